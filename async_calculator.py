@@ -0,0 +1,145 @@
+#! -*- encoding: utf-8 -*-
+import asyncio
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple, Union
+from distance_calculator import DistanceCalculator
+
+
+DEFAULT_MAX_PENDING = 1024  # Queries waiting for the executor at the same time, others wait for a free place
+DEFAULT_WINDOW = 64  # Queries of distances() running at the same time
+
+
+class AsyncDistanceCalculator:
+    """
+    Asyncio facade of DistanceCalculator for services running an event loop
+    Queries run on a bounded thread executor (one thread per pooled connection), so the loop is never blocked by
+    SQLite. Only max_pending queries are submitted at the same time, other callers wait for a free place.
+    Concurrent requests of the same pair of stations share one query.
+    Timeouts cancel waiting of the caller only, the query is cancelled when nobody waits for it anymore
+    (a query already running in the executor thread is finished, but its result is dropped)
+    """
+    def __init__(self, path_to_database: str = "railroads.db", connections: int = 4,
+                 max_pending: int = DEFAULT_MAX_PENDING):
+        """
+        Opens the pool of connections and the executor
+        :param path_to_database: path to the railroads.db
+        :param connections: Number of pooled connections and executor threads
+        :param max_pending: Number of queries submitted to the executor at the same time
+        """
+        self.calculator = DistanceCalculator(path_to_database, connections)
+        self.executor = ThreadPoolExecutor(max_workers=max(connections, 1), thread_name_prefix="distance")
+        self.max_pending = max_pending
+        self.semaphore: Optional[asyncio.Semaphore] = None  # Created in the running loop
+        self.in_flight: Dict[Tuple[str, str], asyncio.Task] = {}
+        self.waiters: Dict[asyncio.Task, int] = {}  # Number of callers waiting for every in-flight query
+
+    async def __aenter__(self) -> "AsyncDistanceCalculator":
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        """
+        Waits for the submitted queries and closes the executor and the connections
+        :return: None
+        """
+        await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
+        self.calculator.close()
+
+    async def run(self, function, *args):
+        """
+        Runs the function in the executor when there is a free place for it
+        :param function: Method of the DistanceCalculator
+        :param args: Arguments of the function
+        :return: Result of the function
+        """
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_pending)
+        async with self.semaphore:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def distance(self, code_from: str, code_to: str, timeout: Optional[float] = None) -> int:
+        """
+        Calculates distance between two stations, see calculate_travel_distance
+        :param code_from: Station code in r_transportation_railroad_stations or Kniga_2...xls
+        :param code_to: Station code in r_transportation_railroad_stations or Kniga_2...xls
+        :param timeout: Seconds to wait for the distance, None - wait until calculated
+        :return: Distance between stations, -1 if they are not connected, -2 if a station doesn't exist
+        Raises asyncio.TimeoutError if the distance is not calculated in time
+        """
+        key = (code_from, code_to)
+        task = self.in_flight.get(key)
+        if task is None:  # The first request of the pair - start the query, next requests wait for it
+            task = asyncio.ensure_future(self.run(self.calculator.distance, code_from, code_to))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self.forget(key, task))
+        self.waiters[task] = self.waiters.get(task, 0) + 1
+        try:
+            # Shield keeps the shared query running if this caller is cancelled or timed out
+            return await asyncio.wait_for(asyncio.shield(task), timeout)
+        finally:
+            self.waiters[task] -= 1
+            if self.waiters[task] == 0:
+                del self.waiters[task]
+                if not task.done():  # Nobody waits for the query anymore, next requests of the pair start a new one
+                    self.forget(key, task)
+                    task.cancel()
+
+    def forget(self, key: Tuple[str, str], task: asyncio.Task) -> None:
+        """
+        Removes the query of the pair from in-flight queries
+        :param key: Tuple with codes of stations
+        :param task: Finished or cancelled query
+        :return: None
+        """
+        if self.in_flight.get(key) is task:
+            del self.in_flight[key]
+
+    async def distances(self, pairs: Union[Iterable[Tuple[str, str]], AsyncIterator[Tuple[str, str]]],
+                        window: int = DEFAULT_WINDOW,
+                        timeout: Optional[float] = None) -> AsyncIterator[Tuple[str, str, int]]:
+        """
+        Calculates distances between pairs of stations, pairs are taken only when there is a free place in the window,
+        so a long (or endless) source of pairs is read as fast as the distances are calculated
+        :param pairs: Iterable or async iterable of tuples with codes of stations
+        :param window: Number of pairs calculated at the same time
+        :param timeout: Seconds to wait for every distance, see distance
+        :return: Async generator of tuples with codes of stations and distance between them in order of pairs
+        """
+        running: "collections.deque[Tuple[str, str, asyncio.Task]]" = collections.deque()
+
+        async def iterate_pairs() -> AsyncIterator[Tuple[str, str]]:
+            if hasattr(pairs, "__aiter__"):
+                async for pair in pairs:
+                    yield pair
+            else:
+                for pair in pairs:
+                    yield pair
+
+        try:
+            async for code_from, code_to in iterate_pairs():
+                running.append((code_from, code_to,
+                                asyncio.ensure_future(self.distance(code_from, code_to, timeout))))
+                if len(running) >= window:
+                    code_from, code_to, task = running.popleft()
+                    yield code_from, code_to, await task
+            while len(running) != 0:
+                code_from, code_to, task = running.popleft()
+                yield code_from, code_to, await task
+        finally:  # The consumer stopped iteration or an error occurred - stop waiting for the rest
+            for _, _, task in running:
+                task.cancel()
+
+    async def distances_from(self, code_from: str, railroad_code: Optional[str] = None,
+                             timeout: Optional[float] = None) -> List[Tuple[str, int]]:
+        """
+        Calculates distances from the station to all stations, see distances_from
+        :param code_from: Station code in r_transportation_railroad_stations or Kniga_2...xls
+        :param railroad_code: Code of the railroad to take stations from, None - all stations
+        :param timeout: Seconds to wait for the distances, None - wait until calculated
+        :return: List of tuples with station code and distance to it
+        """
+        # Nobody else waits for the query, so it's cancelled on timeout
+        return await asyncio.wait_for(self.run(self.calculator.distances_from, code_from, railroad_code), timeout)
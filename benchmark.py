@@ -0,0 +1,321 @@
+#! -*- encoding: utf-8 -*-
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from distance_calculator import DistanceCalculator
+from field_parsers import (parse_distance_column, parse_operation_codes_column, parse_optional_distance_column,
+                           parse_railroad_code_column, parse_station_code_column, parse_transit_distances_column)
+from import_report import ImportReport
+from kniga_1_reader import iter_parts_table, repair_distance, repair_station_code
+from kniga_2_reader import BIG_TYPE_CODE, get_operation_codes, get_railroad_code, get_transit_dict, iter_station_data
+from kniga_3_reader import get_distance, get_transit_table
+from query_metrics import (PHASE_DIRECT_TRANSIT, PHASE_IDENTICAL, PHASE_SAME_PART, PHASE_TP_JOIN,
+                           PHASE_UNKNOWN_STATION, QueryStats)
+from railroad_parser import generate_database
+from synthetic_network import (build_database, generate_books, generate_network, get_kniga1_sheets, get_kniga2_sheets,
+                               get_kniga3_sheets)
+
+
+HELP = """
+  This script generates a synthetic railroad network (see synthetic_network)
+  and measures queries per second and latency percentiles of distance
+  queries by class (the phase of calculate_travel_distance which answers
+  the query), rows per second of every import stage and cells per second
+  of field parsers compared with character loops of the readers.
+  Optional arguments: number of railroads, number of parts of a railroad,
+  number of stations of a part and depth of branches
+  Flags: --queries N - number of sampled queries (default 2000),
+  --save PATH - save results as a baseline,
+  --compare PATH - compare results with the baseline, exits with -1
+  if something is more than 10% slower
+  Example: D:\\work\\MyPyProjects\\railroads>benchmark.exe 10 20 8 2 --compare baseline.json
+
+  Этот скрипт генерирует синтетическую железнодорожную сеть (см. synthetic_network)
+  и измеряет число запросов в секунду и перцентили времени запросов
+  расстояний по классам (этапу calculate_travel_distance, который дает
+  ответ), число строк в секунду каждого этапа импорта и число ячеек
+  в секунду разбора полей в сравнении с посимвольными циклами чтения.
+  Необязательные аргументы: число железных дорог, число участков дороги,
+  число станций участка и глубина ответвлений
+  Флаги: --queries N - число запросов в выборке (по умолчанию 2000),
+  --save PATH - сохранить результаты как базовые,
+  --compare PATH - сравнить результаты с базовыми, завершается с -1,
+  если что-то медленнее более чем на 10%
+  Example: D:\\work\\MyPyProjects\\railroads>benchmark.exe 10 20 8 2 --compare baseline.json
+  """
+
+QUERY_CLASSES = (PHASE_UNKNOWN_STATION, PHASE_IDENTICAL, PHASE_DIRECT_TRANSIT, PHASE_SAME_PART, PHASE_TP_JOIN)
+DEFAULT_QUERIES = 2000
+UNKNOWN_STATION_CODE = "999999"  # Code of a station which is never generated
+REGRESSION_THRESHOLD = 0.1  # Relative slowdown reported as a regression
+PARSER_REPEATS = 5  # Parsing of a column is measured several times, the best time is taken
+
+
+def percentile(sorted_values: Sequence[float], q: float) -> float:
+    """
+    :param sorted_values: Values sorted ascending
+    :param q: Percentile from 0 to 1
+    :return: Nearest-rank percentile, 0 if there are no values
+    """
+    if len(sorted_values) == 0:
+        return 0.0
+    return sorted_values[min(int(q * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def sample_queries(cursor: sqlite3.Cursor, number: int, seed: int = 1) -> List[Tuple[str, str]]:
+    """
+    Samples random pairs of stations, a few pairs have an unknown station or the same station twice,
+    so every query class is present
+    :param cursor: cursor to the railroads.db
+    :param number: Number of pairs
+    :param seed: Seed of the random generator
+    :return: List of tuples with codes of stations
+    """
+    generator = random.Random(seed)
+    station_codes = [code[0] for code in cursor.execute("SELECT code FROM r_transportation_railroad_stations")]
+    transit_pairs = cursor.execute("SELECT code_from, code_to FROM r_transportation_transit_distances").fetchall()
+    pairs = []
+    for index in range(number):
+        if index % 20 == 0:
+            pairs.append((generator.choice(station_codes), UNKNOWN_STATION_CODE))
+        elif index % 20 == 1:
+            code = generator.choice(station_codes)
+            pairs.append((code, code))
+        elif index % 20 == 2 and len(transit_pairs) != 0:
+            pairs.append(tuple(str(code) for code in generator.choice(transit_pairs)))
+        else:
+            pairs.append((generator.choice(station_codes), generator.choice(station_codes)))
+    return pairs
+
+
+def classify_queries(path_to_database: str, pairs: List[Tuple[str, str]]) -> Dict[str, List[Tuple[str, str]]]:
+    """
+    Splits pairs by the phase of calculate_travel_distance which answers the query
+    :param path_to_database: path to the railroads.db
+    :param pairs: List of tuples with codes of stations
+    :return: Dictionary with QUERY_CLASSES as keys and lists of pairs as values
+    """
+    classes: Dict[str, List[Tuple[str, str]]] = {query_class: [] for query_class in QUERY_CLASSES}
+
+    def observe(stats: QueryStats) -> None:
+        classes.setdefault(stats.phase, []).append((stats.code_from, stats.code_to))
+
+    with DistanceCalculator(path_to_database, connections=1, observer=observe) as calculator:
+        for code_from, code_to in pairs:
+            calculator.distance(code_from, code_to)
+    return classes
+
+
+def benchmark_queries(path_to_database: str, classes: Dict[str, List[Tuple[str, str]]]) -> Dict[str, dict]:
+    """
+    Runs queries of every class on a new calculator without an observer, so transit points of stations are
+    searched by the measured queries like in a just started service
+    :param path_to_database: path to the railroads.db
+    :param classes: Result of classify_queries
+    :return: Dictionary with query classes as keys and dictionaries with queries, qps, p50, p90, p99 and max
+    (milliseconds) as values
+    """
+    results = {}
+    for query_class, pairs in classes.items():
+        if len(pairs) == 0:
+            continue
+        times = []
+        with DistanceCalculator(path_to_database, connections=1) as calculator:
+            for code_from, code_to in pairs:
+                started = time.perf_counter()
+                calculator.distance(code_from, code_to)
+                times.append(time.perf_counter() - started)
+        times.sort()
+        results[query_class] = {"queries": len(times), "qps": len(times) / sum(times) if sum(times) > 0 else 0.0,
+                                "p50": percentile(times, 0.5) * 1000, "p90": percentile(times, 0.9) * 1000,
+                                "p99": percentile(times, 0.99) * 1000, "max": times[-1] * 1000}
+    return results
+
+
+def benchmark_import(folder: str, network: dict) -> dict:
+    """
+    Writes books of the network and imports them with generate_database
+    :param folder: Path to the folder for books and the database
+    :param network: Result of generate_network
+    :return: Dictionary with wall_time (seconds), peak_rss and rows_per_second of every stage
+    """
+    path_to_kniga1, path_to_kniga2, path_to_kniga3, path_to_references = generate_books(folder, network)
+    report = ImportReport()
+    generate_database(os.path.join(folder, "imported.db"), path_to_kniga1, path_to_kniga2, path_to_kniga3,
+                      report=report, path_to_references=path_to_references)
+    summary = report.summary()
+    return {"wall_time": summary["wall_time"], "peak_rss": summary["peak_rss"],
+            "rows_per_second": {name: total["rows_per_second"] for name, total in summary["by_stage"].items()
+                                if total["rows"] != 0}}
+
+
+def get_parser_columns(network: dict) -> Dict[str, Tuple[Callable, Callable, tuple]]:
+    """
+    Takes columns of the network books cleaned like the readers do it
+    :param network: Result of generate_network
+    :return: Dictionary with names of fields as keys and tuples with the character loop parser of a cell, the
+    field_parsers parser of a column and arguments (columns) of the column parser as values
+    """
+    parts_rows = [row for name, sheet in get_kniga1_sheets(network).items() if name != "Общие положения"
+                  for row in iter_parts_table(sheet) if row[0].strip(' .').isdigit()]  # Rows of stations only
+    station_rows = list(iter_station_data(get_kniga2_sheets(network)[BIG_TYPE_CODE]))
+    matrix_cells = [cell for name, sheet in get_kniga3_sheets(network).items() if name != "Общие положения"
+                    for row in get_transit_table(sheet)[1] for cell in row[2:]]  # No № and station name
+    distances = [row[k] for row in parts_rows for k in (3, 4) if row[k] != "nan"]
+    return {"station code": (repair_station_code, parse_station_code_column, ([row[1] for row in parts_rows], )),
+            "distance": (repair_distance, parse_distance_column, (distances, )),
+            "matrix distance": (get_distance, parse_optional_distance_column, (matrix_cells, )),
+            "railroad code": (get_railroad_code, parse_railroad_code_column, ([row[3] for row in station_rows], )),
+            "operations": (get_operation_codes, parse_operation_codes_column, ([row[2] for row in station_rows], )),
+            "transit distances": (get_transit_dict, parse_transit_distances_column,
+                                  ([row[4] for row in station_rows], [row[5] for row in station_rows]))}
+
+
+def benchmark_field_parsers(network: dict) -> Dict[str, dict]:
+    """
+    Parses columns of the network books with character loops of the readers and with field_parsers
+    :param network: Result of generate_network
+    :return: Dictionary with names of fields as keys and dictionaries with cells, loop and parser (cells per second)
+    and speedup as values
+    """
+    results = {}
+    for name, (cell_parser, column_parser, columns) in get_parser_columns(network).items():
+        times = {"loop": [], "parser": []}
+        for _ in range(PARSER_REPEATS):
+            started = time.perf_counter()
+            parsed_by_loop = [cell_parser(*cells) for cells in zip(*columns)]
+            times["loop"].append(time.perf_counter() - started)
+            started = time.perf_counter()
+            parsed_by_parser = column_parser(*columns)
+            times["parser"].append(time.perf_counter() - started)
+            if parsed_by_loop != parsed_by_parser:
+                print(f"  field_parsers result differs from the character loop for {name} cells")
+                exit(-1)
+        cells = len(columns[0])
+        loop, parser = min(times["loop"]), min(times["parser"])
+        results[name] = {"cells": cells, "loop": cells / loop if loop > 0 else 0.0,
+                         "parser": cells / parser if parser > 0 else 0.0,
+                         "speedup": loop / parser if parser > 0 else 0.0}
+    return results
+
+
+def run_benchmark(railroads: int = 3, parts: int = 6, stations: int = 5, branch_depth: int = 1,
+                  queries: int = DEFAULT_QUERIES, seed: int = 1) -> dict:
+    """
+    Generates the network, measures queries on the database built from it and the import of its books
+    :param railroads: Number of railroads, see generate_network
+    :param parts: Number of parts of every railroad
+    :param stations: Number of stations of every part
+    :param branch_depth: Depth of branches
+    :param queries: Number of sampled queries
+    :param seed: Seed of the network and of the sampled queries
+    :return: Dictionary with parameters of the network, "queries" - result of benchmark_queries,
+    "import" - result of benchmark_import and "parsers" - result of benchmark_field_parsers
+    """
+    network = generate_network(railroads, parts, stations, branch_depth, seed)
+    with tempfile.TemporaryDirectory() as folder:
+        path_to_database = os.path.join(folder, "railroads.db")
+        build_database(path_to_database, network)
+        connection = sqlite3.connect(path_to_database)
+        pairs = sample_queries(connection.cursor(), queries, seed)
+        connection.close()
+        query_results = benchmark_queries(path_to_database, classify_queries(path_to_database, pairs))
+        import_results = benchmark_import(folder, network)
+    return {"network": {"railroads": railroads, "parts": parts, "stations": len(network["stations"]),
+                        "branch_depth": branch_depth, "seed": seed},
+            "queries": query_results,
+            "import": import_results,
+            "parsers": benchmark_field_parsers(network)}
+
+
+def compare_results(results: dict, baseline: dict, threshold: float = REGRESSION_THRESHOLD) -> Tuple[List[str], bool]:
+    """
+    Compares qps of query classes, rows per second of import stages and cells per second of field parsers with the
+    baseline
+    :param results: Result of run_benchmark
+    :param baseline: Saved result of run_benchmark
+    :param threshold: Relative slowdown reported as a regression
+    :return: Lines of the comparison table and True if there is a regression
+    """
+    lines = [f"{'measure':<32}{'baseline':>14}{'current':>14}{'ratio':>10}"]
+    regression = False
+    measures = [(f"qps {name}", results["queries"].get(name, {}).get("qps"), record["qps"])
+                for name, record in baseline.get("queries", {}).items()]
+    measures += [(f"rows/s {name}", results["import"]["rows_per_second"].get(name), value)
+                 for name, value in baseline.get("import", {}).get("rows_per_second", {}).items()]
+    measures += [(f"cells/s {name}", results.get("parsers", {}).get(name, {}).get("parser"), record["parser"])
+                 for name, record in baseline.get("parsers", {}).items()]
+    for name, current, base in measures:
+        if current is None or base == 0:
+            lines.append(f"{name:<32}{base:>14.1f}{'-':>14}{'-':>10}")
+            continue
+        ratio = current / base
+        mark = "  REGRESSION" if ratio < 1 - threshold else ''
+        regression = regression or mark != ''
+        lines.append(f"{name:<32}{base:>14.1f}{current:>14.1f}{ratio:>10.2f}{mark}")
+    if baseline.get("network") != results["network"]:
+        lines.append("Networks of the baseline and of the current run are different, the ratios are not comparable")
+    return lines, regression
+
+
+def get_flag_value(arguments: List[str], flag: str) -> Optional[str]:
+    """
+    Removes the flag and its value from arguments
+    :param arguments: Command line arguments
+    :param flag: Name of the flag, e.g. "--save"
+    :return: Value of the flag, None if there is no flag
+    """
+    if flag not in arguments:
+        return None
+    index = arguments.index(flag)
+    if index + 1 >= len(arguments):
+        print(f"\n  {flag} flag needs a value. Run script with --help flag to learn more")
+        exit(-1)
+    value = arguments[index + 1]
+    del arguments[index:index + 2]
+    return value
+
+
+if __name__ == "__main__":
+    arguments = sys.argv[1:]
+    if "--help" in arguments:
+        print(HELP)
+        exit(0)
+    save_path = get_flag_value(arguments, "--save")
+    compare_path = get_flag_value(arguments, "--compare")
+    queries_number = get_flag_value(arguments, "--queries") or str(DEFAULT_QUERIES)
+    if not queries_number.isdigit() or not all(argument.isdigit() for argument in arguments[:4]):
+        print("\n  Wrong arguments. Run script with --help flag to learn more")
+        exit(-1)
+    numbers = [int(argument) for argument in arguments[:4]]
+    defaults = [3, 6, 5, 1]  # Railroads, parts, stations, branch depth
+    benchmark_results = run_benchmark(*(numbers + defaults[len(numbers):]), queries=int(queries_number))
+
+    print(f"\n{benchmark_results['network']['stations']} stations")
+    print(f"{'class':<16}{'queries':>10}{'qps':>12}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for class_name, record in benchmark_results["queries"].items():
+        print(f"{class_name:<16}{record['queries']:>10}{record['qps']:>12.1f}{record['p50']:>10.3f}"
+              f"{record['p90']:>10.3f}{record['p99']:>10.3f}{record['max']:>10.3f}")
+    print(f"\nimport {benchmark_results['import']['wall_time']:.2f}s")
+    for stage_name, rows_per_second in benchmark_results["import"]["rows_per_second"].items():
+        print(f"{stage_name:<20}{rows_per_second:>14.1f} rows/s")
+    print(f"\n{'field':<20}{'cells':>10}{'loop cells/s':>16}{'parser cells/s':>16}{'speedup':>10}")
+    for field_name, record in benchmark_results["parsers"].items():
+        print(f"{field_name:<20}{record['cells']:>10}{record['loop']:>16.1f}{record['parser']:>16.1f}"
+              f"{record['speedup']:>10.2f}")
+
+    if save_path is not None:
+        with open(save_path, "w", encoding="utf-8") as baseline_file:
+            json.dump(benchmark_results, baseline_file, ensure_ascii=False, indent=2)
+        print(f"\n{save_path} saved")
+    if compare_path is not None:
+        with open(compare_path, encoding="utf-8") as baseline_file:
+            comparison, regressed = compare_results(benchmark_results, json.load(baseline_file))
+        print("\n" + "\n".join(comparison))
+        if regressed:
+            exit(-1)
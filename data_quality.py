@@ -0,0 +1,261 @@
+#! -*- encoding: utf-8 -*-
+import sqlite3
+import sys
+from typing import Dict, List, Tuple
+import numpy
+from table_generating import (PART_DISTANCES_TABLE, PART_POSITIONS_TABLE, TRANSIT_DISTANCES_TABLE,
+                              format_station_code, object_exists)
+
+
+HELP = """
+  This script checks distances imported to railroads.db: transit
+  distances should be the same in both directions, distances should not be
+  negative or empty, a distance between transit points should not be longer
+  than the way through a station attached to both of them (triangle
+  inequality), distance rows should not refer to unknown stations and
+  every station should have distances. Tables are loaded to numpy arrays
+  and every check is one vectorized pass, so the full network is checked
+  in seconds. Problems are printed with up to 10 samples
+  Optional flag --strict exits with -1 if any problem is found
+  Example: D:\\work\\MyPyProjects\\railroads>data_quality.exe railroads.db --strict
+
+  Этот скрипт проверяет расстояния, загруженные в railroads.db: транзитные
+  расстояния должны совпадать в обоих направлениях, расстояния не должны
+  быть отрицательными или пустыми, расстояние между транзитными пунктами
+  не должно быть длиннее пути через станцию, примыкающую к обоим
+  (неравенство треугольника), строки расстояний не должны ссылаться на
+  неизвестные станции и у каждой станции должны быть расстояния. Таблицы
+  загружаются в массивы numpy, каждая проверка - один векторизованный
+  проход, поэтому вся сеть проверяется за секунды. Проблемы выводятся
+  с примерами (до 10)
+  Флаг --strict завершает работу с -1, если найдена хоть одна проблема
+  Example: D:\\work\\MyPyProjects\\railroads>data_quality.exe railroads.db --strict
+  """
+
+CODE_BASE = 1000000  # Station codes have 6 digits, so a pair of codes is one integer code_from * CODE_BASE + code_to
+SAMPLES_NUMBER = 10  # Problem rows printed for every check
+
+# Checks, every check is reported with the number of problems even if there are none
+CHECK_EMPTY = "empty_distances"
+CHECK_NEGATIVE = "negative_distances"
+CHECK_ONE_WAY = "one_way_transit"
+CHECK_ASYMMETRIC = "asymmetric_transit"
+CHECK_TRANSIT_TRIANGLE = "transit_triangle"
+CHECK_PART_TRIANGLE = "part_triangle"
+CHECK_ORPHANS = "orphan_codes"
+CHECK_UNREACHABLE = "unreachable_stations"
+
+DESCRIPTIONS = {CHECK_EMPTY: "distance rows without distance",
+                CHECK_NEGATIVE: "negative distances",
+                CHECK_ONE_WAY: "transit distances without the opposite direction",
+                CHECK_ASYMMETRIC: "transit distances different from the opposite direction",
+                CHECK_TRANSIT_TRIANGLE: "transit points farther from each other than through an attached station",
+                CHECK_PART_TRIANGLE: "transit points farther from each other than through a station of their part",
+                CHECK_ORPHANS: "codes of distance rows not found in the stations table",
+                CHECK_UNREACHABLE: "stations without transit and part distances"}
+
+# Result of a check: number of problems and up to SAMPLES_NUMBER descriptions of them
+CheckResult = Tuple[int, List[str]]
+
+
+def load_transit_distances(cursor: sqlite3.Cursor) -> numpy.ndarray:
+    """
+    Loads transit distances of any layout (the symmetric view returns both directions)
+    :param cursor: cursor to the railroads.db
+    :return: Array of rows (code_from, code_to, transit_distance) with integer codes, rows without distance are skipped
+    """
+    transit_query = f"""SELECT CAST(code_from AS INTEGER), CAST(code_to AS INTEGER), transit_distance
+                        FROM {TRANSIT_DISTANCES_TABLE} WHERE transit_distance IS NOT NULL"""
+    return numpy.array(cursor.execute(transit_query).fetchall(), dtype=numpy.int64).reshape(-1, 3)
+
+
+def load_part_distances(cursor: sqlite3.Cursor) -> numpy.ndarray:
+    """
+    Loads railroad part distances, part codes are replaced by numbers of the parts in order of their codes
+    :param cursor: cursor to the railroads.db
+    :return: Array of rows (part number, code_from, code_to, distance) with integer codes,
+    rows without distance are skipped
+    """
+    part_query = f"""SELECT DENSE_RANK() OVER (ORDER BY part_code), CAST(code_from AS INTEGER),
+                            CAST(code_to AS INTEGER), distance_between_stations
+                     FROM {PART_DISTANCES_TABLE} WHERE distance_between_stations IS NOT NULL"""
+    return numpy.array(cursor.execute(part_query).fetchall(), dtype=numpy.int64).reshape(-1, 4)
+
+
+def load_station_codes(cursor: sqlite3.Cursor) -> numpy.ndarray:
+    """
+    :param cursor: cursor to the railroads.db
+    :return: Sorted array of integer codes of all stations
+    """
+    stations_query = "SELECT CAST(code AS INTEGER) FROM r_transportation_railroad_stations"
+    return numpy.sort(numpy.array(cursor.execute(stations_query).fetchall(), dtype=numpy.int64).reshape(-1))
+
+
+def sample(rows: numpy.ndarray, row_format: str) -> List[str]:
+    """
+    :param rows: Array of problem rows
+    :param row_format: Format string with {0}, {1}... for columns of a row, e.g. "{0:06d} to {1:06d} {2}km"
+    :return: Descriptions of the first SAMPLES_NUMBER rows
+    """
+    return [row_format.format(*row) for row in rows[:SAMPLES_NUMBER].tolist()]
+
+
+def find_pairs(sorted_keys: numpy.ndarray, keys: numpy.ndarray) -> numpy.ndarray:
+    """
+    :param sorted_keys: Sorted array of pair keys (code_from * CODE_BASE + code_to)
+    :param keys: Keys to look up
+    :return: Indexes of the keys in sorted_keys, -1 for keys which are not found
+    """
+    if len(sorted_keys) == 0:
+        return numpy.full(len(keys), -1, dtype=numpy.int64)
+    indexes = numpy.minimum(numpy.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+    return numpy.where(sorted_keys[indexes] == keys, indexes, -1)
+
+
+def get_group_pairs(groups: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Makes all pairs of rows of the same group without loops: a row of a group with n rows is repeated n times and
+    paired with every row of its group
+    :param groups: Sorted array of group keys of rows
+    :return: Arrays of indexes of the first and the second row of every pair, first < second
+    """
+    _, starts, counts = numpy.unique(groups, return_index=True, return_counts=True)
+    row_counts = numpy.repeat(counts, counts)  # Size of the group of every row
+    row_starts = numpy.repeat(starts, counts)
+    first = numpy.repeat(numpy.arange(len(groups)), row_counts)
+    pair_starts = numpy.repeat(numpy.cumsum(row_counts) - row_counts, row_counts)  # The first pair of every row
+    second = numpy.repeat(row_starts, row_counts) + numpy.arange(len(first)) - pair_starts
+    keep = first < second
+    return first[keep], second[keep]
+
+
+def check_triangle(groups: numpy.ndarray, attachments: numpy.ndarray, transit_keys: numpy.ndarray,
+                   transit_distances: numpy.ndarray) -> numpy.ndarray:
+    """
+    Checks that the distance between two transit points is not longer than the way through a station attached to
+    both of them: distance(tp_a, tp_b) <= distance(station, tp_a) + distance(station, tp_b).
+    Pairs of transit points without transit distance between them are not checked
+    :param groups: Group key of every attachment, only attachments of the same group are paired
+    :param attachments: Array of rows (station, transit point, distance)
+    :param transit_keys: Sorted pair keys of transit distances
+    :param transit_distances: Transit distances in order of transit_keys
+    :return: Array of violating rows (station, tp_a, distance_a, tp_b, distance_b, distance between tp_a and tp_b)
+    """
+    order = numpy.argsort(groups, kind="stable")
+    groups, attachments = groups[order], attachments[order]
+    first, second = get_group_pairs(groups)
+    first, second = attachments[first], attachments[second]
+    found = find_pairs(transit_keys, first[:, 1] * CODE_BASE + second[:, 1])
+    known = found != -1
+    first, second, tp_distances = first[known], second[known], transit_distances[found[known]]
+    violating = tp_distances > first[:, 2] + second[:, 2]
+    return numpy.column_stack((first[violating], second[violating][:, 1:], tp_distances[violating]))
+
+
+def check_database(cursor: sqlite3.Cursor) -> Dict[str, CheckResult]:
+    """
+    Runs all checks of the distance tables
+    :param cursor: cursor to the railroads.db
+    :return: Dictionary with CHECK_... constants as keys and (number of problems, samples) as values
+    """
+    transit = load_transit_distances(cursor)
+    parts = load_part_distances(cursor)
+    station_codes = load_station_codes(cursor)
+    results: Dict[str, CheckResult] = {}
+
+    empty_query = f"""SELECT '{TRANSIT_DISTANCES_TABLE}', code_from, code_to FROM {TRANSIT_DISTANCES_TABLE}
+                      WHERE transit_distance IS NULL
+                      UNION ALL
+                      SELECT '{PART_DISTANCES_TABLE}', code_from, code_to FROM {PART_DISTANCES_TABLE}
+                      WHERE distance_between_stations IS NULL"""
+    empty_select = cursor.execute(empty_query).fetchall()
+    results[CHECK_EMPTY] = (len(empty_select), [f"{table}: {format_station_code(code_from)} to "
+                                                f"{format_station_code(code_to)}"
+                                                for table, code_from, code_to in empty_select[:SAMPLES_NUMBER]])
+
+    negative_transit = transit[transit[:, 2] < 0]
+    negative_parts = parts[parts[:, 3] < 0]
+    results[CHECK_NEGATIVE] = (len(negative_transit) + len(negative_parts),
+                               (sample(negative_transit, f"{TRANSIT_DISTANCES_TABLE}: {{0:06d}} to {{1:06d}} {{2}}km")
+                                + sample(negative_parts, f"{PART_DISTANCES_TABLE}: {{1:06d}} to {{2:06d}} {{3}}km")
+                                )[:SAMPLES_NUMBER])
+
+    # Both directions of every transit distance are stored, the opposite row is found by its pair key
+    keys = transit[:, 0] * CODE_BASE + transit[:, 1]
+    order = numpy.argsort(keys)
+    transit_keys, transit_distances = keys[order], transit[order, 2]
+    opposite = find_pairs(transit_keys, transit[:, 1] * CODE_BASE + transit[:, 0])
+    one_way = transit[opposite == -1]
+    results[CHECK_ONE_WAY] = (len(one_way), sample(one_way, "{0:06d} to {1:06d} {2}km"))
+    has_opposite = opposite != -1
+    asymmetric = numpy.column_stack((transit[has_opposite], transit_distances[opposite[has_opposite]]))
+    asymmetric = asymmetric[(asymmetric[:, 2] != asymmetric[:, 3]) & (asymmetric[:, 0] < asymmetric[:, 1])]
+    results[CHECK_ASYMMETRIC] = (len(asymmetric), sample(asymmetric, "{0:06d} to {1:06d} {2}km, opposite {3}km"))
+
+    # A transit point has distance 0 to itself, distances of other stations go to their transit points (Kniga_2),
+    # distances between transit points (Kniga_3) are not paired - it would be all triangles of the matrix
+    transit_points = numpy.unique(transit[transit[:, 0] == transit[:, 1], 0])
+    attachments = transit[~numpy.isin(transit[:, 0], transit_points) & numpy.isin(transit[:, 1], transit_points)]
+    violating = check_triangle(attachments[:, 0], attachments, transit_keys, transit_distances)
+    results[CHECK_TRANSIT_TRIANGLE] = (len(violating), sample(violating, "{1:06d} to {3:06d} {5}km, "
+                                                                         "through {0:06d} {2}km + {4}km"))
+
+    # Stations of a railroad part have distances to the transit points of the part (Kniga_1)
+    violating = check_triangle(parts[:, 0] * CODE_BASE + parts[:, 1], parts[:, 1:], transit_keys, transit_distances)
+    results[CHECK_PART_TRIANGLE] = (len(violating), sample(violating, "{1:06d} to {3:06d} {5}km, "
+                                                                      "through {0:06d} {2}km + {4}km on the part"))
+
+    positions = numpy.empty(0, dtype=numpy.int64)
+    if object_exists(cursor, PART_POSITIONS_TABLE):  # Databases built before part positions don't have the table
+        positions_query = f"""SELECT CAST(station_code AS INTEGER), CAST(origin_code AS INTEGER)
+                              FROM {PART_POSITIONS_TABLE}"""
+        positions = numpy.array(cursor.execute(positions_query).fetchall(), dtype=numpy.int64).reshape(-1)
+    referenced = numpy.unique(numpy.concatenate((transit[:, 0], transit[:, 1], parts[:, 1], parts[:, 2], positions)))
+    orphans = referenced[~numpy.isin(referenced, station_codes)]
+    results[CHECK_ORPHANS] = (len(orphans), ["%06d" % orphan for orphan in orphans[:SAMPLES_NUMBER]])
+
+    unreachable = station_codes[~numpy.isin(station_codes, referenced)]
+    results[CHECK_UNREACHABLE] = (len(unreachable), ["%06d" % station for station in unreachable[:SAMPLES_NUMBER]])
+    return results
+
+
+def count_problems(results: Dict[str, CheckResult]) -> int:
+    return sum(problems for problems, _ in results.values())
+
+
+def print_report(results: Dict[str, CheckResult]) -> None:
+    """
+    Prints number of problems of every check and their samples
+    :param results: Result of check_database
+    :return: None
+    """
+    for check, (problems, samples) in results.items():
+        print(f"{check:<22}{problems:>9}  {DESCRIPTIONS[check]}")
+        for problem in samples:
+            print(f"    {problem}")
+    print(f"{count_problems(results)} problems found")
+
+
+def validate_database(cursor: sqlite3.Cursor, strict: bool = False) -> int:
+    """
+    Checks the distance tables and prints the report
+    :param cursor: cursor to the railroads.db
+    :param strict: Exit with -1 if any problem is found
+    :return: Number of problems
+    """
+    results = check_database(cursor)
+    print_report(results)
+    problems = count_problems(results)
+    if strict and problems != 0:
+        print("Data quality check has failed!")
+        exit(-1)
+    return problems
+
+
+if __name__ == "__main__":
+    arguments = [argument for argument in sys.argv[1:] if argument != "--strict"]
+    if len(arguments) == 0 or arguments[0] == "--help":
+        print(HELP)
+    else:
+        connection = sqlite3.connect(arguments[0])
+        validate_database(connection.cursor(), strict="--strict" in sys.argv)
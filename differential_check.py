@@ -0,0 +1,351 @@
+#! -*- encoding: utf-8 -*-
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import io
+import itertools
+from multiprocessing import freeze_support
+import os
+import pathlib
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from distance_calculator import DistanceCalculator, calculate_travel_distance
+from partitioned_graph import PartitionedGraph
+from query_metrics import (PHASE_DIRECT_TRANSIT, PHASE_IDENTICAL, PHASE_SAME_PART, PHASE_TP_JOIN,
+                           PHASE_UNKNOWN_STATION, QueryStats)
+from synthetic_network import build_database, generate_network
+
+
+HELP = """
+  This script checks that fast distance engines return the same distances
+  as the reference SQL implementation of calculate_travel_distance.
+  Pairs of stations are sampled from railroads.db by query class
+  (unknown station, identical stations, transit points, same railroad part,
+  transit points search) or all pairs are checked with --exhaustive flag.
+  With --synthetic flag all pairs of several small synthetic networks are
+  checked. Mismatches are reported with minimal pairs reproducing them,
+  the speedup of every engine is reported too. Exits with -1 on mismatches
+  Flags: --pairs N - pairs of every class (default 10000), --workers N -
+  number of processes (default - all cores), --engines a,b - engines
+  to check (default - all registered)
+  Example: D:\\work\\MyPyProjects\\railroads>differential_check.exe railroads.db --pairs 100000 --workers 8
+
+  Этот скрипт проверяет, что быстрые реализации расчета расстояний
+  возвращают те же расстояния, что и эталонная SQL реализация
+  calculate_travel_distance. Пары станций выбираются из railroads.db по
+  классам запросов (неизвестная станция, одинаковые станции, транзитные
+  пункты, один участок, поиск транзитных пунктов) или проверяются все пары
+  с флагом --exhaustive. С флагом --synthetic проверяются все пары
+  нескольких небольших синтетических сетей. Расхождения выводятся с
+  минимальными парами для воспроизведения, также выводится ускорение
+  каждой реализации. Завершается с -1 при расхождениях
+  Флаги: --pairs N - пар каждого класса (по умолчанию 10000), --workers N -
+  число процессов (по умолчанию - все ядра), --engines a,b - проверяемые
+  реализации (по умолчанию - все зарегистрированные)
+  Example: D:\\work\\MyPyProjects\\railroads>differential_check.exe railroads.db --pairs 100000 --workers 8
+  """
+
+REFERENCE_ENGINE = "reference"
+UNKNOWN_STATION_CODE = "999999"  # Code of a station which doesn't exist in the database
+DEFAULT_PAIRS = 10000  # Sampled pairs of every query class
+PAIRS_PER_TASK = 2000  # Pairs checked by a worker in one task
+TASKS_PER_WORKER = 4  # Tasks submitted to every worker ahead, pairs are generated while workers check them
+SYNTHETIC_NETWORKS = ((2, 3, 3, 1, 1), (2, 4, 4, 2, 2), (3, 2, 5, 3, 3), (2, 6, 2, 0, 4))  # generate_network args
+
+# Query classes of sampled pairs, the same as answering phases of calculate_travel_distance
+QUERY_CLASSES = (PHASE_UNKNOWN_STATION, PHASE_IDENTICAL, PHASE_DIRECT_TRANSIT, PHASE_SAME_PART, PHASE_TP_JOIN)
+
+
+class ReferenceEngine:
+    """
+    The reference implementation: calculate_travel_distance on its own connection without shared transit points
+    and part positions, so every query is answered by SQL only
+    """
+    def __init__(self, path_to_database: str):
+        uri = f"{pathlib.Path(path_to_database).absolute().as_uri()}?mode=ro"
+        self.connection = sqlite3.connect(uri, uri=True)
+        self.cursor = self.connection.cursor()
+
+    def distance(self, code_from: str, code_to: str) -> int:
+        return calculate_travel_distance(self.cursor, code_from, code_to)
+
+    def phase(self, code_from: str, code_to: str) -> Tuple[str, int]:
+        """
+        :return: Answering phase of the query and number of SQL statements executed by it
+        """
+        stats: List[QueryStats] = []
+        calculate_travel_distance(self.cursor, code_from, code_to, observer=stats.append)
+        return stats[0].phase, stats[0].statements
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+# Engine name -> function opening the engine for the database. An engine has distance(code_from, code_to) -> int
+# and close() methods. Engines are opened in worker processes by name, so register them at import of a module
+ENGINES: Dict[str, Callable[[str], object]] = {REFERENCE_ENGINE: ReferenceEngine}
+
+
+def register_engine(name: str, factory: Callable[[str], object]) -> None:
+    """
+    Adds an alternative engine to check against the reference
+    :param name: Name of the engine in reports and --engines flag
+    :param factory: Function taking the path to railroads.db and returning the engine
+    :return: None
+    """
+    ENGINES[name] = factory
+
+
+register_engine("calculator", lambda path_to_database: DistanceCalculator(path_to_database, connections=1))
+register_engine("partitioned", PartitionedGraph)
+# Keeps only one railroad loaded, so railroads are dropped and loaded again in the middle of queries
+register_engine("partitioned_evicting", lambda path_to_database: PartitionedGraph(path_to_database, memory_budget=0))
+
+# State of a worker process, set by init_worker
+worker_engines: Dict[str, object] = {}
+
+
+def init_worker(path_to_database: str, engine_names: List[str]) -> None:
+    """
+    Opens the reference and the checked engines in a worker process
+    :param path_to_database: path to the railroads.db
+    :param engine_names: Names of the checked engines
+    :return: None
+    """
+    global worker_engines
+    worker_engines = {name: ENGINES[name](path_to_database) for name in [REFERENCE_ENGINE] + engine_names}
+
+
+def check_pairs(pairs: List[Tuple[str, str]]) -> Tuple[int, Dict[str, float], List[Tuple[str, str, dict]]]:
+    """
+    Calculates distances of the pairs by every engine of the worker
+    Errors of an engine are reported as mismatches with the name of the exception instead of the distance
+    :param pairs: List of tuples with codes of stations
+    :return: Number of checked pairs, dictionary with seconds spent by every engine and list of mismatches -
+    tuples with codes of stations and dictionary with engine names as keys and results as values
+    """
+    times = {name: 0.0 for name in worker_engines}
+    mismatches = []
+    with contextlib.redirect_stdout(io.StringIO()):  # "Station ... does not exist" of every unknown station query
+        for code_from, code_to in pairs:
+            results = {}
+            for name, engine in worker_engines.items():
+                started = time.perf_counter()
+                try:
+                    results[name] = engine.distance(code_from, code_to)
+                except Exception as error:
+                    results[name] = type(error).__name__
+                times[name] += time.perf_counter() - started
+            if any(result != results[REFERENCE_ENGINE] for result in results.values()):
+                mismatches.append((code_from, code_to, results))
+    return len(pairs), times, mismatches
+
+
+def get_station_codes(cursor: sqlite3.Cursor) -> List[str]:
+    return [code[0] for code in cursor.execute("SELECT code FROM r_transportation_railroad_stations ORDER BY code")]
+
+
+def sample_pairs(cursor: sqlite3.Cursor, number: int, seed: int = 1) -> Dict[str, List[Tuple[str, str]]]:
+    """
+    Samples pairs of stations of every query class straight from the tables, so the sampling doesn't depend on
+    the checked implementation. Pairs of the tp_join class are random pairs, a few of them are answered by
+    the earlier phases
+    :param cursor: cursor to the railroads.db
+    :param number: Number of pairs of every class
+    :param seed: Seed of the random generator
+    :return: Dictionary with QUERY_CLASSES as keys and lists of pairs as values
+    """
+    generator = random.Random(seed)
+    station_codes = get_station_codes(cursor)
+    transit_query = "SELECT printf('%06d', code_from), printf('%06d', code_to) FROM r_transportation_transit_distances"
+    transit_pairs = cursor.execute(transit_query).fetchall()
+    part_query = """SELECT part_code, printf('%06d', code_from) FROM r_transportation_railroad_part_distances
+                    GROUP BY part_code, code_from"""
+    part_stations: Dict[str, List[str]] = {}
+    for part_code, station_code in cursor.execute(part_query):
+        part_stations.setdefault(part_code, []).append(station_code)
+    parts = list(part_stations.values())
+    if len(station_codes) == 0:
+        return {query_class: [] for query_class in QUERY_CLASSES}
+
+    def same_part_pair() -> Tuple[str, str]:
+        stations = generator.choice(parts)
+        return generator.choice(stations), generator.choice(stations)
+
+    samplers = {PHASE_UNKNOWN_STATION: lambda: generator.choice(((generator.choice(station_codes),
+                                                                  UNKNOWN_STATION_CODE),
+                                                                 (UNKNOWN_STATION_CODE,
+                                                                  generator.choice(station_codes)))),
+                PHASE_IDENTICAL: lambda: (generator.choice(station_codes),) * 2,
+                PHASE_DIRECT_TRANSIT: lambda: generator.choice(transit_pairs),
+                PHASE_SAME_PART: same_part_pair,
+                PHASE_TP_JOIN: lambda: (generator.choice(station_codes), generator.choice(station_codes))}
+    available = {PHASE_DIRECT_TRANSIT: len(transit_pairs) != 0, PHASE_SAME_PART: len(parts) != 0}
+    return {query_class: [sampler() for _ in range(number)] if available.get(query_class, True) else []
+            for query_class, sampler in samplers.items()}
+
+
+def exhaustive_pairs(station_codes: List[str]) -> Iterator[Tuple[str, str]]:
+    """
+    :param station_codes: Codes of all stations
+    :return: Generator of all ordered pairs of stations and pairs of every station with an unknown one
+    """
+    for code_from in station_codes:
+        for code_to in station_codes:
+            yield code_from, code_to
+        yield code_from, UNKNOWN_STATION_CODE
+
+
+def minimal_repros(path_to_database: str, mismatches: List[Tuple[str, str, dict]]) -> List[dict]:
+    """
+    Groups mismatches by engine and the reference answering phase and keeps the simplest pair of every group -
+    the one answered by the reference with the fewest SQL statements, both directions of a pair are one pair
+    :param path_to_database: path to the railroads.db
+    :param mismatches: Mismatches of check_pairs
+    :return: List of dictionaries with engine, phase, code_from, code_to, expected, actual and statements
+    """
+    reference = ReferenceEngine(path_to_database)
+    repros: Dict[Tuple[str, str], dict] = {}
+    checked = set()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for code_from, code_to, results in mismatches:
+            if (code_to, code_from) in checked or (code_from, code_to) in checked:
+                continue
+            checked.add((code_from, code_to))
+            phase, statements = reference.phase(code_from, code_to)
+            for name, result in results.items():
+                if result == results[REFERENCE_ENGINE]:
+                    continue
+                repro = repros.get((name, phase))
+                if repro is None or statements < repro["statements"]:
+                    repros[(name, phase)] = {"engine": name, "phase": phase, "code_from": code_from,
+                                             "code_to": code_to, "expected": results[REFERENCE_ENGINE],
+                                             "actual": result, "statements": statements}
+    reference.close()
+    return sorted(repros.values(), key=lambda repro: (repro["engine"], repro["phase"]))
+
+
+def run_check(path_to_database: str, pairs: Iterable[Tuple[str, str]], engine_names: List[str],
+              workers: Optional[int] = None) -> dict:
+    """
+    Checks pairs by the engines in parallel processes, pairs are taken from the iterable only when workers need
+    them, so a generator of millions of pairs is not kept in memory
+    :param path_to_database: path to the railroads.db
+    :param pairs: Iterable of tuples with codes of stations
+    :param engine_names: Names of the checked engines registered by register_engine
+    :param workers: Number of worker processes, None - number of cores
+    :return: Dictionary with number of checked pairs, seconds spent by every engine, speedup of every engine
+    (reference time / engine time), number of mismatches of every engine and all mismatches
+    """
+    workers = workers or os.cpu_count() or 1
+    checked = 0
+    times = {name: 0.0 for name in [REFERENCE_ENGINE] + engine_names}
+    mismatches: List[Tuple[str, str, dict]] = []
+    pairs = iter(pairs)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(path_to_database, engine_names)) as executor:
+        running = []
+        while True:
+            while len(running) < workers * TASKS_PER_WORKER:
+                chunk = list(itertools.islice(pairs, PAIRS_PER_TASK))
+                if len(chunk) == 0:
+                    break
+                running.append(executor.submit(check_pairs, chunk))
+            if len(running) == 0:
+                break
+            chunk_checked, chunk_times, chunk_mismatches = running.pop(0).result()
+            checked += chunk_checked
+            for name, engine_time in chunk_times.items():
+                times[name] += engine_time
+            mismatches.extend(chunk_mismatches)
+
+    return {"pairs": checked, "times": times,
+            "speedup": {name: times[REFERENCE_ENGINE] / times[name] if times[name] > 0 else 0.0
+                        for name in engine_names},
+            "mismatch_counts": {name: sum(1 for mismatch in mismatches
+                                          if mismatch[2][name] != mismatch[2][REFERENCE_ENGINE])
+                                for name in engine_names},
+            "mismatches": mismatches}
+
+
+def print_result(title: str, result: dict, repros: List[dict]) -> None:
+    print(f"\n{title}: {result['pairs']} pairs")
+    print(f"{'engine':<24}{'seconds':>10}{'speedup':>10}{'mismatches':>12}")
+    print(f"{REFERENCE_ENGINE:<24}{result['times'][REFERENCE_ENGINE]:>10.2f}{1:>10.2f}{0:>12}")
+    for name, speedup in result["speedup"].items():
+        print(f"{name:<24}{result['times'][name]:>10.2f}{speedup:>10.2f}{result['mismatch_counts'][name]:>12}")
+    for repro in repros:
+        print(f"  {repro['engine']} {repro['phase']}: calculate_travel_distance(cursor, \"{repro['code_from']}\", "
+              f"\"{repro['code_to']}\") = {repro['expected']}, engine returns {repro['actual']}")
+
+
+def get_flag_value(arguments: List[str], flag: str) -> Optional[str]:
+    """
+    Removes the flag and its value from arguments
+    :param arguments: Command line arguments
+    :param flag: Name of the flag, e.g. "--pairs"
+    :return: Value of the flag, None if there is no flag
+    """
+    if flag not in arguments:
+        return None
+    index = arguments.index(flag)
+    if index + 1 >= len(arguments):
+        print(f"\n  {flag} flag needs a value. Run script with --help flag to learn more")
+        exit(-1)
+    value = arguments[index + 1]
+    del arguments[index:index + 2]
+    return value
+
+
+if __name__ == "__main__":
+    freeze_support()
+    arguments = sys.argv[1:]
+    if "--help" in arguments or len(arguments) == 0:
+        print(HELP)
+        exit(0)
+    pairs_number = get_flag_value(arguments, "--pairs") or str(DEFAULT_PAIRS)
+    workers_number = get_flag_value(arguments, "--workers") or "0"
+    engines_flag = get_flag_value(arguments, "--engines")
+    checked_engines = engines_flag.split(",") if engines_flag else [name for name in ENGINES
+                                                                     if name != REFERENCE_ENGINE]
+    if not pairs_number.isdigit() or not workers_number.isdigit() or \
+            any(name not in ENGINES or name == REFERENCE_ENGINE for name in checked_engines):
+        print("\n  Wrong arguments. Run script with --help flag to learn more")
+        print(f"  Registered engines: {', '.join(name for name in ENGINES if name != REFERENCE_ENGINE)}")
+        exit(-1)
+
+    results = []  # Tuples with title, result of run_check and minimal repros
+    if "--synthetic" in arguments:
+        with tempfile.TemporaryDirectory() as folder:
+            for network_number, network_arguments in enumerate(SYNTHETIC_NETWORKS):
+                path_to_synthetic = os.path.join(folder, f"synthetic_{network_number}.db")
+                build_database(path_to_synthetic, generate_network(*network_arguments))
+                connection = sqlite3.connect(path_to_synthetic)
+                codes = get_station_codes(connection.cursor())
+                connection.close()
+                result = run_check(path_to_synthetic, exhaustive_pairs(codes), checked_engines,
+                                   int(workers_number))
+                results.append((f"synthetic network {network_arguments}", result,
+                                minimal_repros(path_to_synthetic, result["mismatches"])))
+    else:
+        path_to_database = arguments[0]
+        if not os.path.exists(path_to_database):
+            print(f"\n  {path_to_database} was not found")
+            exit(-1)
+        connection = sqlite3.connect(path_to_database)
+        if "--exhaustive" in arguments:
+            sampled = {"all pairs": exhaustive_pairs(get_station_codes(connection.cursor()))}
+        else:
+            sampled = sample_pairs(connection.cursor(), int(pairs_number))
+        connection.close()
+        for query_class, class_pairs in sampled.items():
+            result = run_check(path_to_database, class_pairs, checked_engines, int(workers_number))
+            results.append((query_class, result, minimal_repros(path_to_database, result["mismatches"])))
+
+    for title, result, repros in results:
+        print_result(title, result, repros)
+    if any(len(result["mismatches"]) != 0 for _, result, _ in results):
+        exit(-1)
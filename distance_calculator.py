@@ -1,9 +1,27 @@
 #! -*- encoding: utf-8 -*-
+import contextlib
+import json
+import pathlib
+import queue
 import sqlite3
-from typing import List, Tuple
+import threading
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 import sys
+from editions import select_edition
+from query_log import QueryLog
+from query_metrics import (PHASE_DIRECT_TRANSIT, PHASE_IDENTICAL, PHASE_SAME_PART, PHASE_TP_JOIN, PHASE_TP_SEARCH,
+                           PHASE_UNKNOWN_STATION, QueryStats)
+from station_index import DEFAULT_LIMIT, Station, StationIndex
+from table_generating import PART_POSITIONS_TABLE, format_station_code, object_exists
 
 
+DEFAULT_MMAP_SIZE = 1 << 28  # 256 MiB of the database file mapped into memory by every pooled connection
+DEFAULT_CACHE_SIZE = -(1 << 16)  # 64 MiB page cache of every pooled connection (negative value - size in KiB)
+CACHED_STATEMENTS = 256  # Prepared statements cached by every pooled connection
+
+# Observer of calculate_travel_distance calls which don't pass their own, see set_default_observer
+default_observer: Optional[Callable[[QueryStats], None]] = None
+
 HELP = """
   This script calculates the shortest distance between 
   two stations depends on data in railroads.db
@@ -30,6 +48,30 @@ HELP = """
           060904 to 062100 120km + 062100 to 210201 444km + 210201 to 214109 24km = 588km
           060904 to 062100 120km + 062100 to 214700 526km + 214700 to 214109 58km = 704km
           337
+
+  To calculate distances from one station to all stations run script
+  with --from flag, station code and optionally a railroad code
+  to get only stations of the railroad. The script prints lines
+  with station code and distance (-1 if stations are not connected)
+  Example: D:\\work\\MyPyProjects\\railroads>distance_calculator.exe --from 060904 17
+  Output: 170004 412
+          170109 398
+          ...
+
+  To find station codes by a name run script with --find flag, the name
+  (its beginning or the name with typos) and optionally a railroad code.
+  The script prints lines with code, name, railroad code and type
+  of found stations, exact matches first
+  Example: D:\\work\\MyPyProjects\\railroads>distance_calculator.exe --find "Москва-Пасс" 17
+
+  Optional flag --as-of with a date calculates distances by the edition
+  of the books valid at the date (railroads.db should be generated
+  with railroad_parser.py --edition)
+  Example: D:\\work\\MyPyProjects\\railroads>distance_calculator.exe 060904 214109 --as-of 2020-03-01
+
+  Optional flag --query-log with a path adds the query to the binary
+  query log, logs are replayed by query_replay.py
+  Example: D:\\work\\MyPyProjects\\railroads>distance_calculator.exe 060904 214109 --query-log queries.log
           
   Этот скрипт расчитывает кратчайшее расстояние между двумя станциями 
   используя данные из базы railroads.db
@@ -56,92 +98,220 @@ HELP = """
           060904 to 062100 120km + 062100 to 210201 444km + 210201 to 214109 24km = 588km
           060904 to 062100 120km + 062100 to 214700 526km + 214700 to 214109 58km = 704km
           337
+
+  Чтобы расчитать расстояния от одной станции до всех станций запустите
+  скрипт с флагом --from, кодом станции и, при необходимости, кодом
+  железной дороги, чтобы получить только станции этой дороги.
+  Скрипт печатает строки с кодом станции и расстоянием 
+  (-1 если станции не связаны)
+  Example: D:\\work\\MyPyProjects\\railroads>distance_calculator.exe --from 060904 17
+  Output: 170004 412
+          170109 398
+          ...
+
+  Чтобы найти коды станций по названию запустите скрипт с флагом --find,
+  названием (его началом или названием с опечатками) и, при необходимости,
+  кодом железной дороги. Скрипт печатает строки с кодом, названием,
+  кодом дороги и типом найденных станций, сначала точные совпадения
+  Example: D:\\work\\MyPyProjects\\railroads>distance_calculator.exe --find "Москва-Пасс" 17
+
+  Флаг --as-of с датой расчитывает расстояния по изданию книг,
+  действовавшему на эту дату (railroads.db должна быть создана
+  с флагом railroad_parser.py --edition)
+  Example: D:\\work\\MyPyProjects\\railroads>distance_calculator.exe 060904 214109 --as-of 2020-03-01
+
+  Флаг --query-log с путем добавляет запрос в двоичный журнал запросов,
+  журналы воспроизводятся скриптом query_replay.py
+  Example: D:\\work\\MyPyProjects\\railroads>distance_calculator.exe 060904 214109 --query-log queries.log
           
   """
 
 
-def get_distances_to_tp(cursor: sqlite3.Cursor, station_code: str) -> List[Tuple[str, int]]:
+def get_distances_to_tp(cursor: sqlite3.Cursor, station_code: str,
+                        memo: Optional[Dict[str, List[Tuple[str, int]]]] = None) -> List[Tuple[str, int]]:
     """
     Search for all transit points connected to the given station
+    Stations without transit distances are connected through their railroad part neighbours, the chains of
+    neighbours are walked with an explicit stack instead of recursion, so long branches can't exceed recursion limit.
+    A neighbour which is still being walked (a cycle) adds nothing. Results of walked stations are kept in memo only
+    if they don't depend on such neighbours, so the result of a station doesn't depend on where the walk started
     :param cursor: cursor to the railroads.db
     :param station_code: Station code in r_transportation_railroad_stations or Kniga_2...xls
+    :param memo: Dictionary with station codes as keys and results of this function as values. Pass the same
+    dictionary to share results between queries, it's valid while the database doesn't change
     :return: List of tuples with transit point code and distance to it
+    Codes are returned as 6-digit strings for both text and compact layouts of the distance tables
     """
-    # Search for transit points connected to the station with given code
-    transit_from_query = f"""SELECT code_to, transit_distance 
-                             FROM r_transportation_transit_distances 
-                             WHERE code_from = '{station_code}' 
-                             ORDER BY transit_distance"""
-    transit_from_select = cursor.execute(transit_from_query).fetchall()
-
-    if len(transit_from_select) != 0:
-        smallest_distance = transit_from_select[0][1]   # Because SELECT is ordered by distance, if station is a tp
-        if smallest_distance == 0:  # the first distance would be 0, so no need to check all other distances
-            return [transit_from_select[0]]  # Return only this transit point and distance
-        return transit_from_select  # Else return all transit points and distances
-    else:  # If station doesn't have any connection with transit points - look in parts
-        part_query = f"""SELECT code_to, distance_between_stations 
-                         FROM r_transportation_railroad_part_distances 
-                         WHERE code_from = '{station_code}'"""
-        part_select = cursor.execute(part_query).fetchall()
+    if memo is None:
+        memo = {}
+    if station_code in memo:
+        return memo[station_code]
+
+    part_selects: Dict[str, List[Tuple[str, int]]] = {}  # Part neighbours of stations without transit distances
+    partial: Dict[str, List[Tuple[str, int]]] = {}  # Results cut by a cycle, valid for this walk only
+    in_progress = set()
+    stack = [station_code]
+    while len(stack) != 0:
+        current_code = stack[-1]
+        if current_code in memo:
+            stack.pop()
+            continue
+
+        if current_code not in part_selects:  # The first visit of the station
+            # Search for transit points connected to the station with given code
+            transit_from_query = """SELECT code_to, transit_distance 
+                                    FROM r_transportation_transit_distances 
+                                    WHERE code_from = (?) 
+                                    ORDER BY transit_distance"""
+            transit_from_select = [(format_station_code(code), distance)
+                                   for code, distance in cursor.execute(transit_from_query, (current_code, ))]
+
+            if len(transit_from_select) != 0:
+                smallest_distance = transit_from_select[0][1]  # Because SELECT is ordered by distance, if station is
+                if smallest_distance == 0:  # a tp the first distance would be 0, so no need to check all other distances
+                    memo[current_code] = [transit_from_select[0]]  # Only this transit point and distance
+                else:
+                    memo[current_code] = transit_from_select  # Else all transit points and distances
+                stack.pop()
+                continue
+
+            # If station doesn't have any connection with transit points - look in parts
+            part_query = """SELECT code_to, distance_between_stations 
+                            FROM r_transportation_railroad_part_distances 
+                            WHERE code_from = (?)"""
+            part_selects[current_code] = [(format_station_code(code), distance)
+                                          for code, distance in cursor.execute(part_query, (current_code, ))]
+            in_progress.add(current_code)
 
+            not_walked = []
+            for selected_code, selected_distance in part_selects[current_code]:
+                if selected_code in memo or selected_code in partial or selected_code in in_progress:
+                    continue
+                is_station_tp_query = """SELECT * FROM r_transportation_transit_distances 
+                                         WHERE code_from = (?) AND code_to = (?)"""
+                is_station_tp_select = cursor.execute(is_station_tp_query, (selected_code, selected_code)).fetchall()
+                if len(is_station_tp_select) == 0:  # If station is not a transit point - look for its transit points
+                    not_walked.append(selected_code)
+                else:  # A transit point is connected only to itself
+                    memo[selected_code] = [(selected_code, 0)]
+            if len(not_walked) != 0:
+                stack.extend(not_walked)  # Walk the neighbours first and come back to this station
+                continue
+
+        # All neighbours are walked - calculate distances to the closest transit points through them
         station_code_distances = []
-        for selected in part_select:  # Calculate distances to the closest transit points
-            selected_code = selected[0]
-            selected_distance = selected[1]
-            is_station_tp_query = f"""SELECT * FROM r_transportation_transit_distances 
-                                      WHERE code_from = '{selected_code}' AND code_to = '{selected_code}'"""
-            is_station_tp_select = cursor.execute(is_station_tp_query).fetchall()  # Check if station is a transit point
-            if len(is_station_tp_select) == 0:  # If station is not a transit point
-                next_stations = get_distances_to_tp(cursor, selected_code)  # Look for transit points to that station
-                for station in next_stations:
-                    new_station_code = station[0]  # Code of the main station of the station_code main station
-                    new_station_distance = station[1] + selected_distance  # Distance from station_code to main's main
-                    station_code_distances.append((new_station_code, new_station_distance))
-            else:
-                station_code_distances.append(selected)
-        return station_code_distances
+        complete = True
+        for selected_code, selected_distance in part_selects[current_code]:
+            complete = complete and selected_code in memo
+            for new_station_code, distance in memo.get(selected_code, partial.get(selected_code, [])):
+                station_code_distances.append((new_station_code, distance + selected_distance))  # Main's main station
+        if complete or current_code == station_code:  # Nothing is walked before the given station
+            memo[current_code] = station_code_distances
+        else:
+            partial[current_code] = station_code_distances
+        in_progress.discard(current_code)
+        stack.pop()
+
+    return memo[station_code]
 
 
-def same_part_stations_distance(cursor: sqlite3.Cursor, code_from: str, code_to: str, debug: bool) -> int:
+def load_part_positions(cursor: sqlite3.Cursor) -> Optional[Dict[str, Dict[str, Tuple[str, int, int]]]]:
+    """
+    Loads positions of stations on railroad parts for same_part_stations_distance
+    :param cursor: cursor to the railroads.db
+    :return: Dictionary with station codes as keys and dictionaries {part_code: (origin_code, offset, rows_number)}
+    as values, parts are in the order of their origins. None if the database doesn't have positions table
+    """
+    if not object_exists(cursor, PART_POSITIONS_TABLE):
+        return None
+    positions_query = f"""SELECT station_code, part_code, origin_code, origin_offset, rows_number 
+                          FROM {PART_POSITIONS_TABLE} 
+                          ORDER BY station_code, origin_code"""
+    positions = {}
+    for station_code, part_code, origin_code, offset, rows_number in cursor.execute(positions_query):
+        positions.setdefault(station_code, {})[part_code] = (origin_code, offset, rows_number)
+    return positions
+
+
+def part_rows_distance(cursor: sqlite3.Cursor, code_from: str, code_to: str, part_code: str, debug: bool) -> int:
+    """
+    Calculates distance between two stations of the given railroad part from their distance rows
+    :param cursor: cursor to the railroads.db
+    :param code_from: Station code in r_transportation_railroad_stations or Kniga_2...xls
+    :param code_to: Station code in r_transportation_railroad_stations or Kniga_2...xls
+    :param part_code: Code of the railroad part both stations are located at
+    :param debug: Flag to print to all station codes and distances while calculating
+    :return: distance between stations or -1 if rows of the stations don't define it
+    """
+    distances_query = """SELECT r_transportation_railroad_part_distances.distance_between_stations 
+                         FROM r_transportation_railroad_part_distances 
+                         WHERE (code_from = (?) OR code_from = (?)) AND part_code = (?) 
+                         ORDER BY code_to"""
+    distances_select = cursor.execute(distances_query, (code_from, code_to, part_code)).fetchall()
+    if len(distances_select) == 2 or len(distances_select) == 4:
+        from_to_origin = distances_select[0][0]  # Distance from code_from station to part origin
+        to_to_origin = distances_select[1][0]  # Distance from code_to station to part origin
+        distance = from_to_origin - to_to_origin
+        if distance < 0:
+            distance = -distance
+        if debug:
+            print(f"From {code_from} to {part_code} origin {from_to_origin}km, "
+                  f"from {code_to} to {part_code} origin {to_to_origin}km, "
+                  f"between = {distance}km")
+        return distance
+    return -1
+
+
+def same_part_stations_distance(cursor: sqlite3.Cursor, code_from: str, code_to: str, debug: bool,
+                                positions: Optional[Dict[str, Dict[str, Tuple[str, int, int]]]] = None) -> int:
     """
     Checks if stations are at the same railroad part and return distance between them
     :param cursor: cursor to the railroads.db
     :param code_from: Station code in r_transportation_railroad_stations or Kniga_2...xls
     :param code_to: Station code in r_transportation_railroad_stations or Kniga_2...xls
     :param debug: Flag to print to all station codes and distances while calculating
+    :param positions: Result of load_part_positions, stations are checked in memory without queries.
+    None - check with queries to r_transportation_railroad_part_distances
     :return: distance between stations if they are at the same railroad part else -1
     """
-    first_part_code_query = f"""SELECT DISTINCT part_code 
-                                FROM r_transportation_railroad_part_distances 
-                                WHERE code_from = '{code_from}'"""
-    first_part_code_select = cursor.execute(first_part_code_query).fetchall()
+    if positions is not None:
+        parts_to = positions.get(code_to, {})
+        for part_code, (origin_from, offset_from, rows_from) in positions.get(code_from, {}).items():
+            if part_code not in parts_to:
+                continue
+            origin_to, offset_to, rows_to = parts_to[part_code]
+            if rows_from + rows_to not in (2, 4):  # Rows don't define the distance - the next common part
+                continue
+            if rows_from == rows_to and origin_from == origin_to or rows_from == rows_to == 1:
+                # The first two distance rows ordered by code_to are the rows to the origin of the part
+                distance = abs(offset_from - offset_to)
+                if debug:
+                    print(f"From {code_from} to {part_code} origin {offset_from}km, "
+                          f"from {code_to} to {part_code} origin {offset_to}km, "
+                          f"between = {distance}km")
+                return distance
+            # Uneven rows of the stations - take the rows as they are ordered in the database
+            distance = part_rows_distance(cursor, code_from, code_to, part_code, debug)
+            if distance != -1:
+                return distance
+        return -1
+
+    first_part_code_query = """SELECT DISTINCT part_code 
+                               FROM r_transportation_railroad_part_distances 
+                               WHERE code_from = (?)"""
+    first_part_code_select = cursor.execute(first_part_code_query, (code_from, )).fetchall()
     if len(first_part_code_select) > 0:
         first_part_codes = [part_code[0] for part_code in first_part_code_select]
         for first_part_code in first_part_codes:
-            second_part_code_query = f"""SELECT DISTINCT part_code FROM r_transportation_railroad_part_distances 
-                                         WHERE part_code = '{first_part_code}' AND code_from = '{code_to}'"""
-            second_part_code_select = cursor.execute(second_part_code_query).fetchall()
+            second_part_code_query = """SELECT DISTINCT part_code FROM r_transportation_railroad_part_distances 
+                                        WHERE part_code = (?) AND code_from = (?)"""
+            second_part_code_select = cursor.execute(second_part_code_query, (first_part_code, code_to)).fetchall()
             if len(second_part_code_select) > 0:
                 second_part_codes = [part_code[0] for part_code in second_part_code_select]
                 for second_part_code in second_part_codes:
                     if first_part_code == second_part_code:
-                        distances_query = f"""SELECT r_transportation_railroad_part_distances.distance_between_stations 
-                                              FROM r_transportation_railroad_part_distances 
-                                              WHERE (code_from = '{code_from}' OR code_from = '{code_to}')
-                                              AND part_code = '{first_part_code}' 
-                                              ORDER BY code_to"""
-                        distances_select = cursor.execute(distances_query).fetchall()
-                        if len(distances_select) == 2 or len(distances_select) == 4:
-                            from_to_origin = distances_select[0][0]  # Distance from code_from station to part origin
-                            to_to_origin = distances_select[1][0]  # Distance from code_to station to part origin
-                            distance = from_to_origin - to_to_origin
-                            if distance < 0:
-                                distance = -distance
-                            if debug:
-                                print(f"From {code_from} to {first_part_code} origin {from_to_origin}km, "
-                                      f"from {code_to} to {first_part_code} origin {to_to_origin}km, "
-                                      f"between = {distance}km")
+                        distance = part_rows_distance(cursor, code_from, code_to, first_part_code, debug)
+                        if distance != -1:
                             return distance
     return -1
 
@@ -160,88 +330,579 @@ def is_station_exists(cursor: sqlite3.Cursor, station_code: str) -> bool:
     return False
 
 
-def calculate_travel_distance(cursor: sqlite3.Cursor, code_from: str, code_to: str, debug: bool = False) -> int:
+def set_default_observer(observer: Optional[Callable[[QueryStats], None]]) -> None:
+    """
+    Sets the observer of all calculate_travel_distance calls which don't pass their own, so queries of a service are
+    observed without changing its calls, e.g. logged with set_default_observer(QueryLog("queries.log").observe)
+    :param observer: Function called with QueryStats of every query, None - no default observer
+    :return: None
+    """
+    global default_observer
+    default_observer = observer
+
+
+def calculate_travel_distance(cursor: sqlite3.Cursor, code_from: str, code_to: str, debug: bool = False,
+                              memo: Optional[Dict[str, List[Tuple[str, int]]]] = None,
+                              positions: Optional[Dict[str, Dict[str, Tuple[str, int, int]]]] = None,
+                              observer: Optional[Callable[[QueryStats], None]] = None,
+                              as_of: Optional[str] = None, quiet: bool = False) -> int:
     """
     Calculates travel time between two stations with given codes, depends on average travel speed
     :param cursor: cursor to the railroads.db
     :param code_from: Station code in r_transportation_railroad_stations or Kniga_2...xls
     :param code_to: Station code in r_transportation_railroad_stations or Kniga_2...xls
     :param debug: Flag to print to all station codes and distances while calculating
-    :return: Distance between stations or -1 if they are not connected
+    :param memo: Transit points of stations shared between queries, see get_distances_to_tp
+    :param positions: Positions of stations on railroad parts, see load_part_positions
+    :param observer: Function called with QueryStats of the query when it's finished (see query_metrics).
+    The observer takes over the connection's trace callback to count statements and removes it when the query
+    finishes: sqlite3 can't return the callback set before, so a trace callback of the caller is lost and should be
+    set again after the query. None - the default observer (see set_default_observer), no statistics collected and
+    the trace callback isn't touched if it's not set
+    :param as_of: ISO date, the connection reads the edition valid at the date from now on (see editions.py),
+    memo and positions should be of the same edition. None - the edition selected on the connection before,
+    the latest edition by default
+    :param quiet: Don't print unknown stations (e.g. for services and load tests)
+    :return: Distance between stations or -1 if they are not connected, -2 if a station or the edition doesn't exist
     """
-    if not is_station_exists(cursor, code_from):
-        print(f"  Station with code {code_from} does not exist in database")
+    if as_of is not None and not select_edition(cursor, as_of):
         return -2
+    if observer is None:
+        observer = default_observer
+    if observer is None:
+        return travel_distance(cursor, code_from, code_to, debug, memo, positions, quiet=quiet)
 
-    if not is_station_exists(cursor, code_to):
-        print(f"  Station with code {code_to} does not exist in database")
-        return -2
+    stats = QueryStats(code_from, code_to)
+    distance = None
+    cursor.connection.set_trace_callback(stats.count_statement)
+    try:
+        distance = travel_distance(cursor, code_from, code_to, debug, memo, positions, stats, quiet)
+    finally:  # A failed query is observed too, with distance None
+        cursor.connection.set_trace_callback(None)
+        stats.finish(distance)
+        observer(stats)
+    return distance
 
+
+def travel_distance(cursor: sqlite3.Cursor, code_from: str, code_to: str, debug: bool,
+                    memo: Optional[Dict[str, List[Tuple[str, int]]]],
+                    positions: Optional[Dict[str, Dict[str, Tuple[str, int, int]]]],
+                    stats: Optional[QueryStats] = None, quiet: bool = False) -> int:
+    """
+    Calculation of calculate_travel_distance
+    :param stats: Statistics of the query, phases are marked in it if not None
+    Other parameters and return value - see calculate_travel_distance
+    """
+    for station_code in (code_from, code_to):
+        if not is_station_exists(cursor, station_code):
+            if stats is not None:
+                stats.finish_phase(PHASE_UNKNOWN_STATION)
+            if not quiet:
+                print(f"  Station with code {station_code} does not exist in database")
+            return -2
+
+    if stats is not None:
+        stats.finish_phase(PHASE_IDENTICAL)
     if code_from == code_to:  # Distance from a station to itself is 0
         return 0
 
     # Check if stations are transit points (ТП - Kniga_3 stations)
-    transit_check_query = f"""SELECT transit_distance FROM r_transportation_transit_distances 
-                              WHERE code_from = '{code_from}' AND code_to = '{code_to}'"""
-    transit_check_select = cursor.execute(transit_check_query).fetchall()
+    if stats is not None:
+        stats.finish_phase(PHASE_DIRECT_TRANSIT)
+    transit_check_query = """SELECT transit_distance FROM r_transportation_transit_distances 
+                             WHERE code_from = (?) AND code_to = (?)"""
+    transit_check_select = cursor.execute(transit_check_query, (code_from, code_to)).fetchall()
     if len(transit_check_select) == 1:
         return transit_check_select[0][0]
 
     # Check if stations are located on the same railroad part
-    distance = same_part_stations_distance(cursor, code_from, code_to, debug)
+    if stats is not None:
+        stats.finish_phase(PHASE_SAME_PART)
+    distance = same_part_stations_distance(cursor, code_from, code_to, debug, positions)
     if distance != -1:  # If distance != -1 the stations are at the same railroad part
         return distance
 
-    transit_points_from = get_distances_to_tp(cursor, code_from)
-    transit_points_to = get_distances_to_tp(cursor, code_to)
-
-    distances = []
-    for i in range(len(transit_points_from)):
-        for k in range(len(transit_points_to)):
-            transit_from = transit_points_from[i][0]
-            transit_to = transit_points_to[k][0]
-            transit_distance_query = f"""SELECT transit_distance FROM r_transportation_transit_distances 
-                                         WHERE code_from = '{transit_from}' AND code_to = '{transit_to}'"""
-            transit_distance_select = cursor.execute(transit_distance_query).fetchall()
+    if stats is not None:
+        stats.finish_phase(PHASE_TP_SEARCH)
+    if memo is None:
+        memo = {}  # Both ends of the query share their branches at least
+    transit_points_from = get_distances_to_tp(cursor, code_from, memo)
+    transit_points_to = get_distances_to_tp(cursor, code_to, memo)
+
+    if stats is not None:
+        stats.tp_from = len(transit_points_from)
+        stats.tp_to = len(transit_points_to)
+        stats.finish_phase(PHASE_TP_JOIN)
+
+    # Branch and bound: transit points are checked from the closest ones. A transit distance is never negative, so
+    # when the distances to transit points alone are not shorter than the best distance found, farther transit
+    # points can't make a shorter route and aren't looked up. Debug prints all pairs, so nothing is cut there
+    transit_points_from = sorted(transit_points_from, key=lambda transit_point: transit_point[1])
+    transit_points_to = sorted(transit_points_to, key=lambda transit_point: transit_point[1])
+    best_distance = -1
+    for transit_from, distance_from in transit_points_from:
+        if best_distance != -1 and not debug and distance_from + transit_points_to[0][1] >= best_distance:
+            break  # Every next pair is at least as long
+        for transit_to, distance_to in transit_points_to:
+            if best_distance != -1 and not debug and distance_from + distance_to >= best_distance:
+                break
+            if stats is not None:
+                stats.tp_pairs += 1
+            transit_distance_query = """SELECT transit_distance FROM r_transportation_transit_distances 
+                                        WHERE code_from = (?) AND code_to = (?)"""
+            transit_distance_select = cursor.execute(transit_distance_query, (transit_from, transit_to)).fetchall()
             if len(transit_distance_select) != 0:  # If SELECT is empty - transit points are not connected
                 transit_distance = transit_distance_select[0][0]
-                distance_from = transit_points_from[i][1]
-                distance_to = transit_points_to[k][1]
                 distance = distance_from + transit_distance + distance_to
                 if debug:
                     print(f"{code_from} to {transit_from} {distance_from}km + "
                           f"{transit_from} to {transit_to} {transit_distance}km + "
                           f"{transit_to} to {code_to} {distance_to}km = {distance}km")
-                distances.append(distance)
+                if best_distance == -1 or distance < best_distance:
+                    best_distance = distance
 
-    if len(distances) == 0:  # If no distances were added
-        return -1
+    return best_distance  # -1 if no pair of transit points is connected
+
+
+def same_part_distances(cursor: sqlite3.Cursor, code_from: str) -> Dict[str, int]:
+    """
+    Calculates distances from the station to all stations located on the same railroad parts with it.
+    Follows same_part_stations_distance for every station: parts are checked in the same order and a distance is taken
+    only if the two stations have 2 or 4 rows in the part
+    :param cursor: cursor to the railroads.db
+    :param code_from: Station code in r_transportation_railroad_stations or Kniga_2...xls
+    :return: Dictionary with station codes as keys and distances as values
+    """
+    first_part_code_query = """SELECT DISTINCT part_code 
+                               FROM r_transportation_railroad_part_distances 
+                               WHERE code_from = (?)"""
+    first_part_codes = [part_code[0] for part_code in cursor.execute(first_part_code_query, (code_from, )).fetchall()]
+
+    distances: Dict[str, int] = {}
+    for first_part_code in first_part_codes:
+        part_query = """SELECT code_from, code_to, distance_between_stations 
+                        FROM r_transportation_railroad_part_distances 
+                        WHERE part_code = (?)"""
+        part_rows: Dict[str, List[Tuple[str, int]]] = {}  # Station code -> [(code_to, distance)] of this part
+        for station_code, code_to, distance in cursor.execute(part_query, (first_part_code, )).fetchall():
+            station_code = format_station_code(station_code)
+            part_rows.setdefault(station_code, []).append((format_station_code(code_to), distance))
 
-    return min(distances)
+        from_rows = part_rows.pop(code_from, [])
+        for station_code in part_rows:
+            if station_code in distances:  # The distance from a previous part has the priority
+                continue
+            rows = sorted(from_rows + part_rows[station_code], key=lambda row: row[0])  # ORDER BY code_to
+            if len(rows) == 2 or len(rows) == 4:
+                distances[station_code] = abs(rows[0][1] - rows[1][1])
+    return distances
+
+
+def get_transit_vector(cursor: sqlite3.Cursor, transit_points_from: List[Tuple[str, int]]) -> Dict[str, int]:
+    """
+    Combines transit points of a station with the transit distances as a vector of the smallest distances to every
+    point reachable from them: distance to origin transit point + transit distance
+    :param cursor: cursor to the railroads.db
+    :param transit_points_from: List of tuples with transit point code and distance to it from get_distances_to_tp
+    :return: Dictionary with codes of reachable points as keys and the smallest distances as values
+    """
+    origin = json.dumps({transit_point: distance for transit_point, distance in transit_points_from})
+    vector_query = """SELECT r_transportation_transit_distances.code_to, 
+                             MIN(origin.value + r_transportation_transit_distances.transit_distance) 
+                      FROM json_each(?) AS origin 
+                      JOIN r_transportation_transit_distances 
+                      ON r_transportation_transit_distances.code_from = origin.key 
+                      GROUP BY r_transportation_transit_distances.code_to"""
+    return {format_station_code(code): distance for code, distance in cursor.execute(vector_query, (origin, ))}
+
+
+def get_attached_distances(cursor: sqlite3.Cursor, vector: Dict[str, int]) -> Dict[str, int]:
+    """
+    Attaches the vector from get_transit_vector to every station having transit distances in one pass:
+    distance to a station = vector distance to its transit point + distance from the station to the transit point.
+    Stations which are transit points themselves (distance 0) are attached only to themselves like in
+    get_distances_to_tp
+    :param cursor: cursor to the railroads.db
+    :param vector: Dictionary with codes of reachable points as keys and the smallest distances as values
+    :return: Dictionary with codes of stations having transit distances as keys and the smallest distances as values
+    """
+    attached_query = """WITH vector(code, distance) AS (SELECT key, value FROM json_each(?)),
+                             zero_distance(code) AS (SELECT DISTINCT code_from 
+                                                     FROM r_transportation_transit_distances 
+                                                     WHERE transit_distance = 0)
+                        SELECT attached.code_from, MIN(vector.distance + attached.transit_distance) 
+                        FROM r_transportation_transit_distances AS attached 
+                        JOIN vector ON vector.code = attached.code_to 
+                        WHERE attached.transit_distance = 0 OR attached.code_from NOT IN zero_distance 
+                        GROUP BY attached.code_from"""
+    return {format_station_code(code): distance
+            for code, distance in cursor.execute(attached_query, (json.dumps(vector), ))}
+
+
+def get_all_distances_to_tp(cursor: sqlite3.Cursor) -> Dict[str, List[Tuple[str, int]]]:
+    """
+    Searches for transit points connected to every station at once, following get_distances_to_tp:
+    a transit point is connected only to itself, other stations with transit distances - to all points of their
+    transit distances, stations without them - through their railroad part neighbours. If a station is connected to
+    a point by several ways only the shortest one is kept
+    :param cursor: cursor to the railroads.db
+    :return: Dictionary with station codes as keys and lists of tuples with transit point code and distance to it
+    """
+    attached_query = """WITH zero_distance(code) AS (SELECT DISTINCT code_from 
+                                                     FROM r_transportation_transit_distances 
+                                                     WHERE transit_distance = 0)
+                        SELECT code_from, code_to, transit_distance 
+                        FROM r_transportation_transit_distances 
+                        WHERE transit_distance = 0 OR code_from NOT IN zero_distance"""
+    attachments: Dict[str, Dict[str, int]] = {}
+    for code_from, code_to, distance in cursor.execute(attached_query).fetchall():
+        attachments.setdefault(format_station_code(code_from), {})[format_station_code(code_to)] = distance
+
+    transit_points_query = "SELECT code_from FROM r_transportation_transit_distances WHERE code_from = code_to"
+    transit_points = {format_station_code(code[0]) for code in cursor.execute(transit_points_query).fetchall()}
+
+    part_query = "SELECT code_from, code_to, distance_between_stations FROM r_transportation_railroad_part_distances"
+    part_rows: Dict[str, List[Tuple[str, int]]] = {}
+    for station_code, code_to, distance in cursor.execute(part_query).fetchall():
+        station_code = format_station_code(station_code)
+        if station_code not in attachments:  # Stations with transit distances don't look in parts
+            part_rows.setdefault(station_code, []).append((format_station_code(code_to), distance))
+
+    resolved = set(attachments)
+    for station_code in part_rows:
+        stack = [(station_code, False)]  # (station code, are neighbours already pushed)
+        in_progress = set()
+        partial: Dict[str, Dict[str, int]] = {}  # Results cut by a cycle, valid for this walk only
+        while len(stack) != 0:
+            current, expanded = stack.pop()
+            if current in resolved or (not expanded and (current in in_progress or current in partial)):
+                continue
+            if not expanded:
+                in_progress.add(current)
+                stack.append((current, True))
+                for code, distance in part_rows.get(current, []):
+                    if code not in transit_points and code not in resolved and code not in in_progress and \
+                            code not in partial:
+                        stack.append((code, False))
+                continue
+
+            station_distances: Dict[str, int] = {}
+            complete = True
+            for code, distance in part_rows.get(current, []):
+                if code in transit_points:
+                    neighbour_distances = [(code, 0)]
+                else:  # A neighbour which is still in progress (a cycle) adds nothing
+                    complete = complete and code in resolved
+                    neighbour_distances = attachments.get(code, partial.get(code, {})).items()
+                for transit_point, transit_distance in neighbour_distances:
+                    total = transit_distance + distance
+                    if transit_point not in station_distances or total < station_distances[transit_point]:
+                        station_distances[transit_point] = total
+            if complete or current == station_code:  # The same result get_distances_to_tp returns for the station
+                attachments[current] = station_distances
+                resolved.add(current)
+            else:  # Walked again from the station itself
+                partial[current] = station_distances
+            in_progress.discard(current)
+
+    return {station_code: list(attachments[station_code].items()) for station_code in attachments}
+
+
+def distances_from(cursor: sqlite3.Cursor, code_from: str, railroad_code: Optional[str] = None,
+                   memo: Optional[Dict[str, List[Tuple[str, int]]]] = None) -> Iterator[Tuple[str, int]]:
+    """
+    Calculates distances from one station to every station (or every station of the railroad) at once.
+    The origin transit points are searched only once and combined with all stations in bulk queries, every distance
+    is the same as calculate_travel_distance returns for the pair of stations
+    :param cursor: cursor to the railroads.db
+    :param code_from: Station code in r_transportation_railroad_stations or Kniga_2...xls
+    :param railroad_code: Code of the railroad to take stations from, None - all stations
+    :param memo: Transit points of stations shared between queries, see get_distances_to_tp
+    :return: Generator of tuples with station code and distance to it (-1 if stations are not connected)
+    """
+    if not is_station_exists(cursor, code_from):
+        print(f"  Station with code {code_from} does not exist in database")
+        return
+
+    stations_query = "SELECT code FROM r_transportation_railroad_stations"
+    stations_select = cursor.execute(stations_query).fetchall()
+    if railroad_code is not None:
+        stations_query = "SELECT code FROM r_transportation_railroad_stations WHERE railroad_code = (?)"
+        stations_select = cursor.execute(stations_query, (railroad_code, )).fetchall()
+    station_codes = [station[0] for station in stations_select]
+
+    # Stations with a direct transit distance, then stations at the same railroad part have the priority
+    direct_query = "SELECT code_to, transit_distance FROM r_transportation_transit_distances WHERE code_from = (?)"
+    direct_distances = {format_station_code(code): distance
+                        for code, distance in cursor.execute(direct_query, (code_from, )).fetchall()}
+    part_distances = same_part_distances(cursor, code_from)
+
+    # Distances through transit points
+    transit_points_from = get_distances_to_tp(cursor, code_from, memo)
+    vector = get_transit_vector(cursor, transit_points_from)
+    attached = get_attached_distances(cursor, vector)
+
+    transit_points_query = "SELECT code_from FROM r_transportation_transit_distances WHERE code_from = code_to"
+    transit_points = {format_station_code(code[0]) for code in cursor.execute(transit_points_query).fetchall()}
+    with_transit_query = "SELECT DISTINCT code_from FROM r_transportation_transit_distances"
+    with_transit = {format_station_code(code[0]) for code in cursor.execute(with_transit_query).fetchall()}
+
+    # Stations without transit distances are attached through railroad parts like in get_distances_to_tp
+    part_query = "SELECT code_from, code_to, distance_between_stations FROM r_transportation_railroad_part_distances"
+    part_rows: Dict[str, List[Tuple[str, int]]] = {}
+    for station_code, code_to, distance in cursor.execute(part_query).fetchall():
+        station_code = format_station_code(station_code)
+        if station_code not in with_transit:
+            part_rows.setdefault(station_code, []).append((format_station_code(code_to), distance))
+
+    part_attached: Dict[str, Optional[int]] = {}
+
+    def attach_by_parts(station_code: str) -> Optional[int]:
+        """
+        Resolves the smallest distance to a station without transit distances through its part neighbours.
+        Neighbours are resolved first with an explicit stack, a neighbour which is still being resolved (a cycle)
+        adds nothing. Results cut by a cycle are not kept, like in get_distances_to_tp
+        """
+        stack = [(station_code, False)]  # (station code, are neighbours already pushed)
+        in_progress = set()
+        partial: Dict[str, Optional[int]] = {}  # Results cut by a cycle, valid for this walk only
+        while len(stack) != 0:
+            current, expanded = stack.pop()
+            if current in part_attached or (not expanded and (current in in_progress or current in partial)):
+                continue
+            if not expanded:
+                in_progress.add(current)
+                stack.append((current, True))
+                for code, distance in part_rows.get(current, []):
+                    if code not in with_transit and code not in part_attached and code not in in_progress and \
+                            code not in partial:
+                        stack.append((code, False))
+                continue
+
+            best = None
+            complete = True
+            for code, distance in part_rows.get(current, []):
+                if code in transit_points:
+                    neighbour = vector.get(code)
+                elif code in with_transit:
+                    neighbour = attached.get(code)
+                else:
+                    complete = complete and code in part_attached
+                    neighbour = part_attached.get(code, partial.get(code))
+                if neighbour is not None and (best is None or neighbour + distance < best):
+                    best = neighbour + distance
+            if complete or current == station_code:
+                part_attached[current] = best
+            else:
+                partial[current] = best
+            in_progress.discard(current)
+        return part_attached[station_code]
+
+    for station_code in station_codes:
+        if station_code == code_from:
+            yield station_code, 0
+        elif station_code in direct_distances:
+            yield station_code, direct_distances[station_code]
+        elif station_code in part_distances:
+            yield station_code, part_distances[station_code]
+        else:
+            if station_code in with_transit:
+                distance = attached.get(station_code)
+            else:
+                distance = attach_by_parts(station_code)
+            yield station_code, -1 if distance is None else distance
+
+
+class DistanceCalculator:
+    """
+    Thread-safe calculator over a pool of read-only connections to the railroads.db
+    Every call checks a connection out of the pool and returns it back, so the object can be shared between threads
+    (ThreadPoolExecutor, WSGI workers), SQLite releases the GIL while it executes statements.
+    Queries use parameters, so their prepared statements are cached by every connection.
+    Transit points of stations (see get_distances_to_tp) and positions of stations on railroad parts are shared
+    between all calls, the database is expected not to change while the calculator is open
+    """
+    def __init__(self, path_to_database: str = "railroads.db", connections: int = 4,
+                 mmap_size: int = DEFAULT_MMAP_SIZE, cache_size: int = DEFAULT_CACHE_SIZE,
+                 cached_statements: int = CACHED_STATEMENTS,
+                 observer: Optional[Callable[[QueryStats], None]] = None, as_of: Optional[str] = None,
+                 quiet: bool = False):
+        """
+        Opens the pool of connections
+        :param path_to_database: path to the railroads.db, the database is not created if it doesn't exist
+        :param connections: Number of connections in the pool - the number of calls running at the same time
+        :param mmap_size: PRAGMA mmap_size of every connection in bytes
+        :param cache_size: PRAGMA cache_size of every connection, negative - size in KiB
+        :param cached_statements: Number of prepared statements cached by every connection
+        :param observer: Function called with QueryStats of every distance query, e.g. MetricsRegistry.observe
+        :param as_of: ISO date, all calls use the edition valid at the date (see editions.py), None - the latest
+        edition. ValueError is raised if there is no edition at the date
+        :param quiet: Don't print unknown stations of distance queries
+        """
+        self.observer = observer
+        self.quiet = quiet
+        self.memo: Dict[str, List[Tuple[str, int]]] = {}
+        self.positions: Optional[Dict[str, Dict[str, Tuple[str, int, int]]]] = None
+        self.positions_lock = threading.Lock()  # Guards lazy loading of positions and of the station index
+        self.positions_loaded = False
+        self.station_index: Optional[StationIndex] = None  # Built by the first find_stations call
+
+        self.pool: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        self.connections: List[sqlite3.Connection] = []
+        uri = f"{pathlib.Path(path_to_database).absolute().as_uri()}?mode=ro"
+        for _ in range(max(connections, 1)):
+            connection = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=cached_statements)
+            connection.execute(f"PRAGMA mmap_size = {int(mmap_size)}")
+            connection.execute(f"PRAGMA cache_size = {int(cache_size)}")
+            self.connections.append(connection)
+            if as_of is not None and not select_edition(connection.cursor(), as_of):
+                self.close()
+                raise ValueError(f"No edition as of {as_of} in {path_to_database}")
+            self.pool.put(connection)
+
+    def __enter__(self) -> "DistanceCalculator":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """
+        Closes all connections of the pool, calls running at the moment should be finished before
+        :return: None
+        """
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+
+    @contextlib.contextmanager
+    def cursor(self) -> Iterator[sqlite3.Cursor]:
+        """
+        Checks a connection out of the pool, waits if all connections are taken
+        :return: Context manager with a cursor of the checked out connection
+        """
+        connection = self.pool.get()
+        try:
+            yield connection.cursor()
+        finally:
+            self.pool.put(connection)
+
+    def get_positions(self, cursor: sqlite3.Cursor) -> Optional[Dict[str, Dict[str, Tuple[str, int, int]]]]:
+        """
+        Loads positions of stations on railroad parts on the first call
+        :param cursor: cursor to the railroads.db
+        :return: Result of load_part_positions
+        """
+        if not self.positions_loaded:
+            with self.positions_lock:
+                if not self.positions_loaded:
+                    self.positions = load_part_positions(cursor)
+                    self.positions_loaded = True
+        return self.positions
+
+    def distance(self, code_from: str, code_to: str, debug: bool = False) -> int:
+        """
+        Calculates distance between two stations, see calculate_travel_distance
+        :param code_from: Station code in r_transportation_railroad_stations or Kniga_2...xls
+        :param code_to: Station code in r_transportation_railroad_stations or Kniga_2...xls
+        :param debug: Flag to print to all station codes and distances while calculating
+        :return: Distance between stations, -1 if they are not connected, -2 if a station doesn't exist
+        """
+        with self.cursor() as cursor:
+            return calculate_travel_distance(cursor, code_from, code_to, debug, self.memo, self.get_positions(cursor),
+                                             self.observer, quiet=self.quiet)
+
+    def distances_from(self, code_from: str, railroad_code: Optional[str] = None) -> List[Tuple[str, int]]:
+        """
+        Calculates distances from the station to all stations, see distances_from
+        The connection is taken for the whole calculation, so the result is a list, not a generator
+        :param code_from: Station code in r_transportation_railroad_stations or Kniga_2...xls
+        :param railroad_code: Code of the railroad to take stations from, None - all stations
+        :return: List of tuples with station code and distance to it
+        """
+        with self.cursor() as cursor:
+            return list(distances_from(cursor, code_from, railroad_code, self.memo))
+
+    def find_stations(self, text: str, limit: Optional[int] = DEFAULT_LIMIT, railroad_code: Optional[str] = None,
+                      station_type: Optional[str] = None, actual: Optional[bool] = None) -> List[Station]:
+        """
+        Searches for stations by a name typed by a user, see StationIndex.search
+        The index is built on the first call and shared between all calls
+        :param text: Station name, its beginning or a name with typos
+        :param limit: The largest number of stations, None - no limit
+        :param railroad_code: Code of the railroad of stations, None - any railroad
+        :param station_type: "ОП" or "РП", None - any type
+        :param actual: Actuality of stations, None - any actuality
+        :return: List of stations (code, name, railroad_code, type, actuality), exact matches first
+        """
+        if self.station_index is None:
+            with self.positions_lock:
+                if self.station_index is None:
+                    with self.cursor() as cursor:
+                        self.station_index = StationIndex(cursor)
+        return self.station_index.search(text, limit, railroad_code, station_type, actual)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) == 2:  # The first element is the script name
-        if sys.argv[1] == "--help":
-            print(HELP)
+    as_of_date = None
+    if "--as-of" in sys.argv:
+        index = sys.argv.index("--as-of")
+        if index + 1 >= len(sys.argv):
+            print("\n  --as-of flag needs a date. Run script with --help flag to learn more")
+            exit(-1)
+        as_of_date = sys.argv[index + 1]
+        del sys.argv[index:index + 2]
+    query_log = None
+    if "--query-log" in sys.argv:
+        index = sys.argv.index("--query-log")
+        if index + 1 >= len(sys.argv):
+            print("\n  --query-log flag needs a path. Run script with --help flag to learn more")
+            exit(-1)
+        try:
+            query_log = QueryLog(sys.argv[index + 1])
+        except ValueError:
+            exit(-1)
+        set_default_observer(query_log.observe)
+        del sys.argv[index:index + 2]
+
+    # The log is closed (and its buffer written) whichever way the script ends
+    with query_log if query_log is not None else contextlib.nullcontext():
+        if len(sys.argv) in (3, 4) and sys.argv[1] == "--find":  # script name, --find, name, railroad - optional
+            with DistanceCalculator("railroads.db", connections=1, as_of=as_of_date) as calculator:
+                railroad_code = sys.argv[3] if len(sys.argv) == 4 else None
+                for station in calculator.find_stations(sys.argv[2], railroad_code=railroad_code):
+                    print(*station[:4])
+        elif len(sys.argv) in (3, 4) and sys.argv[1] == "--from":  # script name, --from, code_from, railroad - optional
+            path_to_database = "railroads.db"
+            connection = sqlite3.connect(path_to_database)
+            db_cursor = connection.cursor()
+            if as_of_date is not None and not select_edition(db_cursor, as_of_date):
+                exit(-1)
+
+            railroad_code = sys.argv[3] if len(sys.argv) == 4 else None
+            for station_code, distance in distances_from(db_cursor, sys.argv[2], railroad_code):
+                print(station_code, distance)
+        elif len(sys.argv) == 2:  # The first element is the script name
+            if sys.argv[1] == "--help":
+                print(HELP)
+            else:
+                print("\n  Wrong number of arguments. Run script with --help flag to learn more")
+        elif 2 < len(sys.argv) < 5:  # Valid number of arguments is 3 or 4 (script name, code_from, code_to, debug)
+            code_from = sys.argv[1]
+            code_to = sys.argv[2]
+            debug = False
+            if len(sys.argv) == 4:
+                if sys.argv[3] == "--debug":
+                    debug = True
+
+            path_to_database = "railroads.db"
+            connection = sqlite3.connect(path_to_database)
+            db_cursor = connection.cursor()
+
+            # station_from = "060904"
+            # station_to = "214109"
+            distance = calculate_travel_distance(db_cursor, code_from, code_to, debug=debug, as_of=as_of_date)
+            print(distance)
         else:
-            print("\n  Wrong number of arguments. Run script with --help flag to learn more")
-    elif 2 < len(sys.argv) < 5:  # Valid number of arguments is 3 or 4 (script name,code_from,code_to,debug - optional)
-        code_from = sys.argv[1]
-        code_to = sys.argv[2]
-        debug = False
-        if len(sys.argv) == 4:
-            if sys.argv[3] == "--debug":
-                debug = True
-
-        path_to_database = "railroads.db"
-        connection = sqlite3.connect(path_to_database)
-        db_cursor = connection.cursor()
-
-        # station_from = "060904"
-        # station_to = "214109"
-        distance = calculate_travel_distance(db_cursor, code_from, code_to, debug=debug)
-        print(distance)
-    else:
-        input("\n  This script is supposed to be used via console.\n  Run script with --help flag to learn more")
-        input("\n  Этот скрипт содан для консольного использования.\n  Запустите скрипт с флагом --help для информации")
+            input("\n  This script is supposed to be used via console.\n  Run script with --help flag to learn more")
+            input("\n  Этот скрипт содан для консольного использования.\n  Запустите скрипт с флагом --help для информации")
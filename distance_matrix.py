@@ -0,0 +1,192 @@
+#! -*- encoding: utf-8 -*-
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import freeze_support, shared_memory
+import os
+import sqlite3
+import sys
+from typing import List, Optional, Sequence, Tuple
+import numpy
+from distance_calculator import (DistanceCalculator, format_station_code, get_all_distances_to_tp,
+                                 get_distances_to_tp, get_transit_vector, is_station_exists, same_part_distances)
+
+
+HELP = """
+  This script calculates distances between all stations of the given
+  railroads (all stations if railroads are not given) and saves
+  the matrix to .npy (numpy) or .parquet file. Rows of the matrix are
+  stations from, columns are stations to, both ordered by code.
+  Distance is -1 if stations are not connected, -2 if a station doesn't exist
+  Optional flag --workers sets the number of processes (default - all cores)
+  Example: D:\\work\\MyPyProjects\\railroads>distance_matrix.exe matrix.npy 17 24 --workers 8
+
+  Этот скрипт расчитывает расстояния между всеми станциями указанных
+  железных дорог (всеми станциями, если дороги не указаны) и сохраняет
+  матрицу в файл .npy (numpy) или .parquet. Строки матрицы - станции
+  отправления, столбцы - станции назначения, упорядоченные по коду.
+  Расстояние -1 если станции не связаны, -2 если станции не существует
+  Флаг --workers задает число процессов (по умолчанию - все ядра)
+  Example: D:\\work\\MyPyProjects\\railroads>distance_matrix.exe matrix.npy 17 24 --workers 8
+  """
+
+NOT_EXISTING_DISTANCE = -2  # Distance to a station which doesn't exist, the same calculate_travel_distance returns
+ROWS_PER_TASK = 16  # Rows of the matrix calculated by a worker in one task
+
+# State of a worker process, set by init_worker
+worker_calculator: Optional[DistanceCalculator] = None
+worker_memory: Optional[shared_memory.SharedMemory] = None
+worker_matrix: Optional[numpy.ndarray] = None
+worker_codes_from: Sequence[str] = ()
+# Existing stations of the matrix columns: (column, station code, transit points of the station with distances)
+worker_columns: List[Tuple[int, str, List[Tuple[str, int]]]] = []
+
+
+def init_worker(path_to_database: str, memory_name: str, codes_from: Sequence[str], codes_to: Sequence[str]) -> None:
+    """
+    Opens the database, attaches the shared matrix and loads transit points of the column stations in a worker process
+    :param path_to_database: path to the railroads.db
+    :param memory_name: Name of the shared memory block with the matrix
+    :param codes_from: Station codes of the matrix rows
+    :param codes_to: Station codes of the matrix columns
+    :return: None
+    """
+    global worker_calculator, worker_memory, worker_matrix, worker_codes_from, worker_columns
+    worker_calculator = DistanceCalculator(path_to_database, connections=1)
+    worker_memory = shared_memory.SharedMemory(name=memory_name)
+    worker_matrix = numpy.ndarray((len(codes_from), len(codes_to)), dtype=numpy.int32, buffer=worker_memory.buf)
+    worker_codes_from = codes_from
+    with worker_calculator.cursor() as cursor:
+        stations_query = "SELECT code FROM r_transportation_railroad_stations"
+        station_codes = {format_station_code(code[0]) for code in cursor.execute(stations_query).fetchall()}
+        attachments = get_all_distances_to_tp(cursor)  # The same transit points get_distances_to_tp finds
+    worker_columns = [(column, code, attachments.get(code, [])) for column, code in enumerate(codes_to)
+                      if code in station_codes]
+
+
+def fill_rows(start: int, stop: int) -> int:
+    """
+    Calculates rows of the matrix from start to stop and writes them to the shared matrix
+    Distances follow distances_from, so they are the same calculate_travel_distance returns, but transit points of
+    the column stations are loaded once by init_worker, so a row reads only the data of its own station
+    :param start: Index of the first row
+    :param stop: Index after the last row
+    :return: Number of calculated rows
+    """
+    direct_query = "SELECT code_to, transit_distance FROM r_transportation_transit_distances WHERE code_from = (?)"
+    with worker_calculator.cursor() as cursor:
+        for row in range(start, stop):
+            worker_matrix[row, :] = NOT_EXISTING_DISTANCE
+            code_from = worker_codes_from[row]
+            if not is_station_exists(cursor, code_from):
+                continue
+
+            # Stations with a direct transit distance, then stations at the same railroad part have the priority
+            direct_distances = {format_station_code(code): distance
+                                for code, distance in cursor.execute(direct_query, (code_from, )).fetchall()}
+            part_distances = same_part_distances(cursor, code_from)
+            vector = get_transit_vector(cursor, get_distances_to_tp(cursor, code_from, worker_calculator.memo))
+            for column, code_to, transit_points_to in worker_columns:
+                if code_to == code_from:
+                    distance = 0
+                elif code_to in direct_distances:
+                    distance = direct_distances[code_to]
+                elif code_to in part_distances:
+                    distance = part_distances[code_to]
+                else:
+                    distances = [vector[transit_point] + transit_distance
+                                 for transit_point, transit_distance in transit_points_to if transit_point in vector]
+                    distance = min(distances) if len(distances) != 0 else -1
+                worker_matrix[row, column] = distance
+    return stop - start
+
+
+def distance_matrix(codes_from: Sequence[str], codes_to: Sequence[str], workers: Optional[int] = None,
+                    path_to_database: str = "railroads.db") -> numpy.ndarray:
+    """
+    Calculates distances between all given stations in parallel processes
+    Workers write rows straight into a shared memory matrix, so only row numbers are sent between processes
+    :param codes_from: Station codes of the matrix rows
+    :param codes_to: Station codes of the matrix columns
+    :param workers: Number of worker processes, None - number of cores
+    :param path_to_database: path to the railroads.db
+    :return: int32 matrix with distances from codes_from[i] to codes_to[k] at [i, k],
+    -1 if stations are not connected, -2 if a station doesn't exist
+    """
+    codes_from = list(codes_from)
+    codes_to = list(codes_to)
+    shape = (len(codes_from), len(codes_to))
+    if shape[0] == 0 or shape[1] == 0:
+        return numpy.empty(shape, dtype=numpy.int32)
+
+    memory = shared_memory.SharedMemory(create=True, size=shape[0] * shape[1] * numpy.dtype(numpy.int32).itemsize)
+    try:
+        matrix = numpy.ndarray(shape, dtype=numpy.int32, buffer=memory.buf)
+        workers = workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(path_to_database, memory.name, codes_from, codes_to)) as executor:
+            tasks = [executor.submit(fill_rows, start, min(start + ROWS_PER_TASK, shape[0]))
+                     for start in range(0, shape[0], ROWS_PER_TASK)]
+            for task in tasks:
+                task.result()  # Raises the exception of a worker
+        result = matrix.copy()  # The shared block is released below
+        del matrix
+    finally:
+        memory.close()
+        memory.unlink()
+    return result
+
+
+def save_matrix(matrix: numpy.ndarray, codes_from: Sequence[str], codes_to: Sequence[str], path: str) -> None:
+    """
+    Saves the matrix to .npy or .parquet file
+    .npy keeps only distances, .parquet keeps codes_from as index and codes_to as columns (needs pyarrow or fastparquet)
+    :param matrix: Result of distance_matrix
+    :param codes_from: Station codes of the matrix rows
+    :param codes_to: Station codes of the matrix columns
+    :param path: path to the file, the format is taken from the extension
+    :return: None
+    """
+    if path.endswith(".parquet"):
+        from pandas import DataFrame
+        DataFrame(matrix, index=list(codes_from), columns=list(codes_to)).to_parquet(path)
+    else:
+        numpy.save(path, matrix)
+
+
+def get_station_codes(cursor: sqlite3.Cursor, railroad_codes: Optional[List[str]] = None) -> List[str]:
+    """
+    Selects station codes of the railroads
+    :param cursor: cursor to the railroads.db
+    :param railroad_codes: Codes of the railroads, None - all stations
+    :return: List of station codes ordered by code
+    """
+    if not railroad_codes:
+        stations_query = "SELECT code FROM r_transportation_railroad_stations ORDER BY code"
+        return [code[0] for code in cursor.execute(stations_query).fetchall()]
+    stations_query = f"""SELECT code FROM r_transportation_railroad_stations
+                         WHERE railroad_code IN ({', '.join('?' * len(railroad_codes))})
+                         ORDER BY code"""
+    return [code[0] for code in cursor.execute(stations_query, railroad_codes).fetchall()]
+
+
+if __name__ == "__main__":
+    freeze_support()
+    arguments = sys.argv[1:]
+    workers = None
+    if "--workers" in arguments:
+        index = arguments.index("--workers")
+        if index + 1 >= len(arguments) or not arguments[index + 1].isdigit():
+            print("\n  --workers flag needs a number. Run script with --help flag to learn more")
+            exit(-1)
+        workers = int(arguments[index + 1])
+        del arguments[index:index + 2]
+
+    if len(arguments) == 0 or arguments[0] == "--help":
+        print(HELP)
+    else:
+        path_to_database = "railroads.db"
+        with DistanceCalculator(path_to_database, connections=1) as calculator:
+            with calculator.cursor() as db_cursor:
+                station_codes = get_station_codes(db_cursor, arguments[1:])
+        matrix = distance_matrix(station_codes, station_codes, workers, path_to_database)
+        save_matrix(matrix, station_codes, station_codes, arguments[0])
+        print(f"{arguments[0]} saved: {matrix.shape[0]}x{matrix.shape[1]}")
@@ -0,0 +1,201 @@
+#! -*- encoding: utf-8 -*-
+from datetime import datetime
+import os
+import re
+import sqlite3
+from typing import Dict, List, Optional, Tuple
+from table_generating import (PART_DISTANCES_TABLE, PART_POSITIONS_TABLE, TRANSIT_DISTANCES_TABLE,
+                              TRANSIT_PAIRS_TABLE, is_symmetric_layout, object_exists)
+
+
+EDITIONS_TABLE = "r_transportation_editions"
+HISTORY_SUFFIX = "_history"
+AS_OF_TABLE = "as_of_edition"  # TEMP table with the edition selected on the connection
+EDITION_PATTERN = re.compile(r"[0-9]{4}-[0-9]{2}-[0-9]{2}")  # Kniga_1_2019-10-09.xls -> 2019-10-09
+
+# Editions of the books are kept in one database. The data tables always have the latest imported edition, every one
+# of them has a history table with the same columns and [valid_from], [valid_to] - the first edition with the row and
+# the first edition without it (NULL - the row is in the latest edition). A row which doesn't change between editions
+# is stored in the history once. Editions are ISO dates of the books, so they are compared as strings.
+# A connection reads an older edition through TEMP views named as the data tables: TEMP objects are looked up before
+# the main database, so queries don't change and are served by the (key columns, valid_from) indexes of the history
+EDITIONS_QUERY = f"""
+    CREATE TABLE IF NOT EXISTS [{EDITIONS_TABLE}](  -- Imported editions of the books
+        [edition] VARCHAR(10) PRIMARY KEY NOT NULL,
+        [imported] DATETIME NOT NULL);"""
+
+TEMP_TRANSIT_VIEW_QUERY = f"""
+    CREATE TEMP VIEW {TRANSIT_DISTANCES_TABLE} AS  -- Both directions of every pair of the selected edition
+    SELECT code_from, code_to, transit_distance FROM temp.{TRANSIT_PAIRS_TABLE}
+    UNION ALL
+    SELECT code_to, code_from, transit_distance FROM temp.{TRANSIT_PAIRS_TABLE} WHERE code_from != code_to"""
+
+# Versioned tables and their key columns, a row of the history is a version of the row with the same key
+VERSIONED_TABLES: Dict[str, Tuple[str, ...]] = {
+    "r_transportation_railroad_stations": ("code", ),
+    "r_transportation_station_operations": ("station_code", "operation_code"),
+    TRANSIT_DISTANCES_TABLE: ("code_from", "code_to"),
+    "r_transportation_railroad_parts": ("code", ),
+    PART_DISTANCES_TABLE: ("code_from", "code_to"),
+    PART_POSITIONS_TABLE: ("station_code", "part_code")}
+
+
+def get_edition(path_to_book: str) -> Optional[str]:
+    """
+    :param path_to_book: path to Kniga_...xls
+    :return: Date of the edition from the file name: "Kniga_1_2019-10-09.xls" -> "2019-10-09", None if not found
+    """
+    found = EDITION_PATTERN.search(os.path.basename(path_to_book))
+    return found.group() if found is not None else None
+
+
+def get_versioned_tables(cursor: sqlite3.Cursor) -> Dict[str, Tuple[str, ...]]:
+    """
+    :param cursor: cursor to the railroads.db
+    :return: VERSIONED_TABLES, the symmetric layout has the pairs table instead of the transit distances view
+    """
+    if not is_symmetric_layout(cursor):
+        return VERSIONED_TABLES
+    return {(TRANSIT_PAIRS_TABLE if table == TRANSIT_DISTANCES_TABLE else table): key
+            for table, key in VERSIONED_TABLES.items()}
+
+
+def get_columns(cursor: sqlite3.Cursor, table_name: str) -> List[Tuple[str, str]]:
+    """
+    :param cursor: cursor to the railroads.db
+    :param table_name: name of the table
+    :return: List of tuples with name and type of every column of the table in the main database
+    """
+    return [(column_info[1], column_info[2])
+            for column_info in cursor.execute(f"PRAGMA main.table_info({table_name})").fetchall()]
+
+
+def create_edition_tables(cursor: sqlite3.Cursor) -> None:
+    """
+    Creates the editions table and history tables of the versioned tables if they don't exist
+    Should be called after create_tables
+    :param cursor: cursor to the railroads.db
+    :return: None
+    """
+    cursor.execute(EDITIONS_QUERY)
+    for table_name, key in get_versioned_tables(cursor).items():
+        columns = ', '.join(f"[{name}] {column_type}" for name, column_type in get_columns(cursor, table_name))
+        cursor.executescript(f"""
+        CREATE TABLE IF NOT EXISTS [{table_name}{HISTORY_SUFFIX}](  -- Versions of rows of {table_name}
+            {columns},
+            [valid_from] VARCHAR(10) NOT NULL,
+            [valid_to] VARCHAR(10));
+        CREATE INDEX IF NOT EXISTS [{table_name}{HISTORY_SUFFIX}_key]  -- Versions of a row ordered by edition
+        ON [{table_name}{HISTORY_SUFFIX}]({', '.join(key)}, [valid_from]);""")
+
+
+def get_latest_edition(cursor: sqlite3.Cursor) -> Optional[str]:
+    """
+    :param cursor: cursor to the railroads.db
+    :return: The latest imported edition, None if there are no editions
+    """
+    if not object_exists(cursor, EDITIONS_TABLE):
+        return None
+    return cursor.execute(f"SELECT MAX(edition) FROM {EDITIONS_TABLE}").fetchone()[0]
+
+
+def is_new_edition(cursor: sqlite3.Cursor, edition: str) -> bool:
+    """
+    Checks that the edition can be imported: editions are imported in order of their dates,
+    the latest edition can be imported again
+    :param cursor: cursor to the railroads.db
+    :param edition: Edition of the books, ISO date
+    :return: True if the edition is not older than the latest one
+    """
+    latest_edition = get_latest_edition(cursor)
+    if latest_edition is not None and edition < latest_edition:
+        print(f"Edition {edition} is older than the latest imported edition {latest_edition}!")
+        return False
+    return True
+
+
+def clear_versioned_tables(cursor: sqlite3.Cursor) -> None:
+    """
+    Deletes rows of the versioned tables before an edition is imported, so they get only rows of the edition.
+    Rows of the previous editions stay in the history
+    :param cursor: cursor to the railroads.db
+    :return: None
+    """
+    for table_name in get_versioned_tables(cursor):
+        cursor.execute(f"DELETE FROM {table_name}")
+
+
+def record_edition(cursor: sqlite3.Cursor, edition: str) -> None:
+    """
+    Adds the data tables to the history as the edition: versions of rows which changed or disappeared get valid_to,
+    new and changed rows get a version valid from the edition, unchanged rows aren't touched.
+    If the edition is the latest one its versions are replaced
+    :param cursor: cursor to the railroads.db
+    :param edition: Edition of the imported books, ISO date not older than the latest edition
+    :return: None
+    """
+    create_edition_tables(cursor)
+    undo_edition = get_latest_edition(cursor) == edition
+    for table_name, key in get_versioned_tables(cursor).items():
+        history_name = f"{table_name}{HISTORY_SUFFIX}"
+        if undo_edition:  # The history is returned to the previous edition
+            cursor.execute(f"DELETE FROM {history_name} WHERE valid_from = (?)", (edition, ))
+            cursor.execute(f"UPDATE {history_name} SET valid_to = NULL WHERE valid_to = (?)", (edition, ))
+
+        column_names = [name for name, _ in get_columns(cursor, table_name)]
+        # Keys are compared with = to use indexes, other columns with IS because they may be NULL
+        same_row = ' AND '.join(f"current.{name} {'=' if name in key else 'IS'} history.{name}"
+                                for name in column_names)
+        cursor.execute(f"""UPDATE {history_name} AS history SET valid_to = (?)
+                           WHERE valid_to IS NULL
+                           AND NOT EXISTS (SELECT 1 FROM {table_name} AS current WHERE {same_row})""", (edition, ))
+        columns = ', '.join(column_names)
+        cursor.execute(f"""INSERT INTO {history_name} ({columns}, valid_from)
+                           SELECT {columns}, (?) FROM {table_name} AS current
+                           WHERE NOT EXISTS (SELECT 1 FROM {history_name} AS history
+                                             WHERE {same_row} AND history.valid_to IS NULL)""", (edition, ))
+    cursor.execute(f"INSERT OR REPLACE INTO {EDITIONS_TABLE} (edition, imported) VALUES (?, ?)",
+                   (edition, datetime.now().isoformat(timespec="seconds")))
+
+
+def select_edition(cursor: sqlite3.Cursor, as_of: Optional[str]) -> bool:
+    """
+    Makes the connection of the cursor read the edition valid at the date: the latest edition not newer than as_of.
+    Works on read-only connections, only TEMP objects are created. Changes of the TEMP table are committed unless the
+    connection was in a transaction before, otherwise the connection would keep the read lock of the database
+    :param cursor: cursor to the railroads.db
+    :param as_of: ISO date like "2020-03-01", None - the data tables (the latest edition)
+    :return: True if the edition is selected, False if there is no edition at the date
+    """
+    in_transaction = cursor.connection.in_transaction
+    if as_of is None:
+        for table_name in list(VERSIONED_TABLES) + [TRANSIT_PAIRS_TABLE]:
+            cursor.execute(f"DROP VIEW IF EXISTS temp.{table_name}")
+        return True
+
+    edition_select = None
+    if object_exists(cursor, EDITIONS_TABLE):
+        edition_query = f"SELECT edition FROM {EDITIONS_TABLE} WHERE edition <= (?) ORDER BY edition DESC LIMIT 1"
+        edition_select = cursor.execute(edition_query, (as_of, )).fetchone()
+    if edition_select is None:
+        print(f"  No edition as of {as_of} in the database")
+        return False
+
+    views_query = "SELECT COUNT(*) FROM temp.sqlite_master WHERE type = 'view'"
+    if cursor.execute(views_query).fetchone()[0] == 0:  # The first selection on the connection
+        cursor.execute(f"CREATE TEMP TABLE IF NOT EXISTS {AS_OF_TABLE} (edition VARCHAR(10))")
+        cursor.execute(f"DELETE FROM temp.{AS_OF_TABLE}")
+        cursor.execute(f"INSERT INTO temp.{AS_OF_TABLE} (edition) VALUES (NULL)")
+        selected = f"(SELECT edition FROM temp.{AS_OF_TABLE})"
+        versioned_tables = get_versioned_tables(cursor)
+        for table_name in versioned_tables:
+            columns = ', '.join(name for name, _ in get_columns(cursor, table_name))
+            cursor.execute(f"""CREATE TEMP VIEW {table_name} AS
+                               SELECT {columns} FROM main.{table_name}{HISTORY_SUFFIX}
+                               WHERE valid_from <= {selected} AND (valid_to IS NULL OR valid_to > {selected})""")
+        if TRANSIT_PAIRS_TABLE in versioned_tables:  # The main view reads the main pairs table only
+            cursor.execute(TEMP_TRANSIT_VIEW_QUERY)
+    cursor.execute(f"UPDATE temp.{AS_OF_TABLE} SET edition = (?) WHERE edition IS NOT (?)", edition_select * 2)
+    if not in_transaction:
+        cursor.connection.commit()
+    return True
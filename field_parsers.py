@@ -0,0 +1,183 @@
+#! -*- encoding: utf-8 -*-
+import re
+from typing import Dict, Iterable, List, Sequence
+
+
+# Parsers of Kniga cell formats. Every parser gives the same result as the character loop it replaces in the readers
+# (repair_station_code, repair_distance, get_distance, get_railroad_code, get_operation_codes, get_transit_dict),
+# but runs precompiled regular expressions and str methods, plain digit cells don't even get to a regular expression.
+# Operations are separated by spaces and commas: "О 1,3,4,6,8,8н, 9,10,10н".
+# ..._column variants parse a whole column of cells at once and return lists, values are ready for executemany.
+# A cell which can't be parsed raises FieldParseError instead of a bare int('') ValueError
+NON_DIGITS = re.compile(r"[^0-9]+")  # Only ASCII digits, \d matches other digits too
+RAILROAD_CODE = re.compile(r"[0-9]+(?=[^0-9])")  # The first digits followed by anything: "76 Сверд (Р)" -> "76"
+TRANSIT_POINT_SEPARATOR = ", "  # "917103 Новый Ургал - 2090км, 927105 Лена - 489км"
+NAN = "nan"  # Empty cell of a worksheet
+TRANSIT_POINT = "ТП"  # Transit distances cell of a transit point
+
+
+class FieldParseError(ValueError):
+    """
+    A cell of a worksheet doesn't match its format
+    """
+    def __init__(self, field: str, cell: str, reason: str):
+        """
+        :param field: Name of the field: "distance", "transit distances"...
+        :param cell: The cell as it is in the worksheet
+        :param reason: What is wrong with the cell
+        """
+        super().__init__(f"Malformed {field} cell {cell!r}: {reason}")
+        self.field = field
+        self.cell = cell
+        self.reason = reason
+
+
+def get_digits(cell: str) -> str:
+    """
+    :param cell: A cell of a worksheet
+    :return: ASCII digits of the cell in their order: "023202 ." -> "023202", '' if there are no digits
+    """
+    if cell.isdigit() and cell.isascii():  # Most of cells are clean already
+        return cell
+    return NON_DIGITS.sub('', cell)
+
+
+def parse_station_code(cell: str) -> str:
+    """
+    The same as kniga_1_reader.repair_station_code
+    :param cell: Station code cell like "023202 ."
+    :return: Code only string, '' if there are no digits (never found in the stations table)
+    """
+    return get_digits(cell)
+
+
+def parse_distance(cell: str) -> int:
+    """
+    The same as kniga_1_reader.repair_distance
+    :param cell: Distance cell like "   2  км "
+    :return: Distance
+    """
+    digits = get_digits(cell)
+    if digits == '':
+        raise FieldParseError("distance", cell, "no digits")
+    return int(digits)
+
+
+def parse_optional_distance(cell: str, missing: int = -1) -> int:
+    """
+    The same as kniga_3_reader.get_distance
+    :param cell: Distance cell of a Kniga_3...xls worksheet
+    :param missing: Distance returned for "nan" and cells without digits (not connected stations)
+    :return: Distance or missing
+    """
+    if cell == NAN:
+        return missing
+    digits = get_digits(cell)
+    return int(digits) if digits != '' else missing
+
+
+def parse_railroad_code(cell: str) -> str:
+    """
+    The same as kniga_2_reader.get_railroad_code
+    :param cell: Railroad cell like "76 Сверд (Р)"
+    :return: The first digits followed by another character, '' if there are no such digits
+    """
+    found = RAILROAD_CODE.search(cell)
+    return found.group() if found is not None else ''
+
+
+def parse_operation_codes(cell: str) -> List[str]:
+    """
+    The same as kniga_2_reader.get_operation_codes
+    :param cell: Operations cell like "О 1,3,4,6,8,8н, 9,10,10н"
+    :return: List of operations, "nan" is skipped
+    """
+    if cell.isprintable():  # No tabs, line breaks and other spaces, so split() splits only by the spaces
+        operations = cell.replace(',', ' ').split()
+        if NAN not in operations:
+            return operations
+    return [operation for operation in cell.replace(',', ' ').split(' ') if operation != '' and operation != NAN]
+
+
+def parse_transit_distances(cell: str, code_from: str) -> Dict[str, int]:
+    """
+    The same as kniga_2_reader.get_transit_dict
+    :param cell: Transit distances cell like "917103 Новый Ургал - 2090км, 927105 Лена - 489км", "ТП" or "nan"
+    :param code_from: Code of the station of the row, a transit point gets distance 0 to itself
+    :return: Dictionary with codes of transit points as keys and distances to them as values
+    """
+    if cell == NAN:
+        return {}
+    if cell == TRANSIT_POINT:
+        return {code_from: 0}
+    transit_distances: Dict[str, int] = {}
+    for transit in cell.split(TRANSIT_POINT_SEPARATOR):
+        try:  # "917103 Новый Ургал - 2090км" -> "917103": 2090
+            transit_distances[transit.partition(' ')[0]] = int(transit.rpartition(' ')[2][:-2])
+        except ValueError:
+            raise FieldParseError("transit distances", cell, f"{transit!r} doesn't end with distance like 2090км")
+    return transit_distances
+
+
+def parse_station_code_column(cells: Iterable[str]) -> List[str]:
+    """
+    :param cells: Station code cells
+    :return: List of parse_station_code results
+    """
+    substitute = NON_DIGITS.sub
+    return [cell if cell.isdigit() and cell.isascii() else substitute('', cell) for cell in cells]
+
+
+def parse_distance_column(cells: Sequence[str]) -> List[int]:
+    """
+    :param cells: Distance cells
+    :return: List of parse_distance results
+    """
+    substitute = NON_DIGITS.sub
+    digits = [cell if cell.isdigit() and cell.isascii() else substitute('', cell) for cell in cells]
+    if '' in digits:
+        number = digits.index('')
+        raise FieldParseError("distance", cells[number], f"no digits in the cell {number + 1} of the column")
+    return [int(distance) for distance in digits]
+
+
+def parse_optional_distance_column(cells: Iterable[str], missing: int = -1) -> List[int]:
+    """
+    :param cells: Distance cells of a Kniga_3...xls worksheet, e.g. a row of the distances matrix
+    :param missing: Distance of "nan" and cells without digits
+    :return: List of parse_optional_distance results
+    """
+    substitute = NON_DIGITS.sub
+    digits = (NAN if cell == NAN else cell if cell.isdigit() and cell.isascii() else substitute('', cell)
+              for cell in cells)
+    return [missing if distance == NAN or distance == '' else int(distance) for distance in digits]
+
+
+def parse_railroad_code_column(cells: Sequence[str]) -> List[str]:
+    """
+    :param cells: Railroad cells
+    :return: List of parse_railroad_code results
+    """
+    codes = {cell: parse_railroad_code(cell) for cell in set(cells)}  # A column has only a few railroads
+    return [codes[cell] for cell in cells]
+
+
+def parse_operation_codes_column(cells: Sequence[str]) -> List[List[str]]:
+    """
+    :param cells: Operations cells
+    :return: List of parse_operation_codes results, equal cells share the list
+    """
+    operations: Dict[str, List[str]] = {}  # Stations have only a few combinations of operations
+    for cell in cells:
+        if cell not in operations:
+            operations[cell] = parse_operation_codes(cell)
+    return [operations[cell] for cell in cells]
+
+
+def parse_transit_distances_column(cells: Iterable[str], codes_from: Iterable[str]) -> List[Dict[str, int]]:
+    """
+    :param cells: Transit distances cells
+    :param codes_from: Codes of stations of the cells
+    :return: List of parse_transit_distances results
+    """
+    return [parse_transit_distances(cell, code_from) for cell, code_from in zip(cells, codes_from)]
@@ -0,0 +1,160 @@
+#! -*- encoding: utf-8 -*-
+import contextlib
+from datetime import datetime
+import json
+import sys
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar
+try:
+    import resource  # Not available on Windows, peak RSS is not reported there
+except ImportError:
+    resource = None
+
+
+REPORT_PATH = "import_report.json"
+
+# Stages of the import, every stage is reported for every book and worksheet it passes
+STAGE_REFERENCES = "references"
+STAGE_DECODE = "xls_decode"
+STAGE_CLEANUP = "table_cleanup"
+STAGE_RESOLUTION = "station_resolution"
+STAGE_INSERT = "db_insert"
+STAGE_POSITIONS = "part_positions"
+STAGE_EDITION = "edition_history"
+STAGE_VACUUM = "vacuum"
+STAGE_VALIDATION = "validation"
+STAGE_XML = "xml_export"
+
+Item = TypeVar("Item")
+producing: List[float] = []  # Time of nested stages of every measured stage producing an item now, see measured
+
+
+def peak_rss() -> Optional[int]:
+    """
+    :return: Peak resident set size of the process in bytes, None if it can't be measured
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024  # Linux reports KiB, macOS - bytes
+
+
+def throughput(rows: int, wall_time: float) -> float:
+    return rows / wall_time if wall_time > 0 else 0.0
+
+
+class ImportReport:
+    """
+    Timing of the import stages (see STAGE_... constants) by book and worksheet.
+    Repeated stages of the same book and worksheet (e.g. inserts of every railroad part) are summed up
+    """
+    def __init__(self):
+        self.started = datetime.now()
+        self.started_counter = time.perf_counter()
+        self.stages: Dict[Tuple[str, str, str], dict] = {}  # (stage, book, worksheet) -> record, in order of start
+
+    def add(self, name: str, book: str, worksheet: str, wall_time: float, rows: int) -> None:
+        """
+        Adds time and rows to the stage record
+        :param name: Name of the stage, STAGE_... constant
+        :param book: "Kniga_1", "Kniga_2", "Kniga_3" or '' for stages of the whole database
+        :param worksheet: Name of the worksheet or ''
+        :param wall_time: Seconds spent in the stage
+        :param rows: Number of rows processed by the stage
+        :return: None
+        """
+        record = self.stages.setdefault((name, book, worksheet), {"stage": name, "book": book, "worksheet": worksheet,
+                                                                  "wall_time": 0.0, "rows": 0, "calls": 0})
+        record["wall_time"] += wall_time
+        record["rows"] += rows
+        record["calls"] += 1
+        record["peak_rss"] = peak_rss()
+
+    def summary(self) -> dict:
+        """
+        :return: Dictionary with the whole import time, peak RSS, every stage record and totals by stage and by book
+        Every record has wall_time (seconds), rows, rows_per_second, calls and peak_rss (bytes) after the stage
+        """
+        stages: List[dict] = []
+        by_stage: Dict[str, dict] = {}
+        by_book: Dict[str, dict] = {}
+        for record in self.stages.values():
+            stages.append(dict(record, rows_per_second=throughput(record["rows"], record["wall_time"])))
+            for totals, key in ((by_stage, record["stage"]), (by_book, record["book"])):
+                total = totals.setdefault(key, {"wall_time": 0.0, "rows": 0})
+                total["wall_time"] += record["wall_time"]
+                total["rows"] += record["rows"]
+        for totals in (by_stage, by_book):
+            for total in totals.values():
+                total["rows_per_second"] = throughput(total["rows"], total["wall_time"])
+        return {"started": self.started.isoformat(timespec="seconds"),
+                "wall_time": time.perf_counter() - self.started_counter,
+                "peak_rss": peak_rss(),
+                "stages": stages,
+                "by_stage": by_stage,
+                "by_book": by_book}
+
+    def save(self, path: str = REPORT_PATH) -> None:
+        with open(path, "w", encoding="utf-8") as report_file:
+            json.dump(self.summary(), report_file, ensure_ascii=False, indent=2)
+
+
+@contextlib.contextmanager
+def stage(report: Optional[ImportReport], name: str, book: str = '', worksheet: str = '') -> Iterator[dict]:
+    """
+    Measures the stage inside the with block, set "rows" of the yielded dictionary to the number of processed rows
+    Does nothing if report is None
+    :param report: Report to add the stage to or None
+    :param name: Name of the stage, STAGE_... constant
+    :param book: "Kniga_1", "Kniga_2", "Kniga_3" or '' for stages of the whole database
+    :param worksheet: Name of the worksheet or ''
+    :return: Context manager with dictionary {"rows": 0}
+    """
+    record = {"rows": 0}
+    if report is None:
+        yield record
+        return
+    started = time.perf_counter()
+    try:
+        yield record
+    finally:
+        report.add(name, book, worksheet, time.perf_counter() - started, record["rows"])
+
+
+def measured(report: Optional[ImportReport], items: Iterable[Item], name: str, book: str = '',
+             worksheet: str = '') -> Iterator[Item]:
+    """
+    Measures a stage of a generator pipeline: only the time of producing items is added to the stage, the time the
+    consumer spends on them goes to its own stages. If producing an item pulls items of another measured stage,
+    their time is added only to that stage. The stage is reported once when the items end
+    Does nothing if report is None
+    :param report: Report to add the stage to or None
+    :param items: Items produced by the stage, every item is a processed row
+    :param name: Name of the stage, STAGE_... constant
+    :param book: "Kniga_1", "Kniga_2", "Kniga_3" or '' for stages of the whole database
+    :param worksheet: Name of the worksheet or ''
+    :return: Generator of the same items
+    """
+    if report is None:
+        yield from items
+        return
+    iterator = iter(items)
+    wall_time = 0.0
+    rows = 0
+    try:
+        while True:
+            producing.append(0.0)
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                elapsed = time.perf_counter() - started
+                wall_time += elapsed - producing.pop()
+                if len(producing) != 0:  # This stage is nested into another one
+                    producing[-1] += elapsed
+            rows += 1
+            yield item
+    finally:
+        report.add(name, book, worksheet, wall_time, rows)
@@ -0,0 +1,100 @@
+#! -*- encoding: utf-8 -*-
+from datetime import datetime
+import os
+import sqlite3
+from typing import Optional
+
+
+IMPORT_STATE_TABLE = "import_state"
+
+# Import state keeps a checkpoint of every imported worksheet. Data of a worksheet is committed together with its
+# checkpoint, so after a crash (e.g. exit(-1) of a reader) the database has whole worksheets only and a resumed import
+# skips worksheets which have checkpoints. A checkpoint is valid only for the same book file: the file name, size and
+# modification time are saved with it, a changed book is imported again
+IMPORT_STATE_QUERY = f"""
+    CREATE TABLE IF NOT EXISTS [{IMPORT_STATE_TABLE}](  -- Worksheets imported by railroad_parser
+        [book] VARCHAR(10) NOT NULL,
+        [worksheet] VARCHAR(50) NOT NULL,
+        [source] VARCHAR(260) NOT NULL,  -- File name, size and modification time of the book
+        [finished] DATETIME NOT NULL,
+        PRIMARY KEY ([book], [worksheet]));"""
+
+
+def get_source(path_to_book: str) -> str:
+    """
+    :param path_to_book: path to Kniga_...xls
+    :return: String identifying the book file: "Kniga_1_2019-10-09.xls 2365440 1570600000"
+    """
+    file_stat = os.stat(path_to_book)
+    return f"{os.path.basename(path_to_book)} {file_stat.st_size} {int(file_stat.st_mtime)}"
+
+
+class ImportState:
+    """
+    Checkpoints of imported worksheets in the import_state table of the railroads.db
+    """
+    def __init__(self, cursor: sqlite3.Cursor, resume: bool = False):
+        """
+        Creates the import_state table if it doesn't exist
+        :param cursor: cursor to the railroads.db
+        :param resume: Keep checkpoints of the previous import, otherwise they are deleted and all worksheets are
+        imported again
+        """
+        self.cursor = cursor
+        self.cursor.execute(IMPORT_STATE_QUERY)
+        if not resume:
+            self.cursor.execute(f"DELETE FROM {IMPORT_STATE_TABLE}")
+        self.cursor.connection.commit()
+
+    def is_imported(self, book: str, worksheet: str, path_to_book: str) -> bool:
+        """
+        :param book: "Kniga_1", "Kniga_2" or "Kniga_3"
+        :param worksheet: Name of the worksheet
+        :param path_to_book: path to the book file
+        :return: True if the worksheet of the same book file has a checkpoint
+        """
+        select_query = f"SELECT source FROM {IMPORT_STATE_TABLE} WHERE book = (?) AND worksheet = (?)"
+        checkpoint = self.cursor.execute(select_query, (book, worksheet)).fetchone()
+        return checkpoint is not None and checkpoint[0] == get_source(path_to_book)
+
+    def save(self, book: str, worksheet: str, path_to_book: str) -> None:
+        """
+        Saves the checkpoint of the worksheet and commits it with data of the worksheet
+        :param book: "Kniga_1", "Kniga_2" or "Kniga_3"
+        :param worksheet: Name of the worksheet
+        :param path_to_book: path to the book file
+        :return: None
+        """
+        insert_query = f"""INSERT OR REPLACE INTO {IMPORT_STATE_TABLE} (book, worksheet, source, finished)
+                           VALUES (?, ?, ?, ?)"""
+        self.cursor.execute(insert_query, (book, worksheet, get_source(path_to_book),
+                                           datetime.now().isoformat(timespec="seconds")))
+        self.cursor.connection.commit()
+
+
+def is_imported(state: Optional[ImportState], book: str, worksheet: str, path_to_book: str) -> bool:
+    """
+    Checks if the worksheet should be skipped, prints it if so
+    :param state: Import state or None - nothing is skipped
+    :param book: "Kniga_1", "Kniga_2" or "Kniga_3"
+    :param worksheet: Name of the worksheet
+    :param path_to_book: path to the book file
+    :return: True if the worksheet has been imported before
+    """
+    if state is None or not state.is_imported(book, worksheet, path_to_book):
+        return False
+    print(f"{book} {worksheet} has been imported before, skipped")
+    return True
+
+
+def save_checkpoint(state: Optional[ImportState], book: str, worksheet: str, path_to_book: str) -> None:
+    """
+    Saves the checkpoint of the worksheet, does nothing if state is None
+    :param state: Import state or None
+    :param book: "Kniga_1", "Kniga_2" or "Kniga_3"
+    :param worksheet: Name of the worksheet
+    :param path_to_book: path to the book file
+    :return: None
+    """
+    if state is not None:
+        state.save(book, worksheet, path_to_book)
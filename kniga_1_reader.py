@@ -1,22 +1,29 @@
 #! -*- encoding: utf-8 -*-
 from pandas import read_excel
 import sqlite3
-from typing import List, Tuple
-from kniga_2_reader import repair_table
+from typing import Iterable, Iterator, List, Optional, Tuple
+from field_parsers import FieldParseError, parse_distance, parse_station_code
+from import_report import (ImportReport, STAGE_CLEANUP, STAGE_DECODE, STAGE_INSERT, STAGE_POSITIONS,
+                           STAGE_RESOLUTION, measured, stage)
+from import_state import ImportState, is_imported, save_checkpoint
+from kniga_2_reader import clean_rows, get_first_column, iter_sheet_rows, merge_continuation_rows
+from table_generating import PART_POSITIONS_TABLE, update_part_positions
 
+KNIGA: str = "Kniga_1"  # Book name in the import report
 
-def get_parts_table(railroad_worksheet) -> List[List[str]]:
+
+def iter_parts_table(railroad_worksheet) -> Iterator[List[str]]:
     """
-    Takes data from pandas DataFrame and return List[List[str]] with table data
+    Reads table data of pandas DataFrame row by row
     :param railroad_worksheet: pandas DataFrame with railroad parts
-    :return:
+    :return: Generator of clean rows of the table
     """
-    data_list = [[str(cell) for cell in ndarray] for ndarray in railroad_worksheet.values]
+    first_column = get_first_column(railroad_worksheet)  # The table ends are found by the first column
 
     first_row = 6  # Actual data starts from the 7th row of the worksheet
     last_row = - 1  # Default value. If it will be unchanged - end of the table not found
-    for i in range(len(data_list) - 1, -1, -1):
-        if '_' in data_list[i][0]:
+    for i in range(len(first_column) - 1, -1, -1):
+        if '_' in first_column[i]:
             last_row = i
             break
 
@@ -38,24 +45,29 @@ def get_parts_table(railroad_worksheet) -> List[List[str]]:
     [' 7.', '507409 .', 'Ольховая (эксп.)', ' 11 км', 'nan', 'nan']
     """
     for i in range(last_row - 1, -1, -1):
-        if data_list[i][0] == "РАССТОЯНИЯ ДО ГОСУДАРСТВЕННОЙ ГРАНИЦЫ":  # We cant use this information cos there is only
+        if first_column[i] == "РАССТОЯНИЯ ДО ГОСУДАРСТВЕННОЙ ГРАНИЦЫ":  # We cant use this information cos there is only
             last_row = i - 2  # One distance - from border to a station. And no "border" station so this info is useless
             break  # If found - move two rows above and cut there
 
     if last_row == -1:
-        print(f"End of the table {data_list[4][0]} not found!")
+        print(f"End of the table {first_column[4]} not found!")
 
-    return data_list[first_row: last_row]
+    return clean_rows(merge_continuation_rows(iter_sheet_rows(railroad_worksheet, first_row, last_row)))
 
 
-def split_railroad_parts(parts_table: List[List[str]]) -> List[List[List[str]]]:
-    parts = []
-    part_first = 0  # First line of a part
-    for i in range(len(parts_table)):
-        if parts_table[i][0] == "nan":
-            parts.append(parts_table[part_first: i])
-            part_first = i + 1
-    return parts
+def split_railroad_parts(parts_rows: Iterable[List[str]]) -> Iterator[List[List[str]]]:
+    """
+    Parts of the table are separated by empty rows, rows after the last empty row are not a part
+    :param parts_rows: Rows of the table
+    :return: Generator of parts as lists of rows
+    """
+    part = []
+    for row in parts_rows:
+        if row[0] == "nan":
+            yield part
+            part = []
+        else:
+            part.append(row)
 
 
 def get_part_info(part_label: str) -> Tuple[str, str]:
@@ -77,7 +89,8 @@ def get_part_info(part_label: str) -> Tuple[str, str]:
 
 def repair_station_code(station_code_cell: str) -> str:
     """
-    Reads station code cell and returns digits only
+    Reads station code cell and returns digits only. Readers use field_parsers.parse_station_code, benchmark.py
+    compares it with this loop
     :param station_code_cell: Station code cell sometimes contains values like "023202 ."
     :return: code only string
     """
@@ -90,7 +103,8 @@ def repair_station_code(station_code_cell: str) -> str:
 
 def repair_distance(distance_cell: str) -> int:
     """
-    Reads distance cell and returns distance in integer from
+    Reads distance cell and returns distance in integer from. Readers use field_parsers.parse_distance,
+    benchmark.py compares it with this loop
     :param distance_cell: cell with distance value sometimes contains values like "   2  км "
     :return: integer value of distance
     """
@@ -117,8 +131,8 @@ def ger_regular_values(cursor: sqlite3.Cursor, railroad_part: List[List[str]],
         return []  # Because it's just two transit points and this information is in Kniga_3...xls
 
     select_id_query = "SELECT * FROM r_transportation_railroad_stations WHERE code = (?)"
-    first_tp_code: str = repair_station_code(railroad_part[0][1])
-    last_tp_code: str = repair_station_code(railroad_part[-1][1])
+    first_tp_code: str = parse_station_code(railroad_part[0][1])
+    last_tp_code: str = parse_station_code(railroad_part[-1][1])
 
     first_tp_select = cursor.execute(select_id_query, (first_tp_code, )).fetchall()
     if len(first_tp_select) == 0:  # If SELECT returned (): tp with such code wasn't found - use second row as first row
@@ -136,13 +150,17 @@ def ger_regular_values(cursor: sqlite3.Cursor, railroad_part: List[List[str]],
     r_transportation_transit_distances. So add only stations between transit points: 1, len(railroad_part) - 1
     """
     for i in range(1, len(railroad_part) - 1):
-        station_code = repair_station_code(railroad_part[i][1])
+        station_code = parse_station_code(railroad_part[i][1])
         station_select = cursor.execute(select_id_query, (station_code, )).fetchall()
         if len(station_select) == 0:  # If SELECT returned (): station with such code wasn't found - pass it
             print(f"Station with code {station_code} has not been found! It will not be added to part distances.")
             continue
-        tp1_distance = repair_distance(railroad_part[i][3])  # Distance to the first tp is in the 4th column
-        tp2_distance = repair_distance(railroad_part[i][4])  # Distance to the second tp is in the 5th column
+        try:
+            tp1_distance = parse_distance(railroad_part[i][3])  # Distance to the first tp is in the 4th column
+            tp2_distance = parse_distance(railroad_part[i][4])  # Distance to the second tp is in the 5th column
+        except FieldParseError as error:
+            print(f"{error}! Station with code {station_code} will not be added to part distances.")
+            continue
         values.append((part_code, station_code, first_tp_code, tp1_distance))
         values.append((part_code, station_code, last_tp_code, tp2_distance))
     return values
@@ -164,7 +182,7 @@ def get_irregular_values(cursor: sqlite3.Cursor, railroad_part: List[List[str]],
     """
     select_id_query = "SELECT * FROM r_transportation_railroad_stations WHERE code = (?)"
     
-    main_station_code = repair_station_code(railroad_part[0][1])  # Main station - the start of the branch
+    main_station_code = parse_station_code(railroad_part[0][1])  # Main station - the start of the branch
     main_station_select = cursor.execute(select_id_query, (main_station_code, )).fetchall()
     if len(main_station_select) == 0:  # If SELECT returned (): station with such code wasn't found - pass it
         print(f"""\n! Station with code {main_station_code} has not been found! 
@@ -173,12 +191,16 @@ def get_irregular_values(cursor: sqlite3.Cursor, railroad_part: List[List[str]],
 
     values = []
     for i in range(1, len(railroad_part)):  # First row is trivial - distance from main_station to main_station is 0
-        station_code = repair_station_code(railroad_part[i][1])
+        station_code = parse_station_code(railroad_part[i][1])
         station_select = cursor.execute(select_id_query, (station_code,)).fetchall()
         if len(station_select) == 0:  # If SELECT returned (): station with such code wasn't found - pass it
             print(f"\n! Station with code {station_code} has not been found! It will not be added to part distances.\n")
             continue
-        main_station_distance = repair_distance(railroad_part[i][3])  # Distance to the ms is in the 4th column
+        try:
+            main_station_distance = parse_distance(railroad_part[i][3])  # Distance to the ms is in the 4th column
+        except FieldParseError as error:
+            print(f"\n! {error}! Station with code {station_code} will not be added to part distances.\n")
+            continue
         values.append((part_code, station_code, main_station_code, main_station_distance))  # From A to B
         values.append((part_code, main_station_code, station_code, main_station_distance))  # From B to A
     return values
@@ -206,65 +228,83 @@ def get_query_values(cursor: sqlite3.Cursor, railroad_part: List[List[str]],
         return get_irregular_values(cursor, railroad_part[2:], part_code)
 
 
-def insert_part(cursor: sqlite3.Cursor, railroad_part: List[List[str]]) -> None:
+def insert_part(cursor: sqlite3.Cursor, railroad_part: List[List[str]],
+                report: Optional[ImportReport] = None, worksheet: str = '') -> None:
     """
     Insert all data about the given railroad part to the cursor's database
     :param cursor: Cursor to the railroads.db
     :param railroad_part: List of Lists of strings with first element as label something like:
     ["2) участок 55-002 "БАЛАДЖАРЫ - АЛЯТ" (Основной тарифный участок)", "nan", "nan", "nan", "nan"]
+    :param report: Import report to add stages to, None - not measured
+    :param worksheet: Name of the worksheet with the part for the report
     :return:
     """
     part_code, part_name = get_part_info(railroad_part[0][0])
     railroad_code = part_code[:2]
 
-    part_exists_query = "SELECT * FROM r_transportation_railroad_parts WHERE code = (?)"
-    part_exists_select = cursor.execute(part_exists_query, (part_code,)).fetchall()
-    if len(part_exists_select) == 0:  # If part such code not exists in the railroads.db
-        insert_part_query = """INSERT INTO r_transportation_railroad_parts (code, name, railroad_code) 
-                               VALUES (?, ?, ?)"""
-        cursor.execute(insert_part_query, (part_code, part_name, railroad_code))
-    else:  # If part exists - the only field that should be updated - name (code, id and railroad should not change)
-        update_part_query = "UPDATE r_transportation_railroad_parts SET name = (?) WHERE code = (?)"
-        cursor.execute(update_part_query, (part_name, part_code))
-
-    insert_distance_query = """INSERT OR REPLACE INTO r_transportation_railroad_part_distances 
-    (part_code, code_from, code_to, distance_between_stations) VALUES (?, ?, ?, ?)"""
-    values = get_query_values(cursor, railroad_part, part_code)
-    for value in values:
-        cursor.execute(insert_distance_query, value)
-
-
-def insert_railroad_parts(cursor: sqlite3.Cursor, railroad_worksheet) -> None:
+    with stage(report, STAGE_RESOLUTION, KNIGA, worksheet) as resolution:
+        values = get_query_values(cursor, railroad_part, part_code)
+        resolution["rows"] = len(values)
+
+    with stage(report, STAGE_INSERT, KNIGA, worksheet) as insert:
+        part_exists_query = "SELECT * FROM r_transportation_railroad_parts WHERE code = (?)"
+        part_exists_select = cursor.execute(part_exists_query, (part_code,)).fetchall()
+        if len(part_exists_select) == 0:  # If part such code not exists in the railroads.db
+            insert_part_query = """INSERT INTO r_transportation_railroad_parts (code, name, railroad_code) 
+                                   VALUES (?, ?, ?)"""
+            cursor.execute(insert_part_query, (part_code, part_name, railroad_code))
+        else:  # If part exists - the only field that should be updated - name (code, id, railroad should not change)
+            update_part_query = "UPDATE r_transportation_railroad_parts SET name = (?) WHERE code = (?)"
+            cursor.execute(update_part_query, (part_name, part_code))
+
+        insert_distance_query = """INSERT OR REPLACE INTO r_transportation_railroad_part_distances 
+        (part_code, code_from, code_to, distance_between_stations) VALUES (?, ?, ?, ?)"""
+        cursor.executemany(insert_distance_query, values)
+        insert["rows"] = len(values) + 1
+
+
+def insert_railroad_parts(cursor: sqlite3.Cursor, railroad_worksheet,
+                          report: Optional[ImportReport] = None, worksheet: str = '') -> None:
     """
     Inserts all railroad parts from Kniga_1...xls to the railroads.db
     :param cursor: Cursor to the railroads.db
     :param railroad_worksheet: Worksheet with railroad parts: 'Азерб', 'Бел', 'В-Сиб (Р)'...
+    :param report: Import report to add stages to, None - not measured
+    :param worksheet: Name of the worksheet for the report
     :return:
     """
-    parts_table: List[List[str]] = repair_table(get_parts_table(railroad_worksheet))
-
-    railroad_parts: List[List[List[str]]] = split_railroad_parts(parts_table)
-
-    for part in railroad_parts:
-        insert_part(cursor, part)
+    parts_rows = measured(report, iter_parts_table(railroad_worksheet), STAGE_CLEANUP, KNIGA, worksheet)
+    for part in split_railroad_parts(parts_rows):  # Only one part is kept in memory
+        insert_part(cursor, part, report, worksheet)
     return
 
 
 def add_kniga1(cursor: sqlite3.Cursor, path_to_kniga1: str,
-               unused_worksheets: Tuple[str, str] = ("Общие положения", "Вводные положения")):
+               unused_worksheets: Tuple[str, str] = ("Общие положения", "Вводные положения"),
+               report: Optional[ImportReport] = None, state: Optional[ImportState] = None):
     """
     Reads Kniga_1_...xls from РЖД and insert or update all data in railroads.db
     :param cursor: cursor to the railroads.db
     :param path_to_kniga1:
     :param unused_worksheets: path to Kniga_1_...xls
+    :param report: Import report to add stages to, None - not measured
+    :param state: Import state, every worksheet is committed with its checkpoint and imported worksheets are skipped.
+    None - the caller commits
     :return: None
     """
-    worksheets = list(read_excel(path_to_kniga1, sheet_name=None).keys())
+    with stage(report, STAGE_DECODE, KNIGA):  # Names of worksheets
+        worksheets = list(read_excel(path_to_kniga1, sheet_name=None).keys())
     for worksheet in worksheets:
-        if worksheet not in unused_worksheets:
-            railroad_worksheet = read_excel(path_to_kniga1, sheet_name=worksheet, header=None, index_col=False)
-            insert_railroad_parts(cursor, railroad_worksheet)
+        if worksheet not in unused_worksheets and not is_imported(state, KNIGA, worksheet, path_to_kniga1):
+            with stage(report, STAGE_DECODE, KNIGA, worksheet) as decode:
+                railroad_worksheet = read_excel(path_to_kniga1, sheet_name=worksheet, header=None, index_col=False)
+                decode["rows"] = len(railroad_worksheet)
+            insert_railroad_parts(cursor, railroad_worksheet, report, worksheet)
+            save_checkpoint(state, KNIGA, worksheet, path_to_kniga1)
             print(f"Kniga_1 {worksheet} complete")
+    with stage(report, STAGE_POSITIONS, KNIGA) as positions:
+        update_part_positions(cursor)
+        positions["rows"] = cursor.execute(f"SELECT COUNT(*) FROM {PART_POSITIONS_TABLE}").fetchone()[0]
 
 
 if __name__ == "__main__":
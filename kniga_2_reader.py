@@ -1,17 +1,26 @@
 #! -*- encoding: utf-8 -*-
+from itertools import groupby, islice
+from multiprocessing import freeze_support
 import pandas as pd
-from typing import List, Dict
+from typing import List, Dict, Iterable, Iterator, Optional, Tuple
 import sqlite3
+from field_parsers import (FieldParseError, parse_operation_codes_column, parse_railroad_code_column,
+                           parse_transit_distances)
+from import_report import ImportReport, STAGE_CLEANUP, STAGE_DECODE, STAGE_INSERT, measured, stage
+from import_state import ImportState, is_imported, save_checkpoint
 from references import update_references
-from table_generating import create_tables
+from table_generating import create_tables, is_symmetric_layout
 
 BIG_TYPE_CODE: str = "РП"  # Big stations - Kniga_2 РП
 SMALL_TYPE_CODE: str = "ОП"  # Small stations - Kniga_2 ОП
+KNIGA: str = "Kniga_2"  # Book name in the import report
+BATCH_SIZE: int = 1000  # Rows of a worksheet written by one executemany
 
 
 def get_railroad_code(railroad_cell: str) -> str:
     """
     Reads an excel railroad cell and return railroad id from r_transportation_railroads if found else -1
+    Readers use field_parsers.parse_railroad_code, benchmark.py compares it with this loop
     :param railroad_cell: Railroad cell from excel worksheet ("76 Сверд (Р)")
     :return: railroad code
     """
@@ -30,6 +39,7 @@ def get_railroad_code(railroad_cell: str) -> str:
 def get_operation_codes(operations_cell: str) -> List[str]:
     """
     Reads an excel operations cell and return list of operations codes from the r_transportation_operations table
+    Readers use field_parsers.parse_operation_codes, benchmark.py compares it with this loop
     :param operations_cell: Operations cell from excel worksheet ("О 1,3,4,6,8,8н, 9,10,10н")
     :return: List of operations
     """
@@ -93,38 +103,120 @@ def is_row_empty(row: List[str]) -> bool:
     return True
 
 
+def iter_sheet_rows(worksheet: pd.DataFrame, first_row: int = 0, last_row: Optional[int] = None) -> Iterator[List[str]]:
+    """
+    Converts rows of pandas DataFrame to lists of str one by one, so str cells of the whole worksheet are never kept
+    :param worksheet: pandas DataFrame of a worksheet
+    :param first_row: Index of the first row
+    :param last_row: Index of the row after the last one (negative counts from the end), None - till the end
+    :return: Generator of rows as lists of str
+    """
+    for ndarray in worksheet.values[first_row: last_row]:
+        yield [str(cell) for cell in ndarray]  # Because I can't change np._str -_-
+
+
+def get_first_column(worksheet: pd.DataFrame) -> List[str]:
+    """
+    :param worksheet: pandas DataFrame of a worksheet
+    :return: Cells of the first column as str, they are enough to find where tables start and end
+    """
+    return [str(cell) for cell in worksheet.iloc[:, 0]]
+
+
+def merge_continuation_rows(rows: Iterable[List[str]]) -> Iterator[List[str]]:
+    """
+    Railroad's excel sometimes store information about one element in several rows: the first cell of continuation
+    rows is "nan". Collects such rows to the row above them exactly like repair_table does it from the bottom row up
+    to the top, but keeps only one row with its continuation rows in memory:
+    - a cell is added to the cell above it without a space after '-' ("Москва-Пассажирская-Киевская") and with a space
+    after anything else ("Дупленская (обп)"), "nan" cells between the row and a later cell of the column are added too
+    - empty rows (only "nan") are kept if no continuation row with data follows them
+    Continuation rows at the very start have no row above them: their data is dropped, repair_table adds it to the
+    last row of the table
+    :param rows: Rows of excel cells - lists of str
+    :return: Generator of merged rows (not cleaned, see clean_rows)
+    """
+    row: Optional[List[str]] = None  # The row collecting continuation rows
+    previous: List[str] = []  # The last cell added to every column, decides on the space
+    waiting: List[int] = []  # Number of "nan" cells of every column which are added only if a later cell has data
+    empty_rows: List[List[str]] = []  # Empty rows after the last continuation row with data
+    for next_row in rows:
+        if next_row[0] != "nan":
+            if row is not None:
+                yield row
+            yield from empty_rows
+            row, previous, waiting, empty_rows = next_row, list(next_row), [0] * len(next_row), []
+            continue
+
+        if is_row_empty(next_row):
+            empty_rows.append(next_row)
+        else:
+            empty_rows = []  # Empty rows above become a part of the row
+        if row is None:
+            continue
+        for k in range(len(next_row)):
+            if next_row[k] == "nan":
+                waiting[k] += 1
+                continue
+            for cell in ["nan"] * waiting[k] + [next_row[k]]:
+                if previous[k][-1:] == '-':  # "Москва-Пассажирская-Киевская" should be write without spaces
+                    row[k] = "%s%s" % (row[k], cell)
+                else:  # All other rows should contain a space between parts "Дупленская (обп)"
+                    row[k] = "%s %s" % (row[k], cell)
+                previous[k] = cell
+            waiting[k] = 0
+    if row is not None:
+        yield row
+    yield from empty_rows
+
+
+def clean_rows(rows: Iterable[List[str]]) -> Iterator[List[str]]:
+    """
+    Removes extra symbols from every cell of rows (see repair_row)
+    :param rows: Rows of excel cells - lists of str
+    :return: Generator of clean rows
+    """
+    for number, row in enumerate(rows):
+        if number == 0:  # repair_table has always cleaned the first row twice, it adds one more space after commas
+            row = repair_row(row)
+        yield repair_row(row)
+
+
 def repair_table(table_list: List[List[str]]) -> List[List[str]]:
     """
     Railroad's excel sometimes store information about one element if several rows, so the first step is collecting
     such data to one row and the second step is removing extra symbols (without extra spaces, \t and \n)
+    Readers pass rows through merge_continuation_rows and clean_rows one by one instead of the whole table
     :param table_list: A table of excel cells - list of list of str
     :return: Clean table
     """
-    for i in range(len(table_list) - 1, -1, -1):  # From the bottom row up to top
-        if table_list[i][0] == "nan":  # If the first column of the row is "nan" - this row is a part of previous one
-            for k in range(len(table_list[i])):
-                if table_list[i][k] != "nan":  # If cell contain any data - add row data to previous row
-                    if table_list[i - 1][k][-1] == '-':  # "Москва-Пассажирская-Киевская" should be write without spaces
-                        table_list[i - 1][k] = "%s%s" % (table_list[i - 1][k], table_list[i][k])
-                    else:  # All other rows should contain a space between parts "Дупленская (обп)"
-                        table_list[i - 1][k] = "%s %s" % (table_list[i - 1][k], table_list[i][k])
-            continue
-        table_list[i] = repair_row(table_list[i])
-    table_list[0] = repair_row(table_list[0])
-    return [row for row in table_list if row[0] != "nan" or is_row_empty(row)]
+    return list(clean_rows(merge_continuation_rows(table_list)))
 
 
-def get_station_data(worksheet: pd.DataFrame) -> List[List[str]]:
+def batches(items: Iterable, batch_size: int = BATCH_SIZE) -> Iterator[list]:
+    """
+    :param items: Rows or query values
+    :param batch_size: The largest number of items in a batch
+    :return: Generator of lists with batch_size items (the last one may be shorter)
     """
-    Converts pandas DataFrame to List[List[str]] with stations data
+    iterator = iter(items)
+    batch = list(islice(iterator, batch_size))
+    while len(batch) != 0:
+        yield batch
+        batch = list(islice(iterator, batch_size))
+
+
+def iter_station_data(worksheet: pd.DataFrame) -> Iterator[List[str]]:
+    """
+    Reads stations data of pandas DataFrame row by row
     :param worksheet: pandas DataFrame of stations data
-    :return: List[List[str]] with stations data
+    :return: Generator of clean rows with stations data
     """
-    data_list = [[str(cell) for cell in ndarray] for ndarray in worksheet.values]  # Because I can't change np._str -_-
+    first_column = get_first_column(worksheet)
 
     data_first_row: int = -1
-    for i in range(len(data_list)):
-        if '№' in data_list[i][0]:
+    for i in range(len(first_column)):
+        if '№' in first_column[i]:
             data_first_row = i + 1
             break
     if data_first_row == -1:
@@ -132,8 +224,8 @@ def get_station_data(worksheet: pd.DataFrame) -> List[List[str]]:
         exit(-1)
 
     data_last_row: int = -1
-    for i in range(len(data_list) - 1, -1, -1):
-        if '_' in data_list[i][0]:
+    for i in range(len(first_column) - 1, -1, -1):
+        if '_' in first_column[i]:
             data_last_row = i
             break
 
@@ -141,7 +233,7 @@ def get_station_data(worksheet: pd.DataFrame) -> List[List[str]]:
         print("End of the small stations table not found")
         exit(-1)
 
-    return repair_table(data_list[data_first_row: data_last_row])
+    return clean_rows(merge_continuation_rows(iter_sheet_rows(worksheet, data_first_row, data_last_row)))
 
 
 def station_exists(cursor: sqlite3.Cursor, station_code: str) -> bool:
@@ -178,25 +270,27 @@ def get_table_date(station_worksheet: pd.DataFrame) -> str:
     return ''
 
 
-def get_actuality_column(station_table: List[List[str]]) -> List[bool]:
+def iter_actuality(station_rows: Iterable[List[str]]) -> Iterator[Tuple[List[str], bool]]:
     """
-    Generates column of station actuality. The station is actual if it's the only station with such name OR
+    Adds station actuality to rows. The station is actual if it's the only station with such name OR
     It's a station on a Russian railroad (contains "(Р)" in the railroad column)
-    :param station_table:
-    :return:
-    """
-    actuality = [True] * len(station_table)
-    i = 1
-    while i < len(station_table):
-        if station_table[i][1] == station_table[i - 1][1]:  # If the same name for different stations
-            k = i - 1
-            while station_table[k][1] == station_table[i][1]:
-                if "(Р)" not in station_table[k][3]:  # [3] is the railroad column of the worksheet
-                    actuality[k] = False  # So if it is not a Russian railroad - set it's actuality to False
-                k += 1
-            i = k - 1  # When we found a different named station we should jump back for a step to continue the loop
-        i += 1
-    return actuality
+    Stations with the same name follow each other, so only stations of one name are kept in memory
+    :param station_rows: Rows of stations data
+    :return: Generator of tuples with row and actuality
+    """
+    for _, same_name_rows in groupby(station_rows, key=lambda row: row[1]):
+        same_name_rows = list(same_name_rows)
+        for row in same_name_rows:  # [3] is the railroad column of the worksheet
+            yield row, len(same_name_rows) == 1 or "(Р)" in row[3]
+
+
+def get_actuality_column(station_table: List[List[str]]) -> List[bool]:
+    """
+    Generates column of station actuality, see iter_actuality
+    :param station_table: Table of stations data
+    :return: List with values True of False for each station
+    """
+    return [actuality for _, actuality in iter_actuality(station_table)]
 
 
 def insert_stations(cursor: sqlite3.Cursor, station_table: List[List[str]], 
@@ -209,13 +303,12 @@ def insert_stations(cursor: sqlite3.Cursor, station_table: List[List[str]],
     :param station_type: "ОП" or "РП"
     :return: None
     """
-    insert_station_query = """
+    upsert_station_query = """
     INSERT INTO r_transportation_railroad_stations (actuality, name, code, railroad_code, type)
-    VALUES (?, ?, ?, ?, ?)"""
-    update_station_query = """
-    UPDATE r_transportation_railroad_stations 
-    SET actuality = (?), name = (?), railroad_code = (?), type = (?)
-    WHERE code = (?)"""
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (code) DO UPDATE 
+    SET actuality = excluded.actuality, name = excluded.name, railroad_code = excluded.railroad_code, 
+        type = excluded.type"""  # An existing station is updated
 
     code_column = -1
     if station_type == SMALL_TYPE_CODE:
@@ -223,16 +316,9 @@ def insert_stations(cursor: sqlite3.Cursor, station_table: List[List[str]],
     elif station_type == BIG_TYPE_CODE:
         code_column = 5
 
-    for i in range(len(station_table)):
-        station_name = station_table[i][1]
-        station_code = station_table[i][code_column]
-        actuality = actuality_column[i]
-        railroad_code = get_railroad_code(station_table[i][3])
-
-        if station_exists(cursor, station_code):
-            cursor.execute(update_station_query, (actuality, station_name, railroad_code, station_type, station_code))
-        else:
-            cursor.execute(insert_station_query, (actuality, station_name, station_code, railroad_code, station_type))
+    railroad_codes = parse_railroad_code_column([row[3] for row in station_table])
+    cursor.executemany(upsert_station_query, [(actuality_column[i], station_table[i][1], station_table[i][code_column],
+                                               railroad_codes[i], station_type) for i in range(len(station_table))])
 
 
 def insert_operations(cursor: sqlite3.Cursor, station_table: List[List[str]], code_column: int = 4) -> None:
@@ -247,24 +333,23 @@ def insert_operations(cursor: sqlite3.Cursor, station_table: List[List[str]], co
     INSERT OR REPLACE INTO r_transportation_station_operations (station_code, operation_code)
     VALUES (?, ?)"""
 
-    for i in range(len(station_table)):
-        station_code = station_table[i][code_column]
-        station_operations = get_operation_codes(station_table[i][2])
-        for operation in station_operations:
-            cursor.execute(insert_operations_query, (station_code, operation))
+    operations_column = parse_operation_codes_column([row[2] for row in station_table])
+    cursor.executemany(insert_operations_query, [(station_table[i][code_column], operation)
+                                                 for i in range(len(station_table))
+                                                 for operation in operations_column[i]])
 
 
-def insert_stations_info(cursor: sqlite3.Cursor, station_worksheet: pd.DataFrame, station_type: str) -> None:
+def insert_stations_info(cursor: sqlite3.Cursor, station_worksheet: pd.DataFrame, station_type: str,
+                         report: Optional[ImportReport] = None) -> None:
     """
-    Insert data from a station table to the corresponding tables
+    Insert data from a station table to the corresponding tables. Rows of the worksheet go through the pipeline
+    cleanup -> actuality -> batches of BATCH_SIZE rows written to every table, so only a batch is kept in memory
     :param cursor: Cursor to the railroads.db
     :param station_worksheet: pandas DataFrame object with stations table
     :param station_type: "ОП" or "РП"
+    :param report: Import report to add stages to, None - not measured
     :return: None
     """
-    station_table = get_station_data(station_worksheet)
-    actuality_column = get_actuality_column(station_table)
-
     code_column: int
     if station_type == SMALL_TYPE_CODE:
         code_column = 4
@@ -274,10 +359,15 @@ def insert_stations_info(cursor: sqlite3.Cursor, station_worksheet: pd.DataFrame
         print(f"Unknown station type: {station_type}")
         return
 
-    insert_stations(cursor, station_table, actuality_column, station_type)
-    insert_operations(cursor, station_table, code_column)
-    if code_column == 5:  # If code column is 5 - this is the worksheet with transit column
-        insert_transit_distances(cursor, station_table)
+    station_rows = measured(report, iter_station_data(station_worksheet), STAGE_CLEANUP, KNIGA, station_type)
+    for batch in batches(iter_actuality(station_rows)):
+        station_table = [row for row, _ in batch]
+        with stage(report, STAGE_INSERT, KNIGA, station_type) as insert:
+            insert_stations(cursor, station_table, [actuality for _, actuality in batch], station_type)
+            insert_operations(cursor, station_table, code_column)
+            if code_column == 5:  # If code column is 5 - this is the worksheet with transit column
+                insert_transit_distances(cursor, station_table)
+            insert["rows"] = len(station_table)
 
 
 def get_transit_dict(transit_distances_cell: str, code_from: str) -> Dict[str, int]:
@@ -285,6 +375,7 @@ def get_transit_dict(transit_distances_cell: str, code_from: str) -> Dict[str, i
     Parses transit distances and return dict with station codes as keys and distances to them as values.
     In case station is a transit point - return dictionary with it's code and distance 0.
     If cell is empty ("nan") returns empty dict
+    Readers use field_parsers.parse_transit_distances, benchmark.py compares it with this function
     :param transit_distances_cell: transit distances cell of the "РП" worksheet
     :param code_from: code of the current station, required for the transit point cases
     :return: Dictionary with distances to transit points
@@ -314,32 +405,48 @@ def insert_transit_distances(cursor: sqlite3.Cursor, station_table: List[List[st
     insert_transit_query = """
     INSERT OR REPLACE INTO r_transportation_transit_distances (code_from, code_to, transit_distance) 
     VALUES (?, ?, ?)"""
+    symmetric = is_symmetric_layout(cursor)  # Symmetric layout stores a pair once for both directions
 
+    values = []
     for i in range(len(station_table)):
         code_from = station_table[i][5]
 
-        transit_dict = get_transit_dict(station_table[i][4], code_from)
+        try:
+            transit_dict = parse_transit_distances(station_table[i][4], code_from)
+        except FieldParseError as error:
+            print(f"{error}! Transit distances of the station with code {code_from} will not be added")
+            continue
         for code_to in transit_dict:
-            cursor.execute(insert_transit_query, (code_from, code_to, transit_dict[code_to]))  # Station A conn to B
-            cursor.execute(insert_transit_query, (code_to, code_from, transit_dict[code_to]))  # And B also conn to A
-    return
+            values.append((code_from, code_to, transit_dict[code_to]))  # Station A conn to B
+            if not symmetric:
+                values.append((code_to, code_from, transit_dict[code_to]))  # And B to A
+    cursor.executemany(insert_transit_query, values)
 
 
-def add_kniga2(cursor: sqlite3.Cursor, path_to_book2: str):
+def add_kniga2(cursor: sqlite3.Cursor, path_to_book2: str, report: Optional[ImportReport] = None,
+               state: Optional[ImportState] = None):
     """
     Insert or ipdate all data from Kniga_2...xls to railroads.db to tables r_transportation_railroad_stations,
     r_transportation_station_operations and r_transportation_transit_distances
     :param cursor: Cursor to the railroads.db
     :param path_to_book2: path to Kniga_2...xls
+    :param report: Import report to add stages to, None - not measured
+    :param state: Import state, every worksheet is committed with its checkpoint and imported worksheets are skipped.
+    None - the caller commits
     :return: None
     """
-    small_station_worksheet = pd.read_excel(path_to_book2, sheet_name="ОП", header=None, index_col=False)
-    insert_stations_info(cursor, small_station_worksheet, station_type=SMALL_TYPE_CODE)
-    big_station_worksheet = pd.read_excel(path_to_book2, sheet_name="РП", header=None, index_col=False)
-    insert_stations_info(cursor, big_station_worksheet, station_type=BIG_TYPE_CODE)
+    for station_type in (SMALL_TYPE_CODE, BIG_TYPE_CODE):
+        if is_imported(state, KNIGA, station_type, path_to_book2):
+            continue
+        with stage(report, STAGE_DECODE, KNIGA, station_type) as decode:
+            station_worksheet = pd.read_excel(path_to_book2, sheet_name=station_type, header=None, index_col=False)
+            decode["rows"] = len(station_worksheet)
+        insert_stations_info(cursor, station_worksheet, station_type, report)
+        save_checkpoint(state, KNIGA, station_type, path_to_book2)
 
 
 if __name__ == "__main__":
+    freeze_support()
     path_to_database = "railroads.db"
     path_to_book2 = "C:/Users/User/Desktop/ЖД/Kniga_2_2019-10-09.xls"
     connection = sqlite3.connect(path_to_database)
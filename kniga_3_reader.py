@@ -1,22 +1,30 @@
 #! -*- encoding: utf-8 -*-
 from pandas import read_excel
 import sqlite3
-from typing import List, Tuple, Dict
-from kniga_2_reader import repair_table
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from field_parsers import parse_optional_distance_column
+from import_report import ImportReport, STAGE_CLEANUP, STAGE_DECODE, STAGE_INSERT, STAGE_RESOLUTION, measured, stage
+from import_state import ImportState, is_imported, save_checkpoint
+from kniga_2_reader import batches, clean_rows, get_first_column, iter_sheet_rows, merge_continuation_rows
+from station_index import StationIndex
+from table_generating import is_symmetric_layout
 
+KNIGA: str = "Kniga_3"  # Book name in the import report
 
-def get_transit_table(worksheet) -> List[List[str]]:
+
+def get_transit_table(worksheet) -> Tuple[List[str], Iterator[List[str]]]:
     """
     Takes only transit distances and station names from the given worksheet
     :param worksheet: pandas DataFrame of worksheet of Kniga_3...xls
-    :return: List of lists of strings with station names at first row and distances between stations
+    :return: Tuple with the row of station names (not cleaned) and generator of clean rows with distances between
+    stations
     """
-    data_list = [[str(cell) for cell in ndarray] for ndarray in worksheet.values]
+    first_column = get_first_column(worksheet)
 
     first_row = -1
 
-    for i in range(len(data_list)):
-        if data_list[i][0] == "№ п/п":
+    for i in range(len(first_column)):
+        if first_column[i] == "№ п/п":
             first_row = i + 1
             break
 
@@ -24,19 +32,26 @@ def get_transit_table(worksheet) -> List[List[str]]:
         print("Start of the table not found!")
         exit(-1)
 
-    return [data_list[first_row - 2]] + data_list[first_row:]  # Column names + data rows
+    column_names = [str(cell) for cell in worksheet.iloc[first_row - 2]]
+    return column_names, clean_rows(merge_continuation_rows(iter_sheet_rows(worksheet, first_row)))
 
 
-def insert_transit_distances(cursor: sqlite3.Cursor, worksheet, ws_name: str):
+def insert_transit_distances(cursor: sqlite3.Cursor, worksheet, ws_name: str,
+                             report: Optional[ImportReport] = None, report_name: str = '',
+                             index: Optional[StationIndex] = None):
     """
     Inserts all transit distances from the given worksheet of Kniga_3...xls
     :param cursor: cursor to the railroads.db
     :param worksheet: pandas DataFrame of worksheet of Kniga_3...xls
+    :param ws_name: Name of the worksheet's railroad in r_transportation_railroads
+    :param report: Import report to add stages to, None - not measured
+    :param report_name: Name of the worksheet in Kniga_3...xls for the report
+    :param index: Index of station names, None - built from the database for this worksheet
     :return: None
     """
-    transit_table = get_transit_table(worksheet)
-    transit_table = [transit_table[0]] + repair_table(transit_table[1:])  # Repair all rows except column names
-    transit_table = [transit_table[0][1:]] + [transit_table[i][1:] for i in range(1, len(transit_table))]  # Remove №
+    column_names, transit_rows = get_transit_table(worksheet)  # Column names are not repaired
+    column_names = column_names[1:]  # No №
+    transit_rows = (row[1:] for row in measured(report, transit_rows, STAGE_CLEANUP, KNIGA, report_name))
     """
     Now the table contains stations and distances like this:
     ['nan', 'Батуми', 'Гантиади (эксп.)', 'Гардабани (эксп.)', ...]
@@ -45,54 +60,72 @@ def insert_transit_distances(cursor: sqlite3.Cursor, worksheet, ws_name: str):
     ['Гардабани (эксп.)', '396', '556', '0', ...]
     ...  
     """
-    code_distances_table = get_code_distances_table(cursor, transit_table, ws_name)
-    insert_values = get_insert_values(code_distances_table)
-
-    insert_query = """INSERT OR REPLACE INTO r_transportation_transit_distances (code_from, code_to, transit_distance) 
-                      VALUES (?, ?, ?)"""
-
-    for value in insert_values:
-        cursor.execute(insert_query, value)
-
-
-def get_insert_values(code_distances_table: List[List[str]]) -> List[Tuple[str, str, str]]:
+    with stage(report, STAGE_RESOLUTION, KNIGA, report_name) as resolution:
+        if index is None:
+            index = StationIndex(cursor)
+        station_codes = get_station_codes(cursor, column_names, ws_name, index)
+        resolution["rows"] = len(column_names) - 1  # Names of columns
+    code_rows = measured(report, iter_code_distances(cursor, transit_rows, ws_name, index), STAGE_RESOLUTION, KNIGA,
+                         report_name)  # Names of rows
+
+    insert_query = """INSERT OR REPLACE INTO r_transportation_transit_distances 
+                      (code_from, code_to, transit_distance) VALUES (?, ?, ?)"""
+    for batch in batches(iter_insert_values(station_codes, code_rows, is_symmetric_layout(cursor), ws_name)):
+        with stage(report, STAGE_INSERT, KNIGA, report_name) as insert:
+            cursor.executemany(insert_query, batch)
+            insert["rows"] = len(batch)
+
+
+def iter_insert_values(station_codes: List[str], code_rows: Iterable[List], symmetric: bool = False,
+                       ws_name: str = '') -> Iterator[Tuple[str, str, int]]:
     """
-    Takes table with station codes as first row and first column and return a list of tuples to insert into db
-    :param code_distances_table: table with station codes as first row and first column and distances in other cells
-    :return: list of tuples with (station from code, station to code, distance)
+    Takes rows of a table with station codes as first column and yields tuples to insert into db
+    :param station_codes: Station codes of columns, the first element is always ''
+    :param code_rows: Rows with station code as first element and distances in other cells
+    :param symmetric: Yield one tuple for each pair of stations (for the symmetric layout of transit distances).
+    Both directions of a pair are compared over the whole table: a pair is yielded when its opposite direction is read,
+    if the distances are different the smaller one is yielded and the pair is printed, pairs without the opposite
+    direction are yielded at the end
+    :param ws_name: Name of the worksheet's railroad for the printed pairs with different distances
+    :return: Generator of tuples with (station from code, station to code, distance)
     """
     """
     Function expects something like:
     
-    ['', '571509', '574704', '563606', '572107', '564204', '570008', '571903', '560101', '577204', ...]
-    ['571509', 0, 368, 396, 174, 423, 104, 132, 354, 228, ...]
+    ['', '571509', '574704', '563606', '572107', '564204', '570008', '571903', '560101', '577204', ...]  - station_codes
+    ['571509', 0, 368, 396, 174, 423, 104, 132, 354, 228, ...]  - code_rows
     ['574704', 368, 0, 556, 278, 583, 264, 236, 514, 388, ...]
     ['563606', 396, 556, 0, 362, 111, 292, 320, 42, 168, ...]
     ['572107', 174, 278, 362, 0, 389, 70, 42, 320, 194, ...]
-    ['564204', 423, 583, 111, 389, 0, 319, 347, 69, 195, ...]
-    ['570008', 104, 264, 292, 70, 319, 0, 28, 250, 124, ...]
-    ['571903', 132, 236, 320, 42, 347, 28, 0, 278, 152, ...]
-    ['560101', 354, 514, 42, 320, 69, 250, 278, 0, 126, ...]
-    ['577204', 228, 388, 168, 194, 195, 124, 152, 126, 0, ...]
     ...
     """
-
-    values = []
-    for i in range(1, len(code_distances_table)):  # The first element is row of station codes
-        code_from = code_distances_table[i][0]
+    waiting: Dict[Tuple[str, str], Tuple[str, str, int]] = {}  # Pairs waiting for their opposite direction
+    asymmetric: List[Tuple[str, str, int, int]] = []
+    for code_row in code_rows:
+        code_from = code_row[0]
         if code_from == '':  # If no code found for this station - pass the entire row
             continue
-        for k in range(1, len(code_distances_table[i])):  # The first element is code of the station
-            code_to = code_distances_table[0][k]
-            if code_to == '':  # If no code found for this station - pass the entire row
+        for k in range(1, len(code_row)):  # The first element is code of the station
+            code_to = station_codes[k]
+            if code_to == '' or code_row[k] == -1:  # No code found for this station or stations aren't connected
                 continue
-
-            distance = code_distances_table[i][k]
-            if distance == -1:  # If distance between station is -1 that means that stations aren't connected
+            if not symmetric or code_from == code_to:
+                yield code_from, code_to, code_row[k]
                 continue
+            pair = (min(code_from, code_to), max(code_from, code_to))
+            opposite = waiting.pop(pair, None)
+            if opposite is None or opposite[0] == code_from:  # The first direction or the same one again
+                waiting[pair] = (code_from, code_to, code_row[k])
+            else:
+                if opposite[2] != code_row[k]:
+                    asymmetric.append((code_from, code_to, code_row[k], opposite[2]))
+                yield code_from, code_to, min(code_row[k], opposite[2])
+    yield from waiting.values()
 
-            values.append((code_from, code_to, distance))
-    return values
+    if len(asymmetric) != 0:
+        for code_from, code_to, distance, opposite_distance in asymmetric[:10]:
+            print(f"  {code_from} to {code_to} {distance}km, opposite direction {opposite_distance}km")
+        print(f"{len(asymmetric)} transit distances of {ws_name} are not symmetric, the smaller ones have been added")
 
 
 def get_station_railroad(station_name: str) -> str:
@@ -119,12 +152,14 @@ def get_station_name(station_cell: str) -> str:
     return ''
 
 
-def station_code_by_name(cursor: sqlite3.Cursor, station_cell: str, ws_name: str = '') -> str:
+def station_code_by_name(cursor: sqlite3.Cursor, station_cell: str, ws_name: str = '',
+                         index: Optional[StationIndex] = None) -> str:
     """
     Search for the station code with given the name in the database
     :param cursor: cursor to the railroads.db
     :param station_cell: cell value of a Kniga_3...xls worksheet with name of station (and sometimes railroad)
     :param ws_name: Name of the worksheet in the Kniga_3...xls (used to find station by name)
+    :param index: Index of station names to look up instead of the table, None - SELECT from the table
     :return: station code if only one found else -1 if not found and -2 if found several
     """
 
@@ -142,10 +177,12 @@ def station_code_by_name(cursor: sqlite3.Cursor, station_cell: str, ws_name: str
 
         railroad_code = railroad_code_select[0][0]
 
-    station_code_query = """SELECT code FROM r_transportation_railroad_stations 
-                            WHERE name = (?) AND railroad_code = (?) AND type = 'РП'"""
-
-    station_code_select = cursor.execute(station_code_query, (station_name, railroad_code)).fetchall()
+    if index is not None:  # Names are compared exactly like the SELECT does
+        station_code_select = index.exact(station_name, railroad_code, "РП", normalize=False)
+    else:
+        station_code_query = """SELECT code FROM r_transportation_railroad_stations 
+                                WHERE name = (?) AND railroad_code = (?) AND type = 'РП'"""
+        station_code_select = cursor.execute(station_code_query, (station_name, railroad_code)).fetchall()
 
     if len(station_code_select) != 1:  # If SELECT is empty - no stations with such name / (name + railroad) were found
         print(f"\n! Station with name {station_cell} was not found or found in several versions. It will not be added\n")
@@ -156,6 +193,7 @@ def station_code_by_name(cursor: sqlite3.Cursor, station_cell: str, ws_name: str
 def get_distance(distance_cell: str) -> int:
     """
     Read a Kniga_3...xls cell with distance and return integer of the distance or -1 if "nan"
+    Readers use field_parsers.parse_optional_distance, benchmark.py compares it with this loop
     :param distance_cell: Cell of the worksheet from Kniga_3...xls cell with distance
     :return: Distance or -1 if "nan" in the given cell
     """
@@ -170,58 +208,73 @@ def get_distance(distance_cell: str) -> int:
     return int(''.join(distance_digits))
 
 
-def get_code_distances_table(cursor: sqlite3.Cursor, transit_table: List[List[str]], ws_name: str) -> List[List[str]]:
+def get_station_codes(cursor: sqlite3.Cursor, column_names: List[str], ws_name: str,
+                      index: Optional[StationIndex] = None) -> List[str]:
     """
     :param cursor: cursor to the railroads.db
-    :param transit_table: List of lists of strings with station names at first row and distances between stations
-    :return: List of lists with station ids as first row and first column and distances between stations
+    :param column_names: Row of station names, the first element is always "nan"
     :param ws_name: Name of the worksheet in the Kniga_3...xls (used to find station by name)
-    Distance gets value -1 if stations are not connected
+    :param index: Index of station names, see station_code_by_name
+    :return: List of station codes of columns with '' as the first element and for not found stations
     """
+    return [''] + [station_code_by_name(cursor, column_names[i], ws_name, index) for i in range(1, len(column_names))]
 
-    code_distances_table = [['']]
-    for i in range(1, len(transit_table[0])):  # Form the first row - station codes (First element is always "nan")
-        station_code = station_code_by_name(cursor, transit_table[0][i], ws_name)
-        code_distances_table[0].append(station_code)
 
-    for i in range(1, len(transit_table)):  # Starts from the second row because the first one is station row
-        station_code = station_code_by_name(cursor, transit_table[i][0], ws_name)
-        code_distances_table.append([station_code])  # Add list with station code from first column as first element
-        for k in range(1, len(transit_table[i])):  # Add distances for all columns at this row
-            code_distances_table[i].append(get_distance(transit_table[i][k]))
-    return code_distances_table
+def iter_code_distances(cursor: sqlite3.Cursor, transit_rows: Iterable[List[str]], ws_name: str,
+                        index: Optional[StationIndex] = None) -> Iterator[List]:
+    """
+    :param cursor: cursor to the railroads.db
+    :param transit_rows: Rows with station name as first element and distances to stations of columns
+    :param ws_name: Name of the worksheet in the Kniga_3...xls (used to find station by name)
+    :param index: Index of station names, see station_code_by_name
+    :return: Generator of lists with station code as first element and distances, -1 if stations are not connected
+    """
+    for transit_row in transit_rows:
+        yield [station_code_by_name(cursor, transit_row[0], ws_name, index)] + \
+              parse_optional_distance_column(transit_row[1:])
 
 
 def add_kniga3(cursor: sqlite3.Cursor, path_to_kniga3: str,
-               unused_worksheets: Tuple[str, str] = ("Общие положения", "Вводные положения")):
+               unused_worksheets: Tuple[str, str] = ("Общие положения", "Вводные положения"),
+               report: Optional[ImportReport] = None, state: Optional[ImportState] = None):
     """
     Reads Kniga_3_...xls from РЖД and insert or update all data in railroads.db
     :param cursor: cursor to the railroads.db
     :param path_to_kniga3: path to Kniga_3_...xls
     :param unused_worksheets: "Общие положения", "Вводные положения" and other no data storing worksheets
+    :param report: Import report to add stages to, None - not measured
+    :param state: Import state, every worksheet is committed with its checkpoint and imported worksheets are skipped.
+    None - the caller commits
     :return: None
     """
-    worksheets = list(read_excel(path_to_kniga3, sheet_name=None).keys())
+    with stage(report, STAGE_DECODE, KNIGA):  # Names of worksheets
+        worksheets = list(read_excel(path_to_kniga3, sheet_name=None).keys())
+    with stage(report, STAGE_RESOLUTION, KNIGA) as resolution:  # Stations of Kniga_2 are looked up by names
+        index = StationIndex(cursor)
+        resolution["rows"] = len(index)
     for worksheet in worksheets:
-        if worksheet not in unused_worksheets:
-            transit_worksheet = read_excel(path_to_kniga3, sheet_name=worksheet, header=None, index_col=False)
+        if worksheet not in unused_worksheets and not is_imported(state, KNIGA, worksheet, path_to_kniga3):
+            with stage(report, STAGE_DECODE, KNIGA, worksheet) as decode:
+                transit_worksheet = read_excel(path_to_kniga3, sheet_name=worksheet, header=None, index_col=False)
+                decode["rows"] = len(transit_worksheet)
             # For some reason not all worksheet names match with r_transportation_railroads sname column
             if worksheet == "Молд":
-                insert_transit_distances(cursor, transit_worksheet, "Млд")
+                insert_transit_distances(cursor, transit_worksheet, "Млд", report, worksheet, index)
             elif worksheet == "Каз":
-                insert_transit_distances(cursor, transit_worksheet, "Кзх")
+                insert_transit_distances(cursor, transit_worksheet, "Кзх", report, worksheet, index)
             elif worksheet == "Груз":
-                insert_transit_distances(cursor, transit_worksheet, "Грз")
+                insert_transit_distances(cursor, transit_worksheet, "Грз", report, worksheet, index)
             elif worksheet == "Узб":
-                insert_transit_distances(cursor, transit_worksheet, "Узбк")
+                insert_transit_distances(cursor, transit_worksheet, "Узбк", report, worksheet, index)
             elif worksheet == "Азер":
-                insert_transit_distances(cursor, transit_worksheet, "Азерб")
+                insert_transit_distances(cursor, transit_worksheet, "Азерб", report, worksheet, index)
             elif worksheet == "Кирг":
-                insert_transit_distances(cursor, transit_worksheet, "Кырг")
+                insert_transit_distances(cursor, transit_worksheet, "Кырг", report, worksheet, index)
             elif worksheet == "Турк":
-                insert_transit_distances(cursor, transit_worksheet, "Трк")
+                insert_transit_distances(cursor, transit_worksheet, "Трк", report, worksheet, index)
             else:
-                insert_transit_distances(cursor, transit_worksheet, worksheet)
+                insert_transit_distances(cursor, transit_worksheet, worksheet, report, worksheet, index)
+            save_checkpoint(state, KNIGA, worksheet, path_to_kniga3)
             print(f"Kniga_3 {worksheet} complete")
 
     return None
@@ -1,5 +1,38 @@
 #!/usr/bin/env/python
 #! -*- encoding: utf-8 -*-
+import gzip
+from xml.sax.saxutils import escape, unescape
+
+
+GZIP_MAGIC = b"\x1f\x8b"  # The first two bytes of any gzip file
+WRITE_BUFFER_SIZE = 1 << 16  # Size of the file buffer used by save_xml
+# Characters escaped in attribute values besides &, < and >: the parser splits a tag by quotes and reads it by lines
+ATTRIBUTE_ENTITIES = {'"': "&quot;", "\n": "&#10;", "\r": "&#13;"}
+ATTRIBUTE_UNESCAPES = {entity: character for character, entity in ATTRIBUTE_ENTITIES.items()}
+
+
+def escape_attribute(value) -> str:
+    """
+    Escapes a value of a tag attribute, so parse_xml reads the same value
+    :param value: Value of the attribute, not str values are written as str(value)
+    :return: Escaped value without quotes
+    """
+    return escape(str(value), ATTRIBUTE_ENTITIES)
+
+
+def open_xml(path_to_xml, encoding="utf8"):
+    """
+    Opens a plain or a gzip-compressed xml file for reading. The format is detected by the file content, not the name
+    :param path_to_xml: path to an xml file
+    :param encoding: encoding of the xml text
+    :return: text file object
+    """
+    with open(path_to_xml, mode='rb') as file:
+        magic = file.read(len(GZIP_MAGIC))
+    if magic == GZIP_MAGIC:
+        return gzip.open(path_to_xml, mode='rt', encoding=encoding)
+    return open(path_to_xml, encoding=encoding)
+
 
 class XmlDict(dict):
     """
@@ -40,7 +73,7 @@ class XmlDict(dict):
     @staticmethod
     def parse_xml(path_to_xml, encoding="utf8"):
         """
-        Parses a xml file and returns it's content as dictionary
+        Parses a xml file (plain or gzip-compressed) and returns it's content as dictionary
         :param path_to_xml: path to an xml file
         :return: dictionary with tags as keys
         """
@@ -68,7 +101,7 @@ class XmlDict(dict):
                         i += len(closing_tag)
                     xml_dict.add_tag(tag, tag_content)
                 else:
-                    return file_content
+                    return unescape(file_content)
             return xml_dict
 
         def find_tag(file_string: str) -> str:
@@ -94,7 +127,8 @@ class XmlDict(dict):
             content = complex_tag[
                       complex_tag.find(' '):-3]  # '<tag field1="s1" field2="s2"/>' to 'field1="s1" field2="s2"'
             content = content.split('"')
-            return {content[2 * i][1:-1]: content[2 * i + 1] for i in range(int(len(content) / 2))}
+            return {content[2 * i][1:-1]: unescape(content[2 * i + 1], ATTRIBUTE_UNESCAPES)
+                    for i in range(int(len(content) / 2))}
 
         def to_line(file_content: list) -> str:
             """
@@ -112,7 +146,7 @@ class XmlDict(dict):
                     lines.append(file_content[-1][file_content[i].find('<'):])
             return ''.join(lines)
 
-        with open(path_to_xml, encoding=encoding) as file:
+        with open_xml(path_to_xml, encoding=encoding) as file:
             header = file.readline()[:-1]
             if header[:2] == "<?" and header[-2:] == "?>":
                 file_content = to_line(file.readlines())
@@ -121,47 +155,48 @@ class XmlDict(dict):
                 print("Wrong header: {}".format(header))
             exit(1)
 
+    @staticmethod
+    def iter_xml(dictionary, level=0):
+        """
+        Generates xml text of a dictionary chunk by chunk, so the whole document is never held in memory.
+        Simple tags (<tag>value</tag> or <tag/>) go first, complex tags (dictionary, list) at the end
+        :param dictionary: A dictionary which should be converted
+        :param level: Nesting level of the dictionary, used for indentation
+        :return: generator of xml text chunks
+        """
+        indent = level * '\t'
+        complex_tags = []
+        for tag, content in dictionary.items():
+            if content is None or content == '':
+                yield "{}<{}/>\n".format(indent, tag)
+            elif type(content) is str:
+                yield "{}<{}>{}</{}>\n".format(indent, tag, escape(content), tag)
+            elif isinstance(content, (dict, list)):
+                complex_tags.append(tag)  # Only complex tags are kept to be written after the simple ones
+
+        for tag in complex_tags:
+            content = dictionary[tag]
+            for item in (content if type(content) is list else (content, )):  # A list is a repeated tag
+                if item is None or item == '':
+                    yield "{}<{}/>\n".format(indent, tag)
+                elif type(item) is str:
+                    yield "{}<{}>{}</{}>\n".format(indent, tag, escape(item), tag)
+                else:
+                    yield "{}<{}>\n".format(indent, tag)
+                    yield from XmlDict.iter_xml(item, level + 1)
+                    yield "{}</{}>\n".format(indent, tag)
+
     @staticmethod
     def save_xml(dictionary, path_to_save, encoding="utf8"):
         """
-        Saves a dictionary to an xml file
+        Saves a dictionary to an xml file. The text is streamed to the file while it's generated
         :param dictionary: A dictionary which should be saved
         :param path_to_save: A path where the .xml file should be saved
         :return:
         """
-        def text_xml(dictionary, level=0):
-            text = ""
-            tags = list(dictionary.keys())
-            keys = []
-            for i in range(len(tags)):  # Run through the dictionary
-                if type(dictionary[tags[i]]) is str or dictionary[tags[i]] is None:
-                    keys.append(tags[i])  # Add <tag>value</tag> or <tag/> tags first
-            for i in range(len(tags)):
-                if not (type(dictionary[tags[i]]) is str or dictionary[tags[i]] is None):
-                    keys.append(tags[i])  # Add complex tags (dictionary, list) at the end
-
-            for key in keys:
-                if dictionary[key] is None or dictionary[key] == '':
-                    text += level * '\t'
-                    text += "<{}/>\n".format(key)
-                elif type(dictionary[key]) is str:
-                    text += level * '\t'
-                    text += "<{}>{}</{}>\n".format(key, dictionary[key], key)
-                elif type(dictionary[key]) is XmlDict or type(dictionary[key]) is dict:
-                    text += level * '\t'
-                    text += "<{}>\n{}{}</{}>\n".format(key, text_xml(dictionary[key], level + 1), level * '\t', key)
-                elif type(dictionary[key]) is list:
-                    content = ["{}<{}>\n{}{}</{}>\n".format(level * '\t', key,
-                                                            text_xml(dictionary[key][i], level + 1),
-                                                            level * '\t', key) for i in range(len(dictionary[key]))]
-                    text += ''.join(content)
-            return text
-
-        with open(path_to_save, encoding=encoding, mode='w') as file:
-            text = text_xml(dictionary)
+        with open(path_to_save, encoding=encoding, mode='w', buffering=WRITE_BUFFER_SIZE) as file:
             file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-            file.write(text)
-            file.close()
+            file.writelines(XmlDict.iter_xml(dictionary))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,318 @@
+#! -*- encoding: utf-8 -*-
+import collections
+import pathlib
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Tuple
+from distance_calculator import part_rows_distance
+from table_generating import format_station_code
+
+
+DEFAULT_MEMORY_BUDGET = 64 << 20  # 64 MiB of loaded railroads
+ROW_BYTES = 160  # Estimated memory of one loaded row: a tuple with a code and a distance in dictionaries
+UNKNOWN_RAILROAD = ''  # Partition of codes which are not in r_transportation_railroad_stations
+
+
+class RailroadPartition:
+    """
+    Routing data of one railroad: transit distances and railroad part rows of its stations (by code_from),
+    positions of its stations on railroad parts and transit points found for its stations (attachments)
+    """
+    def __init__(self, cursor: sqlite3.Cursor, railroad_code: str, railroads: Dict[str, str]):
+        """
+        Loads the partition from the railroads.db
+        :param cursor: cursor to the railroads.db
+        :param railroad_code: Code of the railroad, UNKNOWN_RAILROAD - codes without a station
+        :param railroads: Dictionary with station codes as keys and railroad codes as values
+        """
+        if railroad_code == UNKNOWN_RAILROAD:
+            condition = "code_from NOT IN (SELECT code FROM r_transportation_railroad_stations)"
+            parameters: tuple = ()
+        else:
+            condition = "code_from IN (SELECT code FROM r_transportation_railroad_stations WHERE railroad_code = (?))"
+            parameters = (railroad_code, )
+        self.railroad_code = railroad_code
+        self.rows = 0
+
+        # Rows between railroads are in the resident layer of PartitionedGraph
+        transit_query = f"SELECT code_from, code_to, transit_distance FROM r_transportation_transit_distances " \
+                        f"WHERE {condition}"
+        self.transit: Dict[str, Dict[str, int]] = {}
+        for code_from, code_to, distance in cursor.execute(transit_query, parameters):
+            code_from, code_to = format_station_code(code_from), format_station_code(code_to)
+            if railroads.get(code_to, UNKNOWN_RAILROAD) == railroad_code:
+                self.transit.setdefault(code_from, {})[code_to] = distance
+                self.rows += 1
+
+        part_query = f"SELECT code_from, code_to, distance_between_stations, part_code " \
+                     f"FROM r_transportation_railroad_part_distances WHERE {condition}"
+        self.parts: Dict[str, List[Tuple[str, int]]] = {}
+        origins: Dict[Tuple[str, str], List] = {}  # (station, part) -> [origin code, offset, rows number]
+        for code_from, code_to, distance, part_code in cursor.execute(part_query, parameters):
+            code_from, code_to = format_station_code(code_from), format_station_code(code_to)
+            self.parts.setdefault(code_from, []).append((code_to, distance))
+            origin = origins.setdefault((code_from, part_code), [code_to, distance, 0])
+            if code_to < origin[0]:  # The origin of a part is the station with the smallest code, like in
+                origin[0], origin[1] = code_to, distance  # update_part_positions
+            origin[2] += 1
+            self.rows += 1
+
+        # The same as load_part_positions returns: parts of every station in the order of their origins
+        self.positions: Dict[str, Dict[str, Tuple[str, int, int]]] = {}
+        for (station_code, part_code), (origin_code, offset, rows_number) in \
+                sorted(origins.items(), key=lambda item: (item[0][0], item[1][0], item[0][1])):
+            self.positions.setdefault(station_code, {})[part_code] = (origin_code, offset, rows_number)
+
+        self.attachments: Dict[str, List[Tuple[str, int]]] = {}  # Results of get_distances_to_tp
+
+    def attach(self, station_code: str, transit_points: List[Tuple[str, int]]) -> None:
+        """
+        Keeps transit points found for the station
+        :param station_code: Station code of this railroad
+        :param transit_points: Result of get_distances_to_tp for the station
+        :return: None
+        """
+        if station_code not in self.attachments:
+            self.attachments[station_code] = transit_points
+            self.rows += len(transit_points)
+
+    def size(self) -> int:
+        """
+        :return: Estimated memory of the partition in bytes
+        """
+        return self.rows * ROW_BYTES
+
+
+class PartitionedGraph:
+    """
+    Distance engine loading routing data by railroads. Only station codes with their railroads and transit distances
+    between transit points of different railroads are always in memory, every railroad (see RailroadPartition) is
+    loaded on the first query touching its stations. When loaded railroads exceed the memory budget the least
+    recently used ones are dropped, so memory follows the railroads a node actually serves.
+    Distances are the same calculate_travel_distance returns. Thread-safe
+    """
+    def __init__(self, path_to_database: str = "railroads.db", memory_budget: int = DEFAULT_MEMORY_BUDGET):
+        """
+        Loads station codes and the transit layer between railroads
+        :param path_to_database: path to the railroads.db, opened read-only
+        :param memory_budget: Estimated bytes of loaded railroads, at least one railroad is kept loaded
+        """
+        uri = f"{pathlib.Path(path_to_database).absolute().as_uri()}?mode=ro"
+        self.connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        self.cursor = self.connection.cursor()
+        self.lock = threading.RLock()  # Guards the connection and loaded railroads
+        self.memory_budget = memory_budget
+        self.partitions: "collections.OrderedDict[str, RailroadPartition]" = collections.OrderedDict()
+        self.loads = 0
+        self.evictions = 0
+
+        stations_query = "SELECT code, railroad_code FROM r_transportation_railroad_stations"
+        self.railroads: Dict[str, str] = {code: railroad_code
+                                          for code, railroad_code in self.cursor.execute(stations_query)}
+
+        self.inter_railroad: Dict[str, Dict[str, int]] = {}  # Transit distances between railroads
+        transit_query = "SELECT code_from, code_to, transit_distance FROM r_transportation_transit_distances"
+        for code_from, code_to, distance in self.cursor.execute(transit_query):
+            code_from, code_to = format_station_code(code_from), format_station_code(code_to)
+            if self.railroads.get(code_from, UNKNOWN_RAILROAD) != self.railroads.get(code_to, UNKNOWN_RAILROAD):
+                self.inter_railroad.setdefault(code_from, {})[code_to] = distance
+
+    def __enter__(self) -> "PartitionedGraph":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def partition(self, station_code: str) -> RailroadPartition:
+        """
+        Takes the partition of the station's railroad, loads it on the first use and drops the least recently used
+        partitions if loaded ones exceed the memory budget
+        :param station_code: Station code
+        :return: Partition with data of the station
+        """
+        railroad_code = self.railroads.get(station_code, UNKNOWN_RAILROAD)
+        with self.lock:
+            partition = self.partitions.get(railroad_code)
+            if partition is not None:
+                self.partitions.move_to_end(railroad_code)
+                return partition
+            partition = RailroadPartition(self.cursor, railroad_code, self.railroads)
+            self.partitions[railroad_code] = partition
+            self.loads += 1
+            self.evict()
+            return partition
+
+    def evict(self) -> None:
+        """
+        Drops the least recently used partitions until loaded ones fit the memory budget, the last used is kept.
+        Queries running at the moment keep using dropped partitions they have already taken
+        :return: None
+        """
+        with self.lock:
+            while len(self.partitions) > 1 and self.memory_used() > self.memory_budget:
+                self.partitions.popitem(last=False)
+                self.evictions += 1
+
+    def memory_used(self) -> int:
+        """
+        :return: Estimated bytes of the loaded partitions
+        """
+        with self.lock:
+            return sum(partition.size() for partition in self.partitions.values())
+
+    def transit_distance(self, code_from: str, code_to: str) -> Optional[int]:
+        """
+        :return: Transit distance between stations, None if there is no such row in r_transportation_transit_distances
+        """
+        if self.railroads.get(code_from, UNKNOWN_RAILROAD) != self.railroads.get(code_to, UNKNOWN_RAILROAD):
+            return self.inter_railroad.get(code_from, {}).get(code_to)
+        return self.partition(code_from).transit.get(code_from, {}).get(code_to)
+
+    def transit_rows(self, station_code: str) -> List[Tuple[str, int]]:
+        """
+        :return: Transit distances of the station ordered by distance
+        """
+        rows = list(self.partition(station_code).transit.get(station_code, {}).items())
+        rows += self.inter_railroad.get(station_code, {}).items()
+        return sorted(rows, key=lambda row: row[1])
+
+    def distances_to_tp(self, station_code: str) -> List[Tuple[str, int]]:
+        """
+        The same as get_distances_to_tp over loaded partitions, but only the shortest distance to every transit point
+        is kept: longer ones never make the shortest route, and with branches joining again their number grows
+        exponentially. Found transit points are kept in the partition of every station
+        :param station_code: Station code
+        :return: List of tuples with transit point code and distance to it
+        """
+        attachments = self.partition(station_code).attachments
+        if station_code in attachments:
+            return attachments[station_code]
+
+        part_selects: Dict[str, List[Tuple[str, int]]] = {}
+        walked: Dict[str, List[Tuple[str, int]]] = {}  # Results found by this walk, complete or cut by a cycle
+        complete = set()
+        in_progress = set()
+        stack = [station_code]
+        while len(stack) != 0:
+            current_code = stack[-1]
+            if current_code in walked:
+                stack.pop()
+                continue
+            if current_code not in part_selects:
+                known = self.partition(current_code).attachments.get(current_code)
+                if known is not None:
+                    walked[current_code] = known
+                    complete.add(current_code)
+                    stack.pop()
+                    continue
+                transit_rows = self.transit_rows(current_code)
+                if len(transit_rows) != 0:
+                    walked[current_code] = transit_rows[:1] if transit_rows[0][1] == 0 else transit_rows
+                    complete.add(current_code)
+                    stack.pop()
+                    continue
+
+                part_selects[current_code] = self.partition(current_code).parts.get(current_code, [])
+                in_progress.add(current_code)
+                not_walked = []
+                for selected_code, _ in part_selects[current_code]:
+                    if selected_code in walked or selected_code in in_progress:
+                        continue
+                    known = self.partition(selected_code).attachments.get(selected_code)
+                    if known is not None:  # Taken now, the partition may be dropped while the walk goes on
+                        walked[selected_code] = known
+                        complete.add(selected_code)
+                    elif self.transit_distance(selected_code, selected_code) is None:
+                        not_walked.append(selected_code)
+                    else:  # A transit point is connected only to itself
+                        walked[selected_code] = [(selected_code, 0)]
+                        complete.add(selected_code)
+                if len(not_walked) != 0:
+                    stack.extend(not_walked)
+                    continue
+
+            shortest: Dict[str, int] = {}
+            is_complete = True
+            for selected_code, selected_distance in part_selects[current_code]:
+                is_complete = is_complete and selected_code in complete
+                for new_station_code, distance in walked.get(selected_code, []):  # Nothing from a cycle
+                    if new_station_code not in shortest or distance + selected_distance < shortest[new_station_code]:
+                        shortest[new_station_code] = distance + selected_distance
+            walked[current_code] = list(shortest.items())
+            if is_complete or current_code == station_code:
+                complete.add(current_code)
+            in_progress.discard(current_code)
+            stack.pop()
+
+        for code in complete:  # Only results which don't depend on the start of the walk are kept
+            self.partition(code).attach(code, walked[code])
+        self.evict()
+        return walked[station_code]
+
+    def same_part_distance(self, code_from: str, code_to: str) -> int:
+        """
+        The same as same_part_stations_distance with positions of stations
+        :return: distance between stations if they are at the same railroad part else -1
+        """
+        parts_to = self.partition(code_to).positions.get(code_to, {})
+        for part_code, (origin_from, offset_from, rows_from) in \
+                self.partition(code_from).positions.get(code_from, {}).items():
+            if part_code not in parts_to:
+                continue
+            origin_to, offset_to, rows_to = parts_to[part_code]
+            if rows_from + rows_to not in (2, 4):
+                continue
+            if rows_from == rows_to and origin_from == origin_to or rows_from == rows_to == 1:
+                return abs(offset_from - offset_to)
+            with self.lock:  # Uneven rows - take the rows as they are ordered in the database
+                distance = part_rows_distance(self.cursor, code_from, code_to, part_code, False)
+            if distance != -1:
+                return distance
+        return -1
+
+    def distance(self, code_from: str, code_to: str) -> int:
+        """
+        Calculates distance between two stations, see calculate_travel_distance
+        :param code_from: Station code in r_transportation_railroad_stations or Kniga_2...xls
+        :param code_to: Station code in r_transportation_railroad_stations or Kniga_2...xls
+        :return: Distance between stations, -1 if they are not connected, -2 if a station doesn't exist
+        """
+        for station_code in (code_from, code_to):
+            if station_code not in self.railroads:
+                print(f"  Station with code {station_code} does not exist in database")
+                return -2
+        if code_from == code_to:
+            return 0
+
+        distance = self.transit_distance(code_from, code_to)
+        if distance is not None:
+            return distance
+
+        distance = self.same_part_distance(code_from, code_to)
+        if distance != -1:
+            return distance
+
+        # Branch and bound as in calculate_travel_distance, cut transit points don't load their partitions either
+        transit_points_from = sorted(self.distances_to_tp(code_from), key=lambda transit_point: transit_point[1])
+        transit_points_to = sorted(self.distances_to_tp(code_to), key=lambda transit_point: transit_point[1])
+        best_distance = -1
+        for transit_from, distance_from in transit_points_from:
+            if best_distance != -1 and distance_from + transit_points_to[0][1] >= best_distance:
+                break
+            railroad_from = self.railroads.get(transit_from, UNKNOWN_RAILROAD)
+            rows_from = self.partition(transit_from).transit.get(transit_from, {})  # Taken once for all points to
+            inter_railroad_from = self.inter_railroad.get(transit_from, {})
+            for transit_to, distance_to in transit_points_to:
+                if best_distance != -1 and distance_from + distance_to >= best_distance:
+                    break
+                if self.railroads.get(transit_to, UNKNOWN_RAILROAD) == railroad_from:
+                    transit_distance = rows_from.get(transit_to)
+                else:
+                    transit_distance = inter_railroad_from.get(transit_to)
+                if transit_distance is not None and \
+                        (best_distance == -1 or distance_from + transit_distance + distance_to < best_distance):
+                    best_distance = distance_from + transit_distance + distance_to
+        return best_distance
@@ -0,0 +1,120 @@
+#! -*- encoding: utf-8 -*-
+import os
+import struct
+import threading
+import time
+from typing import BinaryIO, Iterator, NamedTuple
+from query_metrics import (PHASE_DIRECT_TRANSIT, PHASE_IDENTICAL, PHASE_SAME_PART, PHASE_STATIONS_CHECK,
+                           PHASE_TP_JOIN, PHASE_TP_SEARCH, PHASE_UNKNOWN_STATION, QueryStats)
+
+
+# Query log is a binary file of distance queries: MAGIC and fixed size records (see RECORD), one per query, in order of
+# their finish. A record takes 29 bytes, so a million queries take 29 MB. Codes are stored as they were passed,
+# cut or padded with spaces to 6 bytes (ASCII, other characters are replaced by ?)
+MAGIC = b"RRQLOG1\n"
+# Start time (seconds since epoch), code_from, code_to, answering phase (number in PHASES), latency (seconds), distance
+RECORD = struct.Struct("<d6s6sBfi")
+PHASES = (PHASE_STATIONS_CHECK, PHASE_UNKNOWN_STATION, PHASE_IDENTICAL, PHASE_DIRECT_TRANSIT, PHASE_SAME_PART,
+          PHASE_TP_SEARCH, PHASE_TP_JOIN)
+FAILED_DISTANCE = -3  # Distance of a query which raised an exception
+BUFFER_SIZE = 1 << 16  # Bytes of records kept in memory before they are written
+
+
+class QueryRecord(NamedTuple):
+    timestamp: float
+    code_from: str
+    code_to: str
+    phase: str
+    latency: float
+    distance: int
+
+
+def encode_code(station_code: str) -> bytes:
+    return station_code.encode("ascii", "replace")[:6].ljust(6)
+
+
+class QueryLog:
+    """
+    Writes QueryStats of distance queries to a query log file. Thread-safe, pass observe as observer:
+    calculate_travel_distance(..., observer=log.observe) or DistanceCalculator(..., observer=log.observe)
+    """
+    def __init__(self, path: str, append: bool = True):
+        """
+        Opens the log file
+        :param path: Path to the log file
+        :param append: Add records to the existing log (an incomplete last record is cut off), False - start a new log
+        Raises ValueError if append is True and the existing file is not a query log, so it's not overwritten
+        """
+        self.lock = threading.Lock()
+        self.path = path
+        if append and os.path.exists(path):  # A writer killed in the middle of a record leaves a part of it
+            size = os.path.getsize(path)
+            if size >= len(MAGIC) and not is_query_log(path):
+                raise ValueError(f"{path} is not a query log")
+            if 0 < size < len(MAGIC):  # Only a killed writer leaves a part of MAGIC
+                with open(path, "rb") as log_file:
+                    if not MAGIC.startswith(log_file.read()):
+                        print(f"  {path} is not a query log")
+                        raise ValueError(f"{path} is not a query log")
+            whole_size = len(MAGIC) + (size - len(MAGIC)) // RECORD.size * RECORD.size if size >= len(MAGIC) else 0
+            if whole_size != size:
+                os.truncate(path, whole_size)
+        self.file: BinaryIO = open(path, "ab" if append else "wb", buffering=BUFFER_SIZE)
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.written = 0
+
+    def __enter__(self) -> "QueryLog":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def observe(self, stats: QueryStats) -> None:
+        record = RECORD.pack(time.time() - stats.total_time, encode_code(stats.code_from), encode_code(stats.code_to),
+                             PHASES.index(stats.phase), stats.total_time,
+                             FAILED_DISTANCE if stats.distance is None else stats.distance)
+        with self.lock:
+            if not self.file.closed:
+                self.file.write(record)
+                self.written += 1
+
+    def flush(self) -> None:
+        with self.lock:
+            self.file.flush()
+
+    def close(self) -> None:
+        with self.lock:
+            self.file.close()
+
+
+def is_query_log(path: str) -> bool:
+    """
+    :param path: Path to a file
+    :return: True if the file starts with MAGIC, otherwise prints that it's not a query log
+    """
+    with open(path, "rb") as log_file:
+        if log_file.read(len(MAGIC)) == MAGIC:
+            return True
+    print(f"  {path} is not a query log")
+    return False
+
+
+def read_query_log(path: str) -> Iterator[QueryRecord]:
+    """
+    Reads a query log file record by record, an incomplete last record (the log was being written) is skipped
+    :param path: Path to the log file
+    :return: Generator of QueryRecord
+    """
+    if not is_query_log(path):
+        return
+    with open(path, "rb") as log_file:
+        log_file.seek(len(MAGIC))
+        while True:
+            chunk = log_file.read(RECORD.size * 4096)
+            for timestamp, code_from, code_to, phase, latency, distance in RECORD.iter_unpack(
+                    chunk[:len(chunk) - len(chunk) % RECORD.size]):
+                yield QueryRecord(timestamp, code_from.decode("ascii").rstrip(), code_to.decode("ascii").rstrip(),
+                                  PHASES[phase], latency, distance)
+            if len(chunk) < RECORD.size * 4096:
+                return
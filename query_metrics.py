@@ -0,0 +1,183 @@
+#! -*- encoding: utf-8 -*-
+import bisect
+import heapq
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+
+# Phases of calculate_travel_distance, the answering phase is the last one
+PHASE_STATIONS_CHECK = "stations_check"
+PHASE_UNKNOWN_STATION = "unknown_station"
+PHASE_IDENTICAL = "identical"
+PHASE_DIRECT_TRANSIT = "direct_transit"
+PHASE_SAME_PART = "same_part"
+PHASE_TP_SEARCH = "tp_search"  # Search for transit points of both stations, never answers a query
+PHASE_TP_JOIN = "tp_join"
+
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+TP_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+SLOWEST_NUMBER = 20  # Number of the slowest queries kept by MetricsRegistry
+
+
+class QueryStats:
+    """
+    Statistics of one calculate_travel_distance call, passed to the observer when the call is finished
+    phase_times has seconds spent in every passed phase, phase is the phase which answered the query.
+    statements is the number of SQL statements executed by the connection while calculating
+    (counted with set_trace_callback). tp_from/tp_to are numbers of candidate transit points of the stations,
+    0 if the query was answered before the transit points search, tp_pairs is the number of their pairs looked up
+    (the rest are cut off as not shorter than the best distance)
+    """
+    def __init__(self, code_from: str, code_to: str):
+        self.code_from = code_from
+        self.code_to = code_to
+        self.distance: Optional[int] = None
+        self.phase = PHASE_STATIONS_CHECK
+        self.phase_times: Dict[str, float] = {}
+        self.statements = 0
+        self.tp_from = 0
+        self.tp_to = 0
+        self.tp_pairs = 0
+        self.total_time = 0.0
+        self.started = time.perf_counter()
+        self.phase_started = self.started
+
+    def count_statement(self, statement: str) -> None:
+        """
+        Trace callback of the connection
+        :param statement: Executed SQL statement
+        :return: None
+        """
+        self.statements += 1
+
+    def finish_phase(self, next_phase: str) -> None:
+        """
+        Adds time of the current phase and starts the next one
+        :param next_phase: Name of the next phase, PHASE_... constant
+        :return: None
+        """
+        now = time.perf_counter()
+        self.phase_times[self.phase] = self.phase_times.get(self.phase, 0.0) + now - self.phase_started
+        self.phase = next_phase
+        self.phase_started = now
+
+    def finish(self, distance: Optional[int]) -> None:
+        """
+        Finishes the answering phase and the whole query
+        :param distance: Result of the query, None if the query failed
+        :return: None
+        """
+        now = time.perf_counter()
+        self.phase_times[self.phase] = self.phase_times.get(self.phase, 0.0) + now - self.phase_started
+        self.distance = distance
+        self.total_time = now - self.started
+
+    def as_dict(self) -> dict:
+        return {"code_from": self.code_from, "code_to": self.code_to, "distance": self.distance,
+                "phase": self.phase, "phase_times": dict(self.phase_times), "statements": self.statements,
+                "tp_from": self.tp_from, "tp_to": self.tp_to, "tp_pairs": self.tp_pairs,
+                "total_time": self.total_time}
+
+
+class Histogram:
+    """
+    Histogram with fixed upper bounds of buckets, the last bucket takes values above all bounds
+    """
+    def __init__(self, bounds: Sequence[float]):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimates quantile as the upper bound of the bucket containing it
+        :param q: Quantile from 0 to 1
+        :return: Upper bound of the bucket (not above max value), max value for the last bucket,
+        0 if histogram is empty
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        accumulated = 0
+        for index, bucket_count in enumerate(self.counts):
+            accumulated += bucket_count
+            if accumulated >= rank and bucket_count != 0:
+                return min(self.bounds[index], self.max) if index < len(self.bounds) else self.max
+        return self.max
+
+    def as_dict(self) -> dict:
+        return {"count": self.count, "sum": self.sum, "max": self.max,
+                "mean": self.sum / self.count if self.count != 0 else 0.0,
+                "p50": self.quantile(0.5), "p90": self.quantile(0.9), "p99": self.quantile(0.99),
+                "buckets": dict(zip([str(bound) for bound in self.bounds] + ["inf"], self.counts))}
+
+
+class MetricsRegistry:
+    """
+    Aggregates QueryStats of many queries: histograms of total time and statements by answering phase,
+    histograms of time spent in every phase, of candidate transit points and the slowest queries.
+    Thread-safe, pass observe as observer: calculate_travel_distance(..., observer=registry.observe)
+    """
+    def __init__(self, slowest_number: int = SLOWEST_NUMBER):
+        self.lock = threading.Lock()
+        self.queries: Dict[str, int] = {}  # Answering phase -> number of queries
+        self.query_times: Dict[str, Histogram] = {}  # Answering phase -> total time of queries
+        self.statements: Dict[str, Histogram] = {}  # Answering phase -> statements of queries
+        self.phase_times: Dict[str, Histogram] = {}  # Phase -> time spent in the phase
+        self.transit_points = Histogram(TP_BUCKETS)  # Candidate transit points of both sides
+        self.slowest_number = slowest_number
+        self.slowest: List[Tuple[float, int, dict]] = []  # Heap of (total time, number, stats dictionary)
+        self.observed = 0
+
+    def observe(self, stats: QueryStats) -> None:
+        with self.lock:
+            self.observed += 1
+            self.queries[stats.phase] = self.queries.get(stats.phase, 0) + 1
+            self.query_times.setdefault(stats.phase, Histogram(TIME_BUCKETS)).observe(stats.total_time)
+            self.statements.setdefault(stats.phase, Histogram(STATEMENT_BUCKETS)).observe(stats.statements)
+            for phase, phase_time in stats.phase_times.items():
+                self.phase_times.setdefault(phase, Histogram(TIME_BUCKETS)).observe(phase_time)
+            if stats.phase == PHASE_TP_JOIN:
+                self.transit_points.observe(stats.tp_from)
+                self.transit_points.observe(stats.tp_to)
+
+            record = (stats.total_time, self.observed, stats.as_dict())
+            if len(self.slowest) < self.slowest_number:
+                heapq.heappush(self.slowest, record)
+            elif record[0] > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, record)
+
+    def summary(self) -> dict:
+        """
+        :return: Dictionary with all aggregated metrics, the slowest queries are sorted from the slowest
+        """
+        with self.lock:
+            return {"queries": dict(self.queries),
+                    "query_times": {phase: histogram.as_dict() for phase, histogram in self.query_times.items()},
+                    "statements": {phase: histogram.as_dict() for phase, histogram in self.statements.items()},
+                    "phase_times": {phase: histogram.as_dict() for phase, histogram in self.phase_times.items()},
+                    "transit_points": self.transit_points.as_dict(),
+                    "slowest": [record[2] for record in sorted(self.slowest, reverse=True)]}
+
+    def report(self) -> str:
+        """
+        :return: Human-readable table of queries by answering phase
+        """
+        lines = [f"{'phase':<16}{'queries':>10}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}{'statements p50':>16}"]
+        with self.lock:
+            for phase in sorted(self.queries, key=self.queries.get, reverse=True):
+                times = self.query_times[phase]
+                lines.append(f"{phase:<16}{self.queries[phase]:>10}{times.quantile(0.5) * 1000:>10.2f}"
+                             f"{times.quantile(0.99) * 1000:>10.2f}{times.max * 1000:>10.2f}"
+                             f"{self.statements[phase].quantile(0.5):>16.0f}")
+        return "\n".join(lines)
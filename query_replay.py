@@ -0,0 +1,156 @@
+#! -*- encoding: utf-8 -*-
+from concurrent.futures import ThreadPoolExecutor
+import json
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+from benchmark import get_flag_value, percentile
+from distance_calculator import DistanceCalculator
+from query_log import FAILED_DISTANCE, QueryRecord, is_query_log, read_query_log
+
+
+HELP = """
+  This script replays a query log written by distance_calculator.py
+  --query-log (or by QueryLog observer of a service) against the given
+  railroads.db: queries are sent at the moments they were logged
+  and their latency is counted from these moments, so the load is the same
+  however slow the database is. Throughput, latency percentiles by the
+  answering phase (replayed and logged) and distances different
+  from the logged ones are reported
+  Flags: --rate X - speed of the replay, 2 - twice faster than logged,
+  0 - as fast as possible (default 1), --workers N - number of queries
+  running at the same time (default 4), --save PATH - save results to json
+  Example: D:\\work\\MyPyProjects\\railroads>query_replay.exe queries.log railroads.db --rate 2 --workers 8
+
+  Этот скрипт воспроизводит журнал запросов, записанный
+  distance_calculator.py --query-log (или наблюдателем QueryLog сервиса),
+  на указанной railroads.db: запросы отправляются в те же моменты, что и
+  в журнале, и время ответа считается от этих моментов, поэтому нагрузка
+  не зависит от скорости базы. Выводятся пропускная способность,
+  перцентили времени ответа по этапу ответа (при воспроизведении
+  и в журнале) и расстояния, отличающиеся от записанных в журнале
+  Флаги: --rate X - скорость воспроизведения, 2 - вдвое быстрее журнала,
+  0 - как можно быстрее (по умолчанию 1), --workers N - число запросов,
+  выполняемых одновременно (по умолчанию 4), --save PATH - сохранить
+  результаты в json
+  Example: D:\\work\\MyPyProjects\\railroads>query_replay.exe queries.log railroads.db --rate 2 --workers 8
+  """
+
+DEFAULT_RATE = 1.0
+DEFAULT_WORKERS = 4
+QUEUED_PER_WORKER = 4  # Queries waiting for a worker with --rate 0, so the log is not read into the queue at once
+MISMATCH_SAMPLES = 10  # Queries with different distances kept for the report
+
+
+def get_latency_record(latencies: List[float], logged_latencies: List[float]) -> dict:
+    """
+    :param latencies: Replayed latencies of queries in seconds
+    :param logged_latencies: Logged latencies of the same queries in seconds
+    :return: Dictionary with number of queries, percentiles of replayed and logged latencies in milliseconds
+    """
+    latencies, logged_latencies = sorted(latencies), sorted(logged_latencies)
+    return {"queries": len(latencies),
+            "p50": percentile(latencies, 0.5) * 1000, "p90": percentile(latencies, 0.9) * 1000,
+            "p99": percentile(latencies, 0.99) * 1000, "max": (latencies[-1] if latencies else 0.0) * 1000,
+            "logged_p50": percentile(logged_latencies, 0.5) * 1000,
+            "logged_p99": percentile(logged_latencies, 0.99) * 1000}
+
+
+def replay(path_to_log: str, path_to_database: str, rate: float = DEFAULT_RATE,
+           workers: int = DEFAULT_WORKERS) -> dict:
+    """
+    Replays the query log: a query is sent when the time passed since the first logged query divided by rate
+    passes, latency is counted from that moment (so waiting for a busy worker counts too)
+    :param path_to_log: Path to the query log
+    :param path_to_database: path to the railroads.db
+    :param rate: Speed of the replay relative to the log, 0 - send queries as soon as a worker is free
+    :param workers: Number of threads and connections running queries
+    :return: Dictionary with number of queries, wall time, throughput (queries per second), latency records
+    (see get_latency_record) of all queries and by logged answering phase, number and samples of queries
+    which distances differ from the logged ones
+    """
+    results: List[Tuple[QueryRecord, float, int]] = []  # (logged query, replayed latency, distance)
+    results_lock = threading.Lock()
+    queued = threading.BoundedSemaphore(workers * QUEUED_PER_WORKER)
+
+    def run(record: QueryRecord, scheduled: float) -> None:
+        try:
+            distance = calculator.distance(record.code_from, record.code_to)
+        except Exception:
+            distance = FAILED_DISTANCE
+        latency = time.perf_counter() - scheduled
+        with results_lock:
+            results.append((record, latency, distance))
+        if rate <= 0:
+            queued.release()
+
+    # Unknown stations of the log aren't printed for every query
+    with DistanceCalculator(path_to_database, connections=workers, quiet=True) as calculator, \
+            ThreadPoolExecutor(workers) as executor:
+        started = time.perf_counter()
+        first_timestamp: Optional[float] = None
+        for record in read_query_log(path_to_log):
+            if rate <= 0:
+                queued.acquire()
+                scheduled = time.perf_counter()
+            else:
+                if first_timestamp is None:
+                    first_timestamp = record.timestamp
+                scheduled = started + max(record.timestamp - first_timestamp, 0.0) / rate
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            executor.submit(run, record, scheduled)
+    wall_time = time.perf_counter() - started
+
+    by_phase: Dict[str, Tuple[List[float], List[float]]] = {}
+    mismatches = []
+    for record, latency, distance in results:
+        phase_latencies = by_phase.setdefault(record.phase, ([], []))
+        phase_latencies[0].append(latency)
+        phase_latencies[1].append(record.latency)
+        if distance != record.distance and record.distance != FAILED_DISTANCE:
+            mismatches.append(f"{record.code_from} to {record.code_to}: {distance}km, logged {record.distance}km")
+    return {"queries": len(results), "wall_time": wall_time,
+            "throughput": len(results) / wall_time if wall_time > 0 else 0.0,
+            "latency": get_latency_record([latency for _, latency, _ in results],
+                                          [record.latency for record, _, _ in results]),
+            "phases": {phase: get_latency_record(*latencies) for phase, latencies in by_phase.items()},
+            "mismatches": len(mismatches), "mismatch_samples": mismatches[:MISMATCH_SAMPLES]}
+
+
+if __name__ == "__main__":
+    arguments = sys.argv[1:]
+    if "--help" in arguments or len(arguments) < 2:
+        print(HELP)
+        exit(0)
+    save_path = get_flag_value(arguments, "--save")
+    replay_rate = get_flag_value(arguments, "--rate") or str(DEFAULT_RATE)
+    workers_number = get_flag_value(arguments, "--workers") or str(DEFAULT_WORKERS)
+    try:
+        replay_rate = float(replay_rate)
+    except ValueError:
+        replay_rate = -1.0
+    if replay_rate < 0 or not workers_number.isdigit() or int(workers_number) == 0 or len(arguments) != 2:
+        print("\n  Wrong arguments. Run script with --help flag to learn more")
+        exit(-1)
+
+    if not is_query_log(arguments[0]):
+        exit(-1)
+    replay_results = replay(arguments[0], arguments[1], replay_rate, int(workers_number))
+    print(f"{replay_results['queries']} queries in {replay_results['wall_time']:.2f}s, "
+          f"{replay_results['throughput']:.1f} queries/s")
+    print(f"{'phase':<16}{'queries':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+          f"{'logged p50':>12}{'logged p99':>12}")
+    for phase, record in [("all", replay_results["latency"])] + sorted(replay_results["phases"].items()):
+        print(f"{phase:<16}{record['queries']:>10}{record['p50']:>10.3f}{record['p90']:>10.3f}{record['p99']:>10.3f}"
+              f"{record['max']:>10.3f}{record['logged_p50']:>12.3f}{record['logged_p99']:>12.3f}")
+    print(f"{replay_results['mismatches']} distances differ from the log")
+    for mismatch in replay_results["mismatch_samples"]:
+        print(f"    {mismatch}")
+
+    if save_path is not None:
+        with open(save_path, "w", encoding="utf-8") as results_file:
+            json.dump(replay_results, results_file, ensure_ascii=False, indent=2)
+        print(f"\n{save_path} saved")
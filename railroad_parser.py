@@ -1,18 +1,31 @@
 #! -*- encoding: utf-8 -*-
 import sqlite3
+from data_quality import validate_database
+from editions import (EDITIONS_TABLE, HISTORY_SUFFIX, clear_versioned_tables, create_edition_tables, get_edition,
+                      is_new_edition, record_edition)
+from import_report import (ImportReport, REPORT_PATH, STAGE_EDITION, STAGE_REFERENCES, STAGE_VACUUM, STAGE_VALIDATION,
+                           STAGE_XML, stage)
+from import_state import IMPORT_STATE_TABLE, ImportState
 from references import update_references
-from table_generating import create_tables
+from table_generating import (PART_POSITIONS_TABLE, TRANSIT_DISTANCES_TABLE, TRANSIT_PAIRS_TABLE, create_tables,
+                              format_station_code, is_symmetric_layout)
 from kniga_1_reader import add_kniga1
 from kniga_2_reader import add_kniga2
 from kniga_3_reader import add_kniga3
 from datetime import date
+from multiprocessing import freeze_support
+from parse_xml11 import escape_attribute
+import gzip
 import os
+import sys
+from typing import Optional
 
 
 HELP = """
   This script parses Kniga_1...xls, Kniga_2...xls, Kniga_3...xls 
   from current directory, inserts all data to railroads.db 
   and generates .spr files for each database table
+  Books can be .xls or .xlsx (like books of synthetic_network.py)
    
   !!! Notice that folder "Справочники" is required with next
       files insisde:
@@ -20,10 +33,34 @@ HELP = """
       with railroad reference
       tp0005.spr - r_transportation_railroad_operations, an xml file
       with station operations reference
+
+  Optional flag --compress writes gzip-compressed .spr.gz references
+  instead of plain .spr files. Both formats are read automatically
+  Optional flag --compact stores station codes of the distance tables
+  as integers which makes railroads.db about twice smaller
+  Optional flag --symmetric stores each transit distance once
+  for both directions
+
+  Optional flag --resume continues the last import: every worksheet is
+  committed with a checkpoint, so worksheets imported before a failure
+  are skipped
+
+  Optional flag --edition keeps previous editions of the books in
+  railroads.db: the edition is the date in the names of the books
+  (Kniga_1_2019-10-09.xls), tables get only data of the edition and
+  their history keeps rows of all editions, so distances can be
+  calculated as of a date (see distance_calculator.py --as-of)
+
+  Imported distances are checked after the import (see data_quality.py),
+  optional flag --strict stops the script if any problem is found
+
+  Time, rows per second and memory of every import stage
+  are saved to import_report.json
   
   Данный скрипт парсит Kniga_1...xls, Kniga_2...xls, Kniga_3...xls 
   из текущей директроии, добавляет данные в railroads.db
   и генерирует .spr файлы для каждой таблице в базе
+  Книги могут быть .xls или .xlsx (как книги synthetic_network.py)
   
   !!! Обратите внимание, что папка "Справочники" необходима
   для работы, со следующими файламиЖ
@@ -31,25 +68,62 @@ HELP = """
       со справочником по железным дорогам
       tp0005.spr - r_transportation_railroad_operations, xml файл 
       со справочником по станционным операциям
+
+  Флаг --compress сохраняет справочники в сжатом виде .spr.gz
+  вместо обычных .spr. Оба формата читаются автоматически
+  Флаг --compact хранит коды станций в таблицах расстояний
+  как целые числа, что уменьшает railroads.db примерно вдвое
+  Флаг --symmetric хранит транзитное расстояние один раз
+  для обоих направлений
+
+  Флаг --resume продолжает последний импорт: каждый лист сохраняется
+  с отметкой об импорте, поэтому листы, импортированные до сбоя,
+  пропускаются
+
+  Флаг --edition сохраняет предыдущие издания книг в railroads.db:
+  издание - это дата в названиях книг (Kniga_1_2019-10-09.xls), таблицы
+  получают только данные издания, а их история хранит строки всех
+  изданий, поэтому расстояния можно расчитать на дату
+  (см. distance_calculator.py --as-of)
+
+  Импортированные расстояния проверяются после импорта (см. data_quality.py),
+  флаг --strict останавливает скрипт, если найдена хоть одна проблема
+
+  Время, число строк в секунду и память каждого этапа
+  импорта сохраняются в import_report.json
 """
 
 
-def write_reference(data_dict: dict, columns_dict: dict, xml_name: str, table_name: str) -> bool:
+def open_reference(xml_name: str, compress: bool):
+    """
+    Opens a reference file for writing
+    :param xml_name: Name of the generating xml
+    :param compress: Write gzip-compressed xml if True else plain xml
+    :return: text file object
+    """
+    if compress:
+        return gzip.open(xml_name, 'wt', encoding="utf-8")
+    return open(xml_name, 'w', encoding="utf-8")
+
+
+def write_reference(data_dict: dict, columns_dict: dict, xml_name: str, table_name: str,
+                    compress: bool = False) -> bool:
     """
     Writes xml file from two dictionary of columns and dictionary of data from SQL table
     :param data_dict: Dictionary with column name as key and list of values as value
     :param columns_dict: Dictionary with column name as key and dictionary with column type, caption as value
     :param xml_name: Name of the generating xml
     :param table_name: Name for the rTable field of the generating xml
+    :param compress: Write gzip-compressed xml (.spr.gz) if True else plain xml
     :return:
     """
     try:
-        with open("%s" % xml_name, 'w', encoding="utf-8") as file:
+        with open_reference("%s" % xml_name, compress) as file:
             file.close()
     except:
         return False
 
-    with open("%s" % xml_name, 'w', encoding="utf-8") as file:
+    with open_reference("%s" % xml_name, compress) as file:
         current_date = ('%s' % date.today()).split('-')
         current_date = '.'.join([current_date[2], current_date[1], current_date[0]])
         header = f"""<?xml version="1.1"?>
@@ -64,12 +138,13 @@ def write_reference(data_dict: dict, columns_dict: dict, xml_name: str, table_na
         for column in columns_dict:
             column_type = columns_dict[column]["type"]
             caption = columns_dict[column]["caption"]
-            file.write(f'    <column name="{column}" type="{column_type}" caption="{caption}"/>\n')
+            file.write(f'    <column name="{escape_attribute(column)}" type="{escape_attribute(column_type)}" '
+                       f'caption="{escape_attribute(caption)}"/>\n')
         file.write("  </ColumnsList>\n  <RecordsList>\n")
 
         row_blank = ' '.join(["%s=\"{}\"" % column for column in columns_dict])
         for i in range(records_number):
-            row = row_blank.format(*[data_dict[column][i] for column in data_dict])
+            row = row_blank.format(*[escape_attribute(data_dict[column][i]) for column in data_dict])
             file.write("    <record %s/>\n" % row)
         file.write("  </RecordsList>\n</reference>")
 
@@ -119,67 +194,111 @@ def get_data_dict(cursor: sqlite3.Cursor, table_name: str) -> dict:
     for i in range(len(data)):
         k = 0
         for column in data_dict:
-            data_dict[column].append(data[i][k])
+            if column == "code_from" or column == "code_to":  # Compact tables store codes as integers
+                data_dict[column].append(format_station_code(data[i][k]))
+            else:
+                data_dict[column].append(data[i][k])
             k += 1
     return data_dict
 
 
-def generate_xml(cursor: sqlite3.Cursor) -> None:
+def generate_xml(cursor: sqlite3.Cursor, compress: bool = False, report: Optional[ImportReport] = None) -> None:
     """
     Generates an xml files for each table in the railroads.db
     :param cursor: Cursor to the railroads.db
+    :param compress: Write gzip-compressed references (.spr.gz) if True else plain .spr
+    :param report: Import report to add export of every table to, None - not measured
     :return:
     """
+    extension = ".spr.gz" if compress else ".spr"
     if not os.path.exists("references"):
         os.mkdir("references")
 
-    tables = cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name != 'table_info'").fetchall()
-    tables = [table_info[0] for table_info in tables]
+    # Part positions are rebuilt from the part distances by update_references
+    tables_query = f"""SELECT name FROM sqlite_master 
+                       WHERE type='table' AND name NOT IN ('table_info', '{IMPORT_STATE_TABLE}',
+                                                           '{PART_POSITIONS_TABLE}')"""
+    tables = cursor.execute(tables_query).fetchall()
+    tables = [table_info[0] for table_info in tables
+              if not table_info[0].endswith(HISTORY_SUFFIX) and table_info[0] != EDITIONS_TABLE]
+    if is_symmetric_layout(cursor):  # The reference keeps both directions, the pairs table is internal
+        tables = [TRANSIT_DISTANCES_TABLE if table == TRANSIT_PAIRS_TABLE else table for table in tables]
     for table in tables:
-        columns_dict = get_columns_dict(cursor, table)  # Dictionary with columns' names as keys and property dict
-        data_dict = get_data_dict(cursor, table)  # Dictionary with columns' names as keys and columns' data lists
-        write_reference(data_dict, columns_dict, f"references/{table}.spr", table)
-        print(f"{table}.spr created")
+        with stage(report, STAGE_XML, worksheet=table) as export:
+            columns_dict = get_columns_dict(cursor, table)  # Dictionary with columns' names as keys and property dict
+            data_dict = get_data_dict(cursor, table)  # Dictionary with columns' names as keys and columns' data lists
+            write_reference(data_dict, columns_dict, f"references/{table}{extension}", table, compress)
+            export["rows"] = len(next(iter(data_dict.values()), []))
+        print(f"{table}{extension} created")
     return
 
 
-def generate_database(path_to_database: str, path_to_kniga1: str, path_to_kniga2: str, path_to_kniga3: str):
+def generate_database(path_to_database: str, path_to_kniga1: str, path_to_kniga2: str, path_to_kniga3: str,
+                      compact: bool = False, symmetric: bool = False, report: Optional[ImportReport] = None,
+                      path_to_references: str = "Справочники", strict: bool = False, resume: bool = False,
+                      edition: Optional[str] = None):
     """
     Parses three xls books of railroad open data and create/updates tables in database from given path
     :param path_to_database: path to database where tables should be created
     :param path_to_kniga1: path to Kniga_1...xls file
     :param path_to_kniga2: path to Kniga_2...xls file
     :param path_to_kniga3: path to Kniga_3...xls file
+    :param compact: Use the compact layout (integer station codes) for the distance tables
+    :param symmetric: Store each transit distance once per pair of stations
+    :param report: Import report to add stages to, None - not measured
+    :param path_to_references: path to the folder with references tp0003.spr, tp0005.spr, ...
+    :param strict: Exit with -1 if the data quality check finds any problem
+    :param resume: Skip worksheets imported by the previous call (see import_state.py)
+    :param edition: Date of the books edition (see editions.py) to keep rows of previous editions in the history,
+    None - data of the books is added to the data in the tables
     :return:
     """
     connection = sqlite3.connect(path_to_database)
     db_cursor = connection.cursor()
+    if edition is not None and not is_new_edition(db_cursor, edition):
+        exit(-1)
 
-    update_references(connection)
-    create_tables(db_cursor)
+    with stage(report, STAGE_REFERENCES):
+        update_references(connection, path_to_references)
+    create_tables(db_cursor, compact, symmetric)
+    if edition is not None:
+        create_edition_tables(db_cursor)
+        if not resume:  # Rows of the previous edition are in the history
+            clear_versioned_tables(db_cursor)
+    state = ImportState(db_cursor, resume)  # Every worksheet is committed with its checkpoint
 
-    add_kniga2(db_cursor, path_to_kniga2)  # Read kniga2 first because it contains all stations
+    add_kniga2(db_cursor, path_to_kniga2, report, state)  # Read kniga2 first because it contains all stations
     connection.commit()
     print("Kniga_2 data has been inserted\n")
 
-    add_kniga1(db_cursor, path_to_kniga1)
+    add_kniga1(db_cursor, path_to_kniga1, report=report, state=state)
     connection.commit()
     print("Kniga_1 data has been inserted\n")
 
-    add_kniga3(db_cursor, path_to_kniga3)
+    add_kniga3(db_cursor, path_to_kniga3, report=report, state=state)
     connection.commit()
-    db_cursor.execute("VACUUM")
+    if edition is not None:
+        with stage(report, STAGE_EDITION):
+            record_edition(db_cursor, edition)
+        connection.commit()
+        print(f"Edition {edition} has been added to the history\n")
+    with stage(report, STAGE_VACUUM):
+        db_cursor.execute("VACUUM")
     connection.commit()
     print("Kniga_3 data has been inserted\n")
+
+    with stage(report, STAGE_VALIDATION):
+        validate_database(db_cursor, strict)
     print("Complete")
 
 
 if __name__ == "__main__":
+    freeze_support()  # References are parsed by a process pool, its workers start this .exe again
     print(HELP)
 
     current_folder = os.path.dirname(os.path.realpath(__file__))
     file_list = os.listdir(current_folder)
-    xls_files = [file for file in file_list if file.split('.')[-1] == "xls"]
+    xls_files = [file for file in file_list if file.split('.')[-1] in ("xls", "xlsx")]  # xlsx - synthetic_network
 
     path_to_kniga1 = ""
     path_to_kniga2 = ""
@@ -214,11 +333,25 @@ if __name__ == "__main__":
             input("Press any key to continue")
         else:
             path_to_database = "railroads.db"
+            import_report = ImportReport()
+            edition = None
+            if "--edition" in sys.argv:  # Books of an edition have the same date, the latest one is taken
+                editions = [get_edition(path) for path in (path_to_kniga1, path_to_kniga2, path_to_kniga3)]
+                if None in editions:
+                    print("  Date of the edition was not found in names of the books (Kniga_1_2019-10-09.xls)!\n"
+                          "  Дата издания не найдена в названиях книг (Kniga_1_2019-10-09.xls)!\n")
+                    exit(-1)
+                edition = max(editions)
 
-            generate_database(path_to_database, path_to_kniga1, path_to_kniga2, path_to_kniga3)
+            generate_database(path_to_database, path_to_kniga1, path_to_kniga2, path_to_kniga3,
+                              compact="--compact" in sys.argv, symmetric="--symmetric" in sys.argv,
+                              report=import_report, strict="--strict" in sys.argv, resume="--resume" in sys.argv,
+                              edition=edition)
 
             connection = sqlite3.connect(path_to_database)
             db_cursor = connection.cursor()
 
-            generate_xml(db_cursor)
+            generate_xml(db_cursor, compress="--compress" in sys.argv, report=import_report)
+            import_report.save(REPORT_PATH)
+            print(f"{REPORT_PATH} saved")
             input("\nComplete.")
@@ -1,9 +1,17 @@
 # -*- coding: utf-8 -*-
 import parse_xml11
-from typing import List
+from typing import List, Optional, Set
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import date
+from multiprocessing import freeze_support
 import os
+import re
 import sqlite3
+from table_generating import PART_DISTANCES_TABLE, PART_POSITIONS_QUERY, update_part_positions
+
+
+REFERENCE_EXTENSIONS = (".spr", ".spr.gz")  # Plain xml references and gzip-compressed ones
+REFERENCES_PATTERN = re.compile(r"REFERENCES\s+\[?(\w+)")  # "... REFERENCES r_transportation_railroads(code)"
 
 
 def field_parser(field: dict) -> str:
@@ -92,23 +100,123 @@ def date_from_string(date_string: str) -> date:
 
 def collect_references(path_to_folder: str) -> List[str]:
     """
-    Scan through folder and collect all references (xml files with *.spr names)
+    Scan through folder and collect all references (xml files with *.spr or *.spr.gz names)
     :param path_to_folder: Path to folder with references/folders
     :return: list of paths to references
     """
-    folder_items = [os.path.join(path_to_folder, folder) for folder in os.listdir(path_to_folder)]
-    folders = [item for item in folder_items if not os.path.isfile(item)]
-    references = [item for item in folder_items if os.path.isfile(item) and item.split('.')[-1] == "spr"]
+    references = []
+    folders = []
+    with os.scandir(path_to_folder) as folder_items:  # scandir gives file types without an extra stat per item
+        for item in folder_items:
+            if item.is_dir():
+                folders.append(item.path)
+            elif item.is_file() and item.name.endswith(REFERENCE_EXTENSIONS):
+                references.append(item.path)
     for folder in folders:
         references += collect_references(folder)
     return references
 
 
-def update_references(connection, path_to_references = "Справочники") -> None:
+def get_dependencies(xml_dict: dict) -> Set[str]:
+    """
+    Collects names of the tables the reference refers to in its column types like
+    "VARCHAR(3) NOT NULL REFERENCES r_transportation_railroads(code)"
+    :param xml_dict: A reference book in a xml dictionary
+    :return: set of referenced table names
+    """
+    columns = xml_dict["ColumnsList"]["column"]
+    dependencies = set()
+    for column in columns:
+        dependencies.update(REFERENCES_PATTERN.findall(column["type"]))
+    dependencies.discard(xml_dict["rTable"])  # A table referring to itself doesn't have to wait for anything
+    return dependencies
+
+
+def parse_reference(path_to_reference: str) -> dict:
+    """
+    Parses a reference file and prepares everything required to put it into the data base.
+    Runs in worker processes of update_references so it has to return only picklable data
+    :param path_to_reference: Path to a *.spr or *.spr.gz reference
+    :return: dictionary with table name, date, sql queries, values and dependencies of the reference
     """
-    Check if the data base contains all actual references from the path
+    reference = parse_xml11.XmlDict.parse_xml(path_to_reference)["reference"]
+    return {"Table": reference["rTable"],
+            "Date": date_from_string(reference["rDate"]),
+            "TableSQL": create_table_query(reference),
+            "InsertSQL": insert_values_query(reference),
+            "Values": get_query_values(reference),
+            "Dependencies": get_dependencies(reference)}
+
+
+def apply_reference(connection, reference: dict, current_tables: dict) -> None:
+    """
+    Creates or updates the reference table if the reference is newer than the one in the data base
+    :param connection: Connection to the references' data base
+    :param reference: Parsed reference from parse_reference
+    :param current_tables: Dictionary with table names as keys and their updating dates as values, gets updated
+    :return:
+    """
+    cursor = connection.cursor()
+    table = reference["Table"]
+    if table in current_tables:  # If a reference already exists
+        if reference["Date"] <= current_tables[table]:
+            # print("{} is up to date".format(table))
+            return  # Do nothing if the reference is up to date
+        # Update the reference using INSERT OR UPDATE
+        cursor.executemany(reference["InsertSQL"], reference["Values"])
+        connection.commit()
+        cursor.execute("UPDATE table_info SET updating_date='{}' "
+                       "WHERE table_name='{}'".format(reference["Date"], table))
+        connection.commit()
+        # print("{} has been updated".format(table))
+    else:
+        cursor.execute(reference["TableSQL"])
+        cursor.executemany(reference["InsertSQL"], reference["Values"])
+        connection.commit()
+        cursor.execute("INSERT INTO table_info (table_name, updating_date) "
+                       "VALUES ('{}', '{}')".format(table, reference["Date"]))
+        print("{} has been added".format(table))
+        connection.commit()
+    current_tables[table] = reference["Date"]
+
+
+def apply_ready_references(connection, pending: List[dict], current_tables: dict, applied: Set[str],
+                           waiting_for: Optional[Set[str]]) -> List[dict]:
+    """
+    Applies pending references whose dependencies are already applied. Tables from waiting_for may still come from
+    not yet parsed references, so references depending on them stay pending
+    :param connection: Connection to the references' data base
+    :param pending: Parsed references which have not been applied yet
+    :param current_tables: Dictionary with table names as keys and their updating dates as values
+    :param applied: Names of the tables applied during this update, gets updated
+    :param waiting_for: Names of the tables which can not be considered applied yet, None - any table
+    :return: references which are still pending
+    """
+    progress = True
+    while progress:  # Applying one reference can unlock others depending on it
+        progress = False
+        still_pending = []
+        for reference in pending:
+            blockers = [table for table in reference["Dependencies"]
+                        if table not in applied and (waiting_for is None or table in waiting_for)]
+            if len(blockers) == 0:
+                apply_reference(connection, reference, current_tables)
+                applied.add(reference["Table"])
+                progress = True
+            else:
+                still_pending.append(reference)
+        pending = still_pending
+    return pending
+
+
+def update_references(connection, path_to_references = "Справочники", processes: Optional[int] = None) -> None:
+    """
+    Check if the data base contains all actual references from the path.
+    References are parsed in a process pool while the current process applies the finished ones in dependency order:
+    a reference is applied only after the references of the tables it refers to (r_transportation_railroads first)
     :param connection: Connection to the references' data base
     :param path_to_references: Path to a folder with references
+    :param processes: Number of parsing processes, None - number of CPUs, 1 - parse in the current process
     :return:
     """
 
@@ -124,38 +232,33 @@ def update_references(connection, path_to_references = "Справочники")
 
     references = collect_references(path_to_references)
 
-    references = [parse_xml11.XmlDict.parse_xml(reference)["reference"] for reference in references]
-
-    references = {r["rTable"]: {"Date": date_from_string(r["rDate"]),
-                                "TableSQL": create_table_query(r),
-                                "InsertSQL": insert_values_query(r),
-                                "Values": get_query_values(r)}
-                                 for r in references}
-
-    for reference in references:
-        if reference in current_tables:  # If a reference already exists
-            if references[reference]["Date"] <= current_tables[reference]:
-                # print("{} is up to date".format(reference))
-                continue  # Do nothing if the reference is up to date
-            else:  # Update the reference using INSERT OR UPDATE
-                cursor.executemany(references[reference]["InsertSQL"], references[reference]["Values"])
-                connection.commit()
-                cursor.execute("UPDATE table_info SET updating_date='{}' "
-                               "WHERE table_name='{}'".format(references[reference]["Date"], reference))
-                connection.commit()
-                # print("{} has been updated".format(reference))
-        else:
-            cursor.execute(references[reference]["TableSQL"])
-            cursor.executemany(references[reference]["InsertSQL"], references[reference]["Values"])
-            connection.commit()
-            cursor.execute("INSERT INTO table_info (table_name, updating_date) "
-                           "VALUES ('{}', '{}')".format(reference, references[reference]["Date"]))
-            print("{} has been added".format(reference))
-            connection.commit()
+    pending: List[dict] = []
+    applied: Set[str] = set()
+    if processes == 1 or len(references) < 2:  # No sense to start processes for a single reference
+        pending = [parse_reference(reference) for reference in references]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(parse_reference, reference) for reference in references]
+            for future in as_completed(futures):
+                pending.append(future.result())
+                # Until every reference is parsed any referenced table can still come from the bundle
+                pending = apply_ready_references(connection, pending, current_tables, applied, None)
+
+    # Everything is parsed - wait only for the tables which are in the bundle
+    waiting_for = {reference["Table"] for reference in pending}
+    pending = apply_ready_references(connection, pending, current_tables, applied, waiting_for)
+    for reference in pending:  # Circular references - nothing to wait for, apply in any order
+        apply_reference(connection, reference, current_tables)
 
+    applied.update(reference["Table"] for reference in pending)
+    if PART_DISTANCES_TABLE in applied:  # Part positions are derived from the part distances, they aren't exported
+        cursor.executescript(PART_POSITIONS_QUERY)
+        update_part_positions(cursor)
+        connection.commit()
 
 
 if __name__ == "__main__":
+    freeze_support()
     path_to_db = "test.db"
     connection = sqlite3.connect(path_to_db)
 
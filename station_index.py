@@ -0,0 +1,230 @@
+#! -*- encoding: utf-8 -*-
+import re
+import sqlite3
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+
+PUNCTUATION = re.compile(r"[^\w]+")  # Dots, brackets, hyphens, quotes... are spaces in normalized names
+DEFAULT_LIMIT = 10  # Stations returned by prefix and fuzzy lookups
+DEFAULT_MAX_EDITS = 2  # Typos allowed by fuzzy lookup
+
+# Row of a station as it is selected from r_transportation_railroad_stations: (code, name, railroad_code, type,
+# actuality)
+Station = Tuple[str, str, str, str, bool]
+
+
+def normalize_name(name: str) -> str:
+    """
+    Makes station names comparable: "Москва-Пасс. (эксп.)" -> "москва пасс эксп"
+    :param name: Station name
+    :return: Lowercase name with ё as е, punctuation as spaces and single spaces between words
+    """
+    return PUNCTUATION.sub(' ', name.lower().replace('ё', 'е')).strip()
+
+
+def get_trigrams(normalized_name: str) -> Set[str]:
+    """
+    :param normalized_name: Result of normalize_name
+    :return: Set of three letter substrings of the name padded with spaces, so short names have trigrams too
+    """
+    padded = f"  {normalized_name} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(first: str, second: str, max_edits: int) -> int:
+    """
+    Levenshtein distance between strings, only cells of the matrix not farther than max_edits from the diagonal are
+    calculated and the calculation stops when the distance is surely above max_edits
+    :param first: A string
+    :param second: A string
+    :param max_edits: The largest distance of interest
+    :return: Distance between strings or max_edits + 1 if it's larger than max_edits
+    """
+    too_far = max_edits + 1
+    if abs(len(first) - len(second)) > max_edits:
+        return too_far
+    previous = [j if j <= max_edits else too_far for j in range(len(second) + 1)]
+    for i, first_char in enumerate(first, 1):
+        current = [too_far] * (len(second) + 1)
+        current[0] = i if i <= max_edits else too_far
+        row_min = current[0]
+        for j in range(max(1, i - max_edits), min(len(second), i + max_edits) + 1):
+            distance = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (first_char != second[j - 1]))
+            current[j] = distance
+            row_min = min(row_min, distance)
+        if row_min > max_edits:
+            return too_far
+        previous = current
+    return min(previous[-1], too_far)
+
+
+class TrieNode:
+    __slots__ = ("children", "stations")
+
+    def __init__(self):
+        self.children: Dict[str, "TrieNode"] = {}
+        self.stations: List[int] = []  # Stations of the whole subtree, ordered by name
+
+
+class StationIndex:
+    """
+    In-memory index of station names built once from r_transportation_railroad_stations.
+    Names are normalized (see normalize_name), prefixes are looked up in a trie keeping stations of every subtree,
+    typos are tolerated by taking candidates sharing enough trigrams with the name and checking their edit distance.
+    Every lookup can be filtered by railroad code, type (ОП/РП) and actuality.
+    The index doesn't see changes of the table made after it was built
+    """
+    def __init__(self, cursor: sqlite3.Cursor):
+        """
+        Builds the index from the railroads.db
+        :param cursor: cursor to the railroads.db
+        """
+        stations_query = "SELECT code, name, railroad_code, type, actuality FROM r_transportation_railroad_stations"
+        # Railroad codes are strings like the TEXT column compares them, a code may be stored as a number
+        self.stations: List[Station] = sorted(((code, name, str(railroad_code), station_type, bool(actuality))
+                                               for code, name, railroad_code, station_type, actuality
+                                               in cursor.execute(stations_query).fetchall()),
+                                              key=lambda station: (normalize_name(station[1]), station[0]))
+        self.normalized = [normalize_name(station[1]) for station in self.stations]
+
+        self.names: Dict[str, List[int]] = {}  # Name as it is in the table -> stations
+        self.normalized_names: Dict[str, List[int]] = {}
+        self.trie = TrieNode()
+        self.trigrams: Dict[str, List[int]] = {}
+        for number, (station, normalized) in enumerate(zip(self.stations, self.normalized)):
+            self.names.setdefault(station[1], []).append(number)
+            self.normalized_names.setdefault(normalized, []).append(number)
+            node = self.trie
+            node.stations.append(number)
+            for char in normalized:
+                node = node.children.setdefault(char, TrieNode())
+                node.stations.append(number)
+            for trigram in get_trigrams(normalized):
+                self.trigrams.setdefault(trigram, []).append(number)
+
+    def __len__(self) -> int:
+        return len(self.stations)
+
+    def filtered(self, numbers: Iterable[int], railroad_code: Optional[str], station_type: Optional[str],
+                 actual: Optional[bool], limit: Optional[int] = None) -> List[Station]:
+        """
+        :param numbers: Numbers of stations in self.stations
+        :param railroad_code: Code of the railroad of stations, None - any railroad
+        :param station_type: "ОП" or "РП", None - any type
+        :param actual: Actuality of stations, None - any actuality
+        :param limit: The largest number of stations, None - no limit
+        :return: Stations passing the filters in the order of numbers
+        """
+        if railroad_code is not None:  # r_transportation_railroads.code may be INTEGER
+            railroad_code = str(railroad_code)
+        found = []
+        for number in numbers:
+            station = self.stations[number]
+            if (railroad_code is None or station[2] == railroad_code) and \
+                    (station_type is None or station[3] == station_type) and \
+                    (actual is None or station[4] == actual):
+                found.append(station)
+                if limit is not None and len(found) == limit:
+                    break
+        return found
+
+    def exact(self, name: str, railroad_code: Optional[str] = None, station_type: Optional[str] = None,
+              actual: Optional[bool] = None, normalize: bool = True) -> List[Station]:
+        """
+        Searches for stations with the name
+        :param name: Station name
+        :param railroad_code: Code of the railroad of stations, None - any railroad
+        :param station_type: "ОП" or "РП", None - any type
+        :param actual: Actuality of stations, None - any actuality
+        :param normalize: Compare normalized names, False - names exactly as they are in the table
+        :return: List of stations (code, name, railroad_code, type, actuality)
+        """
+        if normalize:
+            numbers = self.normalized_names.get(normalize_name(name), [])
+        else:
+            numbers = self.names.get(name, [])
+        return self.filtered(numbers, railroad_code, station_type, actual)
+
+    def prefix(self, prefix: str, limit: Optional[int] = DEFAULT_LIMIT, railroad_code: Optional[str] = None,
+               station_type: Optional[str] = None, actual: Optional[bool] = None) -> List[Station]:
+        """
+        Searches for stations which names start with the prefix
+        :param prefix: The beginning of a station name
+        :param limit: The largest number of stations, None - no limit
+        :param railroad_code: Code of the railroad of stations, None - any railroad
+        :param station_type: "ОП" or "РП", None - any type
+        :param actual: Actuality of stations, None - any actuality
+        :return: List of stations (code, name, railroad_code, type, actuality) ordered by name
+        """
+        node = self.trie
+        for char in normalize_name(prefix):
+            node = node.children.get(char)
+            if node is None:
+                return []
+        return self.filtered(node.stations, railroad_code, station_type, actual, limit)
+
+    def fuzzy(self, name: str, limit: Optional[int] = DEFAULT_LIMIT, max_edits: int = DEFAULT_MAX_EDITS,
+              railroad_code: Optional[str] = None, station_type: Optional[str] = None,
+              actual: Optional[bool] = None) -> List[Tuple[Station, int]]:
+        """
+        Searches for stations which names differ from the name by max_edits typos at most
+        An edit changes at most three trigrams of a name, so only stations sharing enough trigrams are checked
+        :param name: Station name with possible typos
+        :param limit: The largest number of stations, None - no limit
+        :param max_edits: The largest number of inserted, deleted or replaced letters
+        :param railroad_code: Code of the railroad of stations, None - any railroad
+        :param station_type: "ОП" or "РП", None - any type
+        :param actual: Actuality of stations, None - any actuality
+        :return: List of tuples with station and number of typos, the closest names first
+        """
+        normalized = normalize_name(name)
+        trigrams = get_trigrams(normalized)
+        least_shared = max(len(trigrams) - 3 * max_edits, 1)
+
+        # A name sharing least_shared trigrams has one of any len(trigrams) - least_shared + 1 of them, so only
+        # the rarest trigrams are looked up and shared trigrams are counted for the found names only
+        rarest = sorted(trigrams, key=lambda trigram: len(self.trigrams.get(trigram, ())))
+        shared: Dict[int, int] = {}
+        for trigram in rarest[:len(trigrams) - least_shared + 1]:
+            for number in self.trigrams.get(trigram, []):
+                if number not in shared:
+                    shared[number] = len(trigrams & get_trigrams(self.normalized[number]))
+
+        # Candidates sharing more trigrams are checked first. A name sharing n trigrams has at least
+        # (len(trigrams) - n) / 3 typos, so the check stops when the rest can't get into the closest names
+        candidates = []
+        for number, shared_number in sorted(shared.items(), key=lambda item: -item[1]):
+            if shared_number < least_shared:
+                break
+            least_edits = (len(trigrams) - shared_number + 2) // 3
+            if limit is not None and len(candidates) >= limit and \
+                    sum(1 for found in candidates if found[:2] < (least_edits, -shared_number)) >= limit:
+                break
+            if self.filtered((number, ), railroad_code, station_type, actual):
+                edits = edit_distance(normalized, self.normalized[number], max_edits)
+                if edits <= max_edits:
+                    candidates.append((edits, -shared_number, number))
+        candidates.sort()
+        if limit is not None:
+            candidates = candidates[:limit]
+        return [(self.stations[number], edits) for edits, _, number in candidates]
+
+    def search(self, text: str, limit: Optional[int] = DEFAULT_LIMIT, railroad_code: Optional[str] = None,
+               station_type: Optional[str] = None, actual: Optional[bool] = None) -> List[Station]:
+        """
+        Searches for stations like a user expects: exact matches first, then names starting with the text.
+        Names with typos are searched only if nothing of them is found
+        :param text: Station name or its beginning typed by a user
+        :param limit: The largest number of stations, None - no limit
+        :param railroad_code: Code of the railroad of stations, None - any railroad
+        :param station_type: "ОП" or "РП", None - any type
+        :param actual: Actuality of stations, None - any actuality
+        :return: List of stations (code, name, railroad_code, type, actuality)
+        """
+        found = self.exact(text, railroad_code, station_type, actual)
+        found += self.prefix(text, None if limit is None else limit + len(found), railroad_code, station_type, actual)
+        if len(found) == 0:  # Only a name with typos doesn't match anything
+            found = [station for station, _ in self.fuzzy(text, limit, DEFAULT_MAX_EDITS, railroad_code,
+                                                          station_type, actual)]
+        unique = list(dict.fromkeys(found))  # Keeps the first position of every station
+        return unique if limit is None else unique[:limit]
@@ -0,0 +1,140 @@
+#! -*- encoding: utf-8 -*-
+import heapq
+import sqlite3
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+from distance_calculator import (is_station_exists, get_distances_to_tp, get_transit_vector, same_part_distances,
+                                 get_all_distances_to_tp)
+from table_generating import format_station_code
+
+
+FIXED_LIST = ''  # Heap key of the fixed distances list, no transit point has such code
+
+
+class OperationStationIndex:
+    """
+    In-memory index for searching the nearest stations supporting an operation (r_transportation_station_operations).
+    Keeps stations of every operation and, for every operation and transit point, stations supporting the operation
+    connected to the transit point sorted by the distance.
+    A search walks these sorted lists from the closest stations and stops as soon as enough stations are found,
+    so distances to the far candidates are never calculated.
+    Distances are the same calculate_travel_distance returns
+    """
+    def __init__(self, cursor: sqlite3.Cursor):
+        """
+        Builds the index from the railroads.db
+        :param cursor: cursor to the railroads.db
+        """
+        operations_query = "SELECT station_code, operation_code FROM r_transportation_station_operations"
+        self.operation_stations: Dict[str, Set[str]] = {}
+        station_operations: Dict[str, Set[str]] = {}
+        for station_code, operation_code in cursor.execute(operations_query).fetchall():
+            self.operation_stations.setdefault(operation_code, set()).add(station_code)
+            station_operations.setdefault(station_code, set()).add(operation_code)
+
+        # Operation -> transit point -> [(distance, station code)], stations without the operation aren't in the lists,
+        # so a search never walks past them
+        self.tp_stations: Dict[str, Dict[str, List[Tuple[int, str]]]] = {}
+        for station_code, transit_points in get_all_distances_to_tp(cursor).items():
+            for operation_code in station_operations.get(station_code, ()):
+                operation_tp_stations = self.tp_stations.setdefault(operation_code, {})
+                for transit_point, distance in transit_points:
+                    operation_tp_stations.setdefault(transit_point, []).append((distance, station_code))
+        for operation_tp_stations in self.tp_stations.values():
+            for tp_stations in operation_tp_stations.values():
+                tp_stations.sort()
+
+    def iter_nearest(self, cursor: sqlite3.Cursor, code_from: str, operation: str) -> Iterator[Tuple[str, int]]:
+        """
+        Generates stations supporting the operation in ascending order of the distance from the given station.
+        Not connected stations are not generated
+        :param cursor: cursor to the railroads.db
+        :param code_from: Station code in r_transportation_railroad_stations or Kniga_2...xls
+        :param operation: Operation code from r_transportation_operations
+        :return: Generator of tuples with station code and distance to it
+        """
+        if not is_station_exists(cursor, code_from):
+            print(f"  Station with code {code_from} does not exist in database")
+            return
+        stations = self.operation_stations.get(operation, set())
+        if len(stations) == 0:
+            return
+        operation_tp_stations = self.tp_stations.get(operation, {})
+
+        # Direct transit distances and same part distances have the priority over distances through transit points
+        direct_query = "SELECT code_to, transit_distance FROM r_transportation_transit_distances WHERE code_from = (?)"
+        fixed = same_part_distances(cursor, code_from)
+        for code, distance in cursor.execute(direct_query, (code_from, )).fetchall():
+            fixed[format_station_code(code)] = distance
+        fixed[code_from] = 0
+        fixed_list = sorted((distance, code) for code, distance in fixed.items() if code in stations)
+
+        vector = get_transit_vector(cursor, get_distances_to_tp(cursor, code_from))
+
+        # Heap of the next candidates of every sorted list: (distance, station code, transit point, position)
+        # transit point FIXED_LIST is the list of fixed distances
+        heap = []
+        if len(fixed_list) != 0:
+            heap.append((fixed_list[0][0], fixed_list[0][1], FIXED_LIST, 0))
+        for transit_point, transit_distance in vector.items():
+            tp_stations = operation_tp_stations.get(transit_point)
+            if tp_stations is not None:
+                heap.append((transit_distance + tp_stations[0][0], tp_stations[0][1], transit_point, 0))
+        heapq.heapify(heap)
+
+        found = set()
+        while len(heap) != 0:
+            distance, station_code, transit_point, position = heapq.heappop(heap)
+            if transit_point == FIXED_LIST:
+                candidates = fixed_list
+                if position + 1 < len(candidates):
+                    next_distance, next_code = candidates[position + 1]
+                    heapq.heappush(heap, (next_distance, next_code, FIXED_LIST, position + 1))
+            else:
+                candidates = operation_tp_stations[transit_point]
+                if position + 1 < len(candidates):
+                    next_distance = vector[transit_point] + candidates[position + 1][0]
+                    heapq.heappush(heap, (next_distance, candidates[position + 1][1], transit_point, position + 1))
+                if station_code in fixed:  # The distance through transit points isn't used for such stations
+                    continue
+
+            # The first time a station comes out of the heap it comes with its shortest distance
+            if station_code in found or station_code not in stations:
+                continue
+            found.add(station_code)
+            yield station_code, distance
+
+    def nearest(self, cursor: sqlite3.Cursor, code_from: str, operation: str, k: int) -> List[Tuple[str, int]]:
+        """
+        Searches for k nearest stations supporting the operation
+        :param cursor: cursor to the railroads.db
+        :param code_from: Station code in r_transportation_railroad_stations or Kniga_2...xls
+        :param operation: Operation code from r_transportation_operations
+        :param k: Number of stations to find
+        :return: List of tuples with station code and distance to it, the nearest first
+        """
+        found = []
+        if k <= 0:
+            return found
+        for station_code, distance in self.iter_nearest(cursor, code_from, operation):
+            found.append((station_code, distance))
+            if len(found) == k:
+                break
+        return found
+
+    def within(self, cursor: sqlite3.Cursor, code_from: str, operation: str,
+               radius: int, k: Optional[int] = None) -> List[Tuple[str, int]]:
+        """
+        Searches for stations supporting the operation not farther than the radius
+        :param cursor: cursor to the railroads.db
+        :param code_from: Station code in r_transportation_railroad_stations or Kniga_2...xls
+        :param operation: Operation code from r_transportation_operations
+        :param radius: The largest distance in km
+        :param k: The largest number of stations to find, None - no limit
+        :return: List of tuples with station code and distance to it, the nearest first
+        """
+        found = []
+        for station_code, distance in self.iter_nearest(cursor, code_from, operation):
+            if distance > radius or (k is not None and len(found) == k):
+                break
+            found.append((station_code, distance))
+        return found
@@ -0,0 +1,339 @@
+#! -*- encoding: utf-8 -*-
+import bisect
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+from typing import Dict, List, Optional, Tuple
+import pandas as pd
+from import_report import STAGE_POSITIONS, STAGE_REFERENCES, ImportReport, stage
+from kniga_1_reader import insert_railroad_parts
+from kniga_2_reader import BIG_TYPE_CODE, SMALL_TYPE_CODE, insert_stations_info
+from kniga_3_reader import insert_transit_distances as insert_kniga3_distances
+from railroad_parser import write_reference
+from references import update_references
+from station_index import StationIndex
+from table_generating import PART_POSITIONS_TABLE, create_tables, update_part_positions
+
+
+HELP = """
+  This script generates a synthetic railroad network and writes it
+  as Kniga_1_...xlsx, Kniga_2_...xlsx, Kniga_3_...xlsx and references
+  (Справочники/tp0003.spr, Справочники/tp0005.spr) to the given folder,
+  so the import and the calculator can be checked without РЖД books
+  Optional arguments: number of railroads, number of parts of a railroad,
+  number of stations of a part, depth of branches and seed of the random
+  generator. With --database flag railroads.db of the network is built
+  in the folder without the books
+  Example: D:\\work\\MyPyProjects\\railroads>synthetic_network.exe synthetic 10 20 8 2 1
+
+  Этот скрипт генерирует синтетическую железнодорожную сеть и сохраняет
+  ее в виде Kniga_1_...xlsx, Kniga_2_...xlsx, Kniga_3_...xlsx и справочников
+  (Справочники/tp0003.spr, Справочники/tp0005.spr) в указанную папку,
+  чтобы проверять импорт и расчет расстояний без книг РЖД
+  Необязательные аргументы: число железных дорог, число участков дороги,
+  число станций участка, глубина ответвлений и начальное значение
+  генератора случайных чисел. С флагом --database в папке создается
+  railroads.db сети без книг
+  Example: D:\\work\\MyPyProjects\\railroads>synthetic_network.exe synthetic 10 20 8 2 1
+  """
+
+BOOKS_DATE = "2019-10-09"  # Date in names of the generated books
+OPERATION_CODES = ("1", "3", "4", "6", "8", "8н", "9", "10", "10н")
+RAILROAD_LENGTH = 1000  # Kilometers between the first transit points of two neighbour railroads
+NAN = float("nan")  # Empty cell of a worksheet
+
+
+def generate_network(railroads: int = 3, parts: int = 6, stations: int = 5, branch_depth: int = 1,
+                     seed: int = 1) -> dict:
+    """
+    Generates a network of railroads lying one after another on a line. Every railroad is a chain of regular parts
+    between transit points (ТП), every part has big (РП) and small (ОП) stations between its transit points,
+    every second part has an irregular part - a branch of small stations from one of its stations, the last station
+    of a branch starts the next branch up to branch_depth branches
+    :param railroads: Number of railroads
+    :param parts: Number of regular parts of every railroad (transit points density)
+    :param stations: Number of stations between transit points of every regular part
+    :param branch_depth: Number of branches starting one from another, 0 - no branches
+    :param seed: Seed of the random generator, the same seed gives the same network
+    :return: Dictionary with "railroads" - list of (code, name, sname), "stations" - dictionary with station codes as
+    keys and dictionaries with name, railroad, type, position (km from the start of the line) and operations as values,
+    "parts" - list of dictionaries with code, name, railroad, regular flag and list of station codes (transit points
+    first and last for regular parts, main station first for irregular parts), "branch_distances" - dictionary with
+    branch station codes as keys and distances to the main station of the branch as values
+    """
+    generator = random.Random(seed)
+    network = {"railroads": [], "stations": {}, "parts": [], "branch_distances": {}}
+    part_length = (RAILROAD_LENGTH - 1) // max(parts, 1)  # Transit points of neighbour railroads never coincide
+    if part_length <= stations:
+        print(f"  {stations} stations don't fit a part of {part_length}km, use less parts or stations")
+        exit(-1)
+
+    for railroad_index in range(railroads):
+        railroad_code = str(10 + railroad_index)
+        network["railroads"].append((railroad_code, f"Дорога {railroad_code}", f"Дор{railroad_code}"))
+        numbers = iter(range(1, 10000))
+
+        def add_station(station_type: str, position: int) -> str:
+            code = f"{railroad_code}{next(numbers):04d}"
+            operations = generator.sample(OPERATION_CODES, generator.randint(1, 4))
+            network["stations"][code] = {"name": f"Станция {code}", "railroad": railroad_code, "type": station_type,
+                                         "position": position, "operations": operations}
+            return code
+
+        def add_part(name: str, regular: bool, part_stations: List[str]) -> None:
+            network["parts"].append({"code": f"{railroad_code}-{len(network['parts']) + 1:03d}", "name": name,
+                                     "railroad": railroad_code, "regular": regular, "stations": part_stations})
+
+        start = railroad_index * RAILROAD_LENGTH
+        transit_points = [add_station("ТП", start + part_length * part_index) for part_index in range(parts + 1)]
+        for part_index in range(parts):
+            first_position = start + part_length * part_index
+            positions = sorted(generator.sample(range(first_position + 1, first_position + part_length), stations))
+            part_stations = [add_station(generator.choice(("РП", "ОП")), position) for position in positions]
+            add_part(f"ПЕРЕГОН {part_index + 1}", True,
+                     [transit_points[part_index]] + part_stations + [transit_points[part_index + 1]])
+
+            if part_index % 2 == 1 and stations != 0:  # Branches of small stations from a station of the part
+                main_station = generator.choice(part_stations)
+                for depth in range(branch_depth):
+                    position = network["stations"][main_station]["position"]
+                    branch = [add_station("ОП", position) for _ in range(generator.randint(1, max(stations, 1)))]
+                    distance = 0
+                    for station_code in branch:
+                        distance += generator.randint(3, 30)
+                        network["branch_distances"][station_code] = distance
+                    add_part(f"ВЕТКА {part_index + 1}-{depth + 1}", False, [main_station] + branch)
+                    main_station = branch[-1]
+    return network
+
+
+def get_transit_points(network: dict, railroad_code: Optional[str] = None) -> List[str]:
+    """
+    :param network: Result of generate_network
+    :param railroad_code: Code of the railroad, None - all railroads
+    :return: Codes of transit points ordered by position
+    """
+    transit_points = [code for code, station in network["stations"].items() if station["type"] == "ТП" and
+                      (railroad_code is None or station["railroad"] == railroad_code)]
+    return sorted(transit_points, key=lambda code: network["stations"][code]["position"])
+
+
+def get_distance(network: dict, code_from: str, code_to: str) -> int:
+    return abs(network["stations"][code_from]["position"] - network["stations"][code_to]["position"])
+
+
+def get_kniga1_sheets(network: dict) -> Dict[str, pd.DataFrame]:
+    """
+    Makes worksheets of Kniga_1...xls with railroad parts of the network: a worksheet for every railroad with parts
+    starting from the 7th row, every part is a label, a header and station rows followed by an empty row
+    :param network: Result of generate_network
+    :return: Dictionary with worksheet names as keys and worksheets as values
+    """
+    sheets = {"Общие положения": pd.DataFrame([["Общие положения"]])}
+    for railroad_code, _, sname in network["railroads"]:
+        rows: List[list] = [[f"Железная дорога {railroad_code}"] + [NAN] * 5] + [[NAN] * 6] * 5
+        railroad_parts = [part for part in network["parts"] if part["railroad"] == railroad_code]
+        for part_number, part in enumerate(railroad_parts, 1):
+            stations = part["stations"]
+            rows.append([f"{part_number}) участок {part['code']} \"{part['name']}\" (Основной тарифный участок)"] +
+                        [NAN] * 5)
+            if part["regular"]:
+                first, last = stations[0], stations[-1]
+                rows.append(["№ п/п", "Коды", "от станции", f"до ст. {network['stations'][first]['name']}",
+                             f"до ст. {network['stations'][last]['name']}", NAN])
+                for number, station_code in enumerate(stations, 1):
+                    rows.append([f" {number}.", f"{station_code} .", network["stations"][station_code]["name"],
+                                 f" {get_distance(network, station_code, first)} км",
+                                 f" {get_distance(network, station_code, last)} км", NAN])
+            else:
+                main_station = stations[0]
+                rows.append(["№ п/п", "Коды", "от станции", f"до ст. {network['stations'][main_station]['name']}",
+                             "до ст. ТП 1", "до ст. ТП 2"])
+                for number, station_code in enumerate(stations, 1):
+                    distance = network["branch_distances"].get(station_code, 0) if number > 1 else 0
+                    rows.append([f" {number}.", f"{station_code} .", network["stations"][station_code]["name"],
+                                 f" {distance} км", f" {distance} км", f" {distance} км"])
+            rows.append([NAN] * 6)
+        rows.append(["_" * 20] + [NAN] * 5)
+        sheets[sname] = pd.DataFrame(rows)
+    return sheets
+
+
+def get_transit_cell(network: dict, station_code: str, transit_points: List[str], positions: List[int]) -> str:
+    """
+    :param network: Result of generate_network
+    :param station_code: Code of a big station or a transit point
+    :param transit_points: Codes of all transit points ordered by position
+    :param positions: Positions of the transit points
+    :return: Transit distances cell of the "РП" worksheet: "ТП" for transit points or distances to the closest ones
+    """
+    if network["stations"][station_code]["type"] == "ТП":
+        return "ТП"
+    after = bisect.bisect(positions, network["stations"][station_code]["position"])
+    return ", ".join(f"{code} {network['stations'][code]['name']} - {get_distance(network, station_code, code)}км"
+                     for code in transit_points[after - 1: after + 1])
+
+
+def get_kniga2_sheets(network: dict) -> Dict[str, pd.DataFrame]:
+    """
+    Makes worksheets of Kniga_2...xls with stations of the network: "ОП" worksheet with small stations and "РП"
+    worksheet with big stations and transit points
+    :param network: Result of generate_network
+    :return: Dictionary with worksheet names as keys and worksheets as values
+    """
+    transit_points = get_transit_points(network)
+    positions = [network["stations"][code]["position"] for code in transit_points]
+    small_rows: List[list] = [["Среда 09 окт.2019г.  17:59"] + [NAN] * 4,
+                              ["№ п/п", "Станция", "Операции", "Дорога", "Код"]]
+    big_rows: List[list] = [["Среда 09 окт.2019г.  17:59"] + [NAN] * 5,
+                            ["№ п/п", "Станция", "Операции", "Дорога", "Транзитные пункты", "Код"]]
+    sname_by_code = {railroad_code: sname for railroad_code, _, sname in network["railroads"]}
+    for station_code, station in sorted(network["stations"].items(), key=lambda item: item[1]["name"]):
+        operations = ", ".join(station["operations"])
+        railroad_cell = f"{station['railroad']} {sname_by_code[station['railroad']]}"
+        if station["type"] == "ОП":
+            small_rows.append([f" {len(small_rows) - 1}.", station["name"], operations, railroad_cell, station_code])
+        else:
+            big_rows.append([f" {len(big_rows) - 1}.", station["name"], operations, railroad_cell,
+                             get_transit_cell(network, station_code, transit_points, positions), station_code])
+    small_rows.append(["_" * 20] + [NAN] * 4)
+    big_rows.append(["_" * 20] + [NAN] * 5)
+    return {"ОП": pd.DataFrame(small_rows), "РП": pd.DataFrame(big_rows)}
+
+
+def get_kniga3_sheets(network: dict) -> Dict[str, pd.DataFrame]:
+    """
+    Makes worksheets of Kniga_3...xls with transit distances of the network: a worksheet for every railroad with its
+    transit points as rows and all transit points of the network as columns (with the railroad in brackets for
+    transit points of other railroads)
+    :param network: Result of generate_network
+    :return: Dictionary with worksheet names as keys and worksheets as values
+    """
+    all_transit_points = get_transit_points(network)
+    sname_by_code = {railroad_code: sname for railroad_code, _, sname in network["railroads"]}
+    sheets = {"Общие положения": pd.DataFrame([["Общие положения"]])}
+    for railroad_code, _, sname in network["railroads"]:
+        column_names = []
+        for code in all_transit_points:
+            station = network["stations"][code]
+            if station["railroad"] == railroad_code:
+                column_names.append(station["name"])
+            else:
+                railroad_cell = f"{station['railroad']} {sname_by_code[station['railroad']]}"
+                column_names.append(f"{station['name']} ({railroad_cell})")
+        width = len(all_transit_points) + 2
+        rows: List[list] = [[f"Таблица расстояний {sname}"] + [NAN] * (width - 1),
+                            [NAN, NAN] + column_names,
+                            ["№ п/п"] + [NAN] * (width - 1)]
+        for number, code in enumerate(get_transit_points(network, railroad_code), 1):
+            rows.append([f" {number}.", network["stations"][code]["name"]] +
+                        [str(get_distance(network, code, column_code)) for column_code in all_transit_points])
+        sheets[sname] = pd.DataFrame(rows)
+    return sheets
+
+
+def write_workbook(sheets: Dict[str, pd.DataFrame], path: str) -> None:
+    """
+    Writes worksheets to the .xlsx file without headers and indexes like РЖД books are read
+    :param sheets: Dictionary with worksheet names as keys and worksheets as values
+    :param path: Path to the .xlsx file
+    :return: None
+    """
+    with pd.ExcelWriter(path) as writer:
+        for sheet_name, sheet in sheets.items():
+            sheet.to_excel(writer, sheet_name=sheet_name, header=False, index=False)
+
+
+def write_references(network: dict, path_to_references: str) -> None:
+    """
+    Writes references of railroads (tp0003.spr) and operations (tp0005.spr) required by the import
+    :param network: Result of generate_network
+    :param path_to_references: Path to the folder with references, created if doesn't exist
+    :return: None
+    """
+    os.makedirs(path_to_references, exist_ok=True)
+    railroads = {"code": [railroad[0] for railroad in network["railroads"]],
+                 "name": [railroad[1] for railroad in network["railroads"]],
+                 "sname": [railroad[2] for railroad in network["railroads"]]}
+    columns = {"code": {"type": "VARCHAR(3)", "caption": ''}, "name": {"type": "VARCHAR(100)", "caption": ''},
+               "sname": {"type": "VARCHAR(10)", "caption": ''}}
+    write_reference(railroads, columns, os.path.join(path_to_references, "tp0003.spr"), "r_transportation_railroads")
+    operations = {"code": list(OPERATION_CODES), "name": [f"Операция {code}" for code in OPERATION_CODES]}
+    columns = {"code": {"type": "VARCHAR(3)", "caption": ''}, "name": {"type": "VARCHAR(100)", "caption": ''}}
+    write_reference(operations, columns, os.path.join(path_to_references, "tp0005.spr"), "r_transportation_operations")
+
+
+def generate_books(folder: str, network: dict) -> Tuple[str, str, str, str]:
+    """
+    Writes all three books and references of the network to the folder
+    :param folder: Path to the folder, created if doesn't exist
+    :param network: Result of generate_network
+    :return: Paths to Kniga_1, Kniga_2, Kniga_3 and the references folder
+    """
+    os.makedirs(folder, exist_ok=True)
+    paths = tuple(os.path.join(folder, f"Kniga_{number}_{BOOKS_DATE}.xlsx") for number in (1, 2, 3))
+    write_workbook(get_kniga1_sheets(network), paths[0])
+    write_workbook(get_kniga2_sheets(network), paths[1])
+    write_workbook(get_kniga3_sheets(network), paths[2])
+    path_to_references = os.path.join(folder, "Справочники")
+    write_references(network, path_to_references)
+    return paths[0], paths[1], paths[2], path_to_references
+
+
+def build_database(path_to_database: str, network: dict, compact: bool = False, symmetric: bool = False,
+                   report: Optional[ImportReport] = None) -> None:
+    """
+    Builds railroads.db of the network without writing books: the worksheets are passed straight to the readers,
+    so the database is the same the import of generate_books result creates (except VACUUM)
+    :param path_to_database: Path to the database, should not exist or contain another network
+    :param network: Result of generate_network
+    :param compact: Use the compact layout of the distance tables, see create_tables
+    :param symmetric: Use the symmetric layout of the transit distances, see create_tables
+    :param report: Import report to add stages to, None - not measured
+    :return: None
+    """
+    connection = sqlite3.connect(path_to_database)
+    cursor = connection.cursor()
+    with tempfile.TemporaryDirectory() as path_to_references:
+        write_references(network, path_to_references)
+        with stage(report, STAGE_REFERENCES):
+            update_references(connection, path_to_references, processes=1)
+    create_tables(cursor, compact, symmetric)
+
+    kniga2_sheets = get_kniga2_sheets(network)
+    for station_type in (SMALL_TYPE_CODE, BIG_TYPE_CODE):
+        insert_stations_info(cursor, kniga2_sheets[station_type], station_type, report)
+    for sheet_name, sheet in get_kniga1_sheets(network).items():
+        if sheet_name != "Общие положения":
+            insert_railroad_parts(cursor, sheet, report, sheet_name)
+    with stage(report, STAGE_POSITIONS, "Kniga_1") as positions:
+        update_part_positions(cursor)
+        positions["rows"] = cursor.execute(f"SELECT COUNT(*) FROM {PART_POSITIONS_TABLE}").fetchone()[0]
+    index = StationIndex(cursor)
+    for sheet_name, sheet in get_kniga3_sheets(network).items():
+        if sheet_name != "Общие положения":
+            insert_kniga3_distances(cursor, sheet, sheet_name, report, sheet_name, index)
+    connection.commit()
+    connection.close()
+
+
+if __name__ == "__main__":
+    arguments = [argument for argument in sys.argv[1:] if argument != "--database"]
+    if len(arguments) == 0 or arguments[0] == "--help":
+        print(HELP)
+    else:
+        if not all(argument.isdigit() for argument in arguments[1:6]):
+            print("\n  Wrong arguments. Run script with --help flag to learn more")
+            exit(-1)
+        numbers = [int(argument) for argument in arguments[1:6]]
+        defaults = [3, 6, 5, 1, 1]  # Railroads, parts, stations, branch depth, seed
+        synthetic_network = generate_network(*(numbers + defaults[len(numbers):]))
+        if "--database" in sys.argv:
+            os.makedirs(arguments[0], exist_ok=True)
+            build_database(os.path.join(arguments[0], "railroads.db"), synthetic_network)
+            print(os.path.join(arguments[0], "railroads.db"))
+        else:
+            print("\n".join(generate_books(arguments[0], synthetic_network)))
+        print(f"{len(synthetic_network['stations'])} stations, {len(synthetic_network['parts'])} parts")
@@ -1,8 +1,284 @@
 #! -*- encoding: utf-8 -*-
+from contextlib import contextmanager
 import sqlite3
+import sys
+from typing import Iterator, Union
 
 
-def create_tables(cursor: sqlite3.Cursor):
+TRANSIT_DISTANCES_TABLE = "r_transportation_transit_distances"
+TRANSIT_PAIRS_TABLE = "r_transportation_transit_pairs"
+PART_DISTANCES_TABLE = "r_transportation_railroad_part_distances"
+PART_POSITIONS_TABLE = "r_transportation_railroad_part_positions"
+
+# Compact layout of the distance tables stores station codes as INTEGER ("060904" -> 60904) in WITHOUT ROWID tables
+# clustered on (code_from, code_to), so there are no separate unique indexes duplicating the codes.
+# Queries still pass codes as strings: a string like '060904' compared with an INTEGER column is converted to a number.
+# Codes read from the compact tables are integers and should be passed through format_station_code.
+# Columns don't have REFERENCES to the text station codes because an integer never matches a text parent key.
+COMPACT_TRANSIT_DISTANCES_QUERY = """
+    CREATE TABLE IF NOT EXISTS [r_transportation_transit_distances](  -- Table of distances between stations to transit points / transit points
+        [code_from] INTEGER NOT NULL,
+        [code_to] INTEGER NOT NULL,
+        [transit_distance] INTEGER,
+        PRIMARY KEY ([code_from], [code_to])) WITHOUT ROWID;"""
+
+COMPACT_PART_DISTANCES_QUERY = """
+    CREATE TABLE IF NOT EXISTS [r_transportation_railroad_part_distances](  -- Table of distances between two stations of one railroad part
+        [part_code] VARCHAR(6) REFERENCES r_transportation_railroad_parts([code]) ON DELETE CASCADE,
+        [code_from] INTEGER NOT NULL,
+        [code_to] INTEGER NOT NULL,
+        [distance_between_stations] INTEGER,
+        PRIMARY KEY ([code_from], [code_to])) WITHOUT ROWID;"""
+
+# Symmetric layout of the transit distances stores each unordered pair of stations once (code_from <= code_to) in
+# r_transportation_transit_pairs. r_transportation_transit_distances becomes a view returning both directions, so
+# SELECTs don't change, and inserts into the view are normalised by the trigger.
+# Lookups by code_to of the view are served by the reverse index.
+TRANSIT_PAIRS_QUERY = """
+    CREATE TABLE IF NOT EXISTS [r_transportation_transit_pairs](  -- Table of transit distances, one row per pair of stations
+        [code_from] VARCHAR(6) REFERENCES r_transportation_railroad_stations([code]) ON DELETE CASCADE, 
+        [code_to] VARCHAR(6) REFERENCES r_transportation_railroad_stations([code]) ON DELETE CASCADE, 
+        [transit_distance] INTEGER,
+        CHECK ([code_from] <= [code_to]));
+    CREATE UNIQUE INDEX IF NOT EXISTS [duplicate_preventing_transit_pairs]  -- Index preventing adding duplicates of distance between the same stations
+    ON [r_transportation_transit_pairs](
+    [code_from],  
+    [code_to]);
+    CREATE INDEX IF NOT EXISTS [reverse_transit_pairs]  -- Index for lookups of the second station of a pair
+    ON [r_transportation_transit_pairs]([code_to]);"""
+
+COMPACT_TRANSIT_PAIRS_QUERY = """
+    CREATE TABLE IF NOT EXISTS [r_transportation_transit_pairs](  -- Table of transit distances, one row per pair of stations
+        [code_from] INTEGER NOT NULL,
+        [code_to] INTEGER NOT NULL,
+        [transit_distance] INTEGER,
+        CHECK ([code_from] <= [code_to]),
+        PRIMARY KEY ([code_from], [code_to])) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS [reverse_transit_pairs]  -- Index for lookups of the second station of a pair
+    ON [r_transportation_transit_pairs]([code_to]);"""
+
+TRANSIT_VIEW_QUERY = """
+    CREATE VIEW IF NOT EXISTS [r_transportation_transit_distances] AS  -- Both directions of every stored pair
+    SELECT code_from, code_to, transit_distance FROM r_transportation_transit_pairs
+    UNION ALL
+    SELECT code_to, code_from, transit_distance FROM r_transportation_transit_pairs WHERE code_from != code_to;
+    CREATE TRIGGER IF NOT EXISTS [transit_pairs_insert]  -- Stores inserted distance under the normalised pair
+    INSTEAD OF INSERT ON [r_transportation_transit_distances]
+    BEGIN
+        INSERT OR REPLACE INTO r_transportation_transit_pairs (code_from, code_to, transit_distance)
+        VALUES (MIN(NEW.code_from, NEW.code_to), MAX(NEW.code_from, NEW.code_to), NEW.transit_distance);
+    END;"""
+
+# Part positions are derived from r_transportation_railroad_part_distances after Kniga_1 import: one row per station and
+# railroad part with the station's first distance row in the part (the smallest code_to, it's the part origin).
+# Same part check becomes an intersection of station's parts and the distance becomes |offset_a - offset_b|.
+# rows_number keeps the number of distance rows the station has in the part to follow same_part_stations_distance.
+PART_POSITIONS_QUERY = """
+    CREATE TABLE IF NOT EXISTS [r_transportation_railroad_part_positions](  -- Table of station positions on railroad parts
+        [station_code] VARCHAR(6) NOT NULL,
+        [part_code] VARCHAR(6) REFERENCES r_transportation_railroad_parts([code]) ON DELETE CASCADE NOT NULL,
+        [origin_code] VARCHAR(6) NOT NULL,
+        [origin_offset] INTEGER,
+        [rows_number] INTEGER NOT NULL,
+        PRIMARY KEY ([station_code], [part_code])) WITHOUT ROWID;"""
+
+
+def format_station_code(code: Union[str, int]) -> str:
+    """
+    Returns a station code as 6-digit string. Compact distance tables return codes as integers: 60904 -> "060904"
+    :param code: Station code from any of the tables
+    :return: 6-digit station code
+    """
+    if type(code) is int:
+        return "%06d" % code
+    return code
+
+
+def is_compact_layout(cursor: sqlite3.Cursor, table_name: str = TRANSIT_DISTANCES_TABLE) -> bool:
+    """
+    Checks if the distance table stores station codes as integers (compact layout)
+    :param cursor: cursor to the railroads.db
+    :param table_name: name of the distance table
+    :return: True if the table exists and has the compact layout
+    """
+    columns_info = cursor.execute(f"PRAGMA table_info({table_name})").fetchall()
+    for column_info in columns_info:
+        if column_info[1] == "code_from":
+            return column_info[2] == "INTEGER"
+    return False
+
+
+def is_symmetric_layout(cursor: sqlite3.Cursor) -> bool:
+    """
+    Checks if transit distances are stored once per pair of stations (symmetric layout)
+    :param cursor: cursor to the railroads.db
+    :return: True if r_transportation_transit_distances is a view over r_transportation_transit_pairs
+    """
+    return object_exists(cursor, TRANSIT_DISTANCES_TABLE, "view")
+
+
+def object_exists(cursor: sqlite3.Cursor, name: str, object_type: str = "table") -> bool:
+    """
+    Checks if the database contains a table/view/index with the given name
+    :param cursor: cursor to the railroads.db
+    :param name: name of the table/view/index
+    :param object_type: "table", "view" or "index"
+    :return: True if exists
+    """
+    exists_query = "SELECT name FROM sqlite_master WHERE type = (?) AND name = (?)"
+    return len(cursor.execute(exists_query, (object_type, name)).fetchall()) != 0
+
+
+def execute_statements(cursor: sqlite3.Cursor, script: str) -> None:
+    """
+    Executes statements of the script one by one. Unlike executescript it doesn't commit, so the statements stay in
+    the current transaction
+    :param cursor: cursor to the railroads.db
+    :param script: SQL statements separated by ;
+    :return: None
+    """
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):  # Knows about ; inside of triggers
+            cursor.execute(statement)
+            statement = ''
+    if statement.strip() != '':
+        cursor.execute(statement)
+
+
+@contextmanager
+def transaction(cursor: sqlite3.Cursor) -> Iterator[sqlite3.Cursor]:
+    """
+    Runs statements of the block in one transaction: committed if the block finishes, rolled back if it raises.
+    If the connection is in a transaction already the block just becomes a part of it
+    :param cursor: cursor to the railroads.db
+    :return: Context manager with the cursor
+    """
+    connection = cursor.connection
+    if connection.in_transaction:
+        yield cursor
+        return
+    cursor.execute("BEGIN")
+    try:
+        yield cursor
+    except BaseException:
+        connection.rollback()
+        raise
+    connection.commit()
+
+
+def migrate_to_compact(cursor: sqlite3.Cursor) -> None:
+    """
+    Moves data of the distance tables from the text layout to the compact layout. Tables which don't exist
+    or already are compact are skipped. The migration is one transaction, so a crash leaves the text layout
+    :param cursor: cursor to the railroads.db
+    :return: None
+    """
+    compact_queries = {TRANSIT_DISTANCES_TABLE: COMPACT_TRANSIT_DISTANCES_QUERY,
+                       TRANSIT_PAIRS_TABLE: COMPACT_TRANSIT_PAIRS_QUERY,
+                       PART_DISTANCES_TABLE: COMPACT_PART_DISTANCES_QUERY}
+    with transaction(cursor):
+        symmetric = is_symmetric_layout(cursor)
+        if symmetric:  # Renaming the pairs table would redirect the view to the old table - recreate the view after
+            cursor.execute(f"DROP VIEW {TRANSIT_DISTANCES_TABLE}")
+
+        for table_name in compact_queries:
+            if not object_exists(cursor, table_name):
+                continue
+            if is_compact_layout(cursor, table_name):
+                continue
+
+            columns = [column_info[1]
+                       for column_info in cursor.execute(f"PRAGMA table_info({table_name})").fetchall()]
+            columns = ', '.join(columns)
+            cursor.execute(f"ALTER TABLE {table_name} RENAME TO {table_name}_text")  # Indexes move with the table
+            execute_statements(cursor, compact_queries[table_name])
+            # Integer affinity of the new columns converts '060904' to 60904 by itself
+            cursor.execute(f"""INSERT INTO {table_name} ({columns}) 
+                               SELECT {columns} FROM {table_name}_text 
+                               WHERE code_from IS NOT NULL AND code_to IS NOT NULL""")
+            cursor.execute(f"DROP TABLE {table_name}_text")
+            execute_statements(cursor, compact_queries[table_name])  # Indexes which had the names of the old ones
+            print(f"{table_name} has been migrated to the compact layout")
+
+        if symmetric:
+            execute_statements(cursor, TRANSIT_VIEW_QUERY)
+
+
+def migrate_to_symmetric(cursor: sqlite3.Cursor, compact: bool = False) -> bool:
+    """
+    Moves transit distances to the symmetric layout keeping one row per pair of stations. Every distance is checked
+    to have the same distance in the opposite direction, otherwise nothing is migrated.
+    The migration is one transaction, so a crash leaves the directed table
+    :param cursor: cursor to the railroads.db
+    :param compact: Create the pairs table with the compact layout
+    :return: True if transit distances are in the symmetric layout
+    """
+    if is_symmetric_layout(cursor):
+        return True
+
+    if object_exists(cursor, TRANSIT_DISTANCES_TABLE):
+        asymmetric_query = f"""SELECT direct.code_from, direct.code_to, direct.transit_distance, 
+                                      opposite.transit_distance 
+                               FROM {TRANSIT_DISTANCES_TABLE} AS direct 
+                               LEFT JOIN {TRANSIT_DISTANCES_TABLE} AS opposite 
+                               ON opposite.code_from = direct.code_to AND opposite.code_to = direct.code_from 
+                               WHERE opposite.transit_distance IS NOT direct.transit_distance"""
+        asymmetric_select = cursor.execute(asymmetric_query).fetchall()
+        if len(asymmetric_select) != 0:
+            for code_from, code_to, distance, opposite_distance in asymmetric_select[:10]:
+                print(f"  {format_station_code(code_from)} to {format_station_code(code_to)} {distance}km, "
+                      f"opposite direction {opposite_distance}km")
+            print(f"{len(asymmetric_select)} transit distances are not symmetric. "
+                  f"{TRANSIT_DISTANCES_TABLE} won't be migrated to the symmetric layout")
+            return False
+
+        with transaction(cursor):
+            cursor.execute(f"ALTER TABLE {TRANSIT_DISTANCES_TABLE} RENAME TO {TRANSIT_DISTANCES_TABLE}_directed")
+            execute_statements(cursor, COMPACT_TRANSIT_PAIRS_QUERY if compact else TRANSIT_PAIRS_QUERY)
+            # The other half is the same distances in opposite direction
+            cursor.execute(f"""INSERT INTO {TRANSIT_PAIRS_TABLE} (code_from, code_to, transit_distance) 
+                               SELECT code_from, code_to, transit_distance FROM {TRANSIT_DISTANCES_TABLE}_directed 
+                               WHERE code_from <= code_to""")
+            cursor.execute(f"DROP TABLE {TRANSIT_DISTANCES_TABLE}_directed")
+            execute_statements(cursor, TRANSIT_VIEW_QUERY)
+        print(f"{TRANSIT_DISTANCES_TABLE} has been migrated to the symmetric layout")
+    else:
+        with transaction(cursor):
+            execute_statements(cursor, COMPACT_TRANSIT_PAIRS_QUERY if compact else TRANSIT_PAIRS_QUERY)
+            execute_statements(cursor, TRANSIT_VIEW_QUERY)
+    return True
+
+
+def update_part_positions(cursor: sqlite3.Cursor) -> None:
+    """
+    Fills r_transportation_railroad_part_positions from r_transportation_railroad_part_distances
+    Should be called every time railroad part distances change (after Kniga_1 import)
+    :param cursor: cursor to the railroads.db
+    :return: None
+    """
+    cursor.execute(f"DELETE FROM {PART_POSITIONS_TABLE}")
+    # Bare distance column with MIN() is taken from the row with the smallest code_to
+    # printf makes 6-digit codes for both text and compact layouts
+    update_positions_query = f"""
+    INSERT INTO {PART_POSITIONS_TABLE} (station_code, part_code, origin_code, origin_offset, rows_number) 
+    SELECT printf('%06d', code_from), part_code, printf('%06d', MIN(code_to)), distance_between_stations, COUNT(*) 
+    FROM {PART_DISTANCES_TABLE} 
+    GROUP BY code_from, part_code"""
+    cursor.execute(update_positions_query)
+
+
+def create_tables(cursor: sqlite3.Cursor, compact: bool = False, symmetric: bool = False):
+    """
+    Creates all tables for Kniga_1...xls, Kniga_2...xls, Kniga_3...xls data if they don't exist
+    :param cursor: cursor to the railroads.db
+    :param compact: Use the compact layout (integer station codes, WITHOUT ROWID) for the distance tables.
+    Existing distance tables with the text layout are migrated
+    :param symmetric: Store each transit distance once per pair of stations.
+    Existing transit distances are migrated if they are symmetric
+    :return: None
+    """
     create_railroad_stations_query = """
     CREATE TABLE IF NOT EXISTS [r_transportation_railroad_stations](  -- Table with all stations
         [actuality] BOOL NOT NULL DEFAULT 1,
@@ -23,6 +299,17 @@ def create_tables(cursor: sqlite3.Cursor):
     """
     cursor.executescript(create_station_operations_query)
 
+    compact = compact or is_compact_layout(cursor)  # Once compact the tables stay compact
+    if compact:
+        migrate_to_compact(cursor)
+        cursor.execute(COMPACT_PART_DISTANCES_QUERY)
+
+    symmetric = symmetric or is_symmetric_layout(cursor)  # The same for the symmetric layout
+    if symmetric:
+        symmetric = migrate_to_symmetric(cursor, compact)
+    if compact and not symmetric:
+        cursor.execute(COMPACT_TRANSIT_DISTANCES_QUERY)
+
     create_transit_distances_query = """
     CREATE TABLE IF NOT EXISTS [r_transportation_transit_distances](  -- Table of distances between stations to transit points / transit points
         [code_from] VARCHAR(6) REFERENCES r_transportation_railroad_stations([code]) ON DELETE CASCADE, 
@@ -33,7 +320,8 @@ def create_tables(cursor: sqlite3.Cursor):
     [code_from],  
     [code_to]);
     """
-    cursor.executescript(create_transit_distances_query)
+    if not compact and not symmetric:
+        cursor.executescript(create_transit_distances_query)
 
     create_railroad_parts_query = """
     CREATE TABLE IF NOT EXISTS [r_transportation_railroad_parts](  -- Table of railroad parts
@@ -52,11 +340,18 @@ def create_tables(cursor: sqlite3.Cursor):
     ON [r_transportation_railroad_part_distances](
     [code_from],  
     [code_to]);"""
-    cursor.executescript(create_railroad_part_distances_query)
+    if not compact:
+        cursor.executescript(create_railroad_part_distances_query)
+
+    if not object_exists(cursor, PART_POSITIONS_TABLE):  # Databases created before the positions were added
+        cursor.execute(PART_POSITIONS_QUERY)
+        update_part_positions(cursor)
 
 
 if __name__ == '__main__':
     path_to_database = "railroads.db"
     connection = sqlite3.connect(path_to_database)
     cursor = connection.cursor()
-    create_tables(cursor)
+    # --compact and --symmetric create or migrate to the corresponding layouts
+    create_tables(cursor, compact="--compact" in sys.argv, symmetric="--symmetric" in sys.argv)
+    connection.commit()